@@ -0,0 +1,212 @@
+"""
+Message layouts compared on MongoDB: one document per message vs per-recipient buckets
+Seeds one inbox per layout and size, then times the inbox paths and reports data and index sizes
+
+Usage: poetry run python -m benchmarks.buckets [--sizes 1000 100000 1000000] [--message-size 64]
+                                               [--output buckets.json] [--quick]
+
+Needs a MongoDB server (the configured one); everything is written to a dedicated database, dropped afterwards.
+"""
+
+# --- IMPORTS ---
+from benchmarks.harness import Measurement
+from benchmarks.harness import environment
+from benchmarks.harness import measure
+from benchmarks.harness import print_measurements
+from benchmarks.harness import save_results
+from benchmarks.harness import to_json
+from datetime import datetime
+from datetime import timedelta
+from ciphermail.config.database import MESSAGE_LAYOUTS
+from ciphermail.config.database import DatabaseManager
+from ciphermail.config.settings import load_database_settings
+from ciphermail.models.message import Message
+from ciphermail.services.encryption import EncryptionManager
+from ciphermail.services.messaging import MessagingManager
+
+import argparse
+import time
+
+
+# --- TYPES ---
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Tuple
+
+
+# --- GLOBALS ---
+KEY = 'benchmark-key'
+
+# Messages per recipient inbox
+INBOX_SIZES = (1000, 100000, 1000000)
+
+# Messages written per insert_many call while seeding
+SEED_BATCH = 10000
+
+# Headers per inbox page
+PAGE_SIZE = 20
+
+# Database used by the benchmark (dropped afterwards)
+BENCHMARK_DATABASE = 'ciphermail_benchmark_layouts'
+
+
+# --- CODE ---
+def seed_inbox(backend: DatabaseManager, recipient: str, count: int, size: int) -> Tuple[float, dict]:
+    """
+    Stores unread messages for a recipient, oldest first, one second apart
+
+    :param backend: DatabaseManager to seed
+    :param recipient: Recipient's username
+    :param count: Number of messages
+    :param size: Plain text size of each message
+
+    :return: Tuple of (messages stored per second, the middle message's document)
+    """
+    token = EncryptionManager.encrypt('x' * size, KEY)
+    first = datetime.now() - timedelta(seconds=count)
+    repository = backend.get_message_repository()
+    middle = None
+    start = time.perf_counter()
+
+    for offset in range(0, count, SEED_BATCH):
+        batch = [Message('alice', recipient, token, first + timedelta(seconds=offset + n), False).to_dict()
+                 for n in range(min(SEED_BATCH, count - offset))]
+        repository.insert_many(batch)
+
+        # Middle of the inbox in this batch: keep it as the deep page position
+        if offset <= count // 2 < offset + len(batch):
+            middle = batch[count // 2 - offset]
+
+    return count / (time.perf_counter() - start), middle
+
+
+def storage_stats(backend: DatabaseManager) -> Dict[str, int]:
+    """
+    Reads the data and index sizes of the collection holding the messages
+
+    :param backend: DatabaseManager of one layout
+
+    :return: Dictionary of documents, data size, storage size and total index size (bytes)
+    """
+    collection = backend.message_buckets if backend.layout == 'bucket' else backend.messages
+    stats = next(collection.aggregate([{'$collStats': {'storageStats': {}}}]))['storageStats']
+    return {
+        'documents': stats['count'],
+        'size': stats['size'],
+        'storage_size': stats['storageSize'],
+        'index_size': stats['totalIndexSize'],
+    }
+
+
+def layout_cases(backend: DatabaseManager, recipient: str, middle: dict) -> List[Tuple[str, Callable[[], object]]]:
+    """
+    Builds the inbox path cases of one seeded inbox
+
+    :param backend: DatabaseManager of one layout
+    :param recipient: Recipient of the seeded inbox
+    :param middle: Document of the message in the middle of the inbox
+
+    :return: List of (case name, callable) tuples
+    """
+    messaging_manager = MessagingManager(backend)
+    repository = backend.get_message_repository()
+    message_id = middle['_id']
+
+    # First read of a message, undone so every call reads an unread message
+    def acknowledge() -> None:
+        repository.acknowledge(message_id, recipient)
+        repository.mark_unread(message_id)
+
+    return [
+        ('get_unread_page[first]', lambda: messaging_manager.get_unread_page(recipient, PAGE_SIZE)),
+        ('find_unread_page[middle]',
+         lambda: repository.find_unread_page(recipient, (middle['timestamp'], message_id), PAGE_SIZE)),
+        ('get_encrypted_content', lambda: repository.get_encrypted_content(message_id)),
+        ('acknowledge+mark_unread', acknowledge),
+    ]
+
+
+def run(sizes: List[int], message_size: int, repeats: int, min_time: float) -> Tuple[List[Measurement], Dict]:
+    """
+    Seeds and measures every layout at every inbox size
+
+    :param sizes: Messages per inbox
+    :param message_size: Plain text size of each message
+    :param repeats: Timed runs per case
+    :param min_time: Minimum duration of one run, in seconds
+
+    :return: Tuple of (measurements, storage figures per '<layout>[<size> msgs]')
+    """
+    settings = load_database_settings()._replace(database_name=BENCHMARK_DATABASE)
+    measurements = []
+    storage = {}
+
+    for layout in MESSAGE_LAYOUTS:
+        backend = DatabaseManager(settings, shared=False, layout=layout)
+
+        try:
+            for size in sizes:
+
+                # Each inbox alone in the database, so the sizes are its own
+                backend.client.drop_database(BENCHMARK_DATABASE)
+                backend.ensure_indexes()
+
+                recipient = f'inbox{size}'
+                label = f'{layout}[{size} msgs]'
+                rate, middle = seed_inbox(backend, recipient, size, message_size)
+                storage[label] = {'seed_rate': rate, **storage_stats(backend)}
+                print(f'Seeded {label} at {rate:,.0f} messages/s')
+
+                for name, function in layout_cases(backend, recipient, middle):
+                    measurements.append(measure(f'{layout}.{name}[{size} msgs]', function, repeats, min_time))
+
+        # Leave nothing behind
+        finally:
+            backend.client.drop_database(BENCHMARK_DATABASE)
+            backend.close()
+
+    return measurements, storage
+
+
+def print_storage(storage: Dict[str, Dict[str, float]]) -> None:
+    """
+    Prints seeding rates and sizes as a table
+
+    :param storage: Figures from run()
+
+    :return: None
+    """
+    print(f'\n{"layout":<28}{"seed msg/s":>12}{"documents":>12}{"data MiB":>10}{"disk MiB":>10}{"index MiB":>11}')
+    for label, figures in storage.items():
+        print(f'{label:<28}{figures["seed_rate"]:>12,.0f}{figures["documents"]:>12,}'
+              f'{figures["size"] / 2 ** 20:>10.1f}{figures["storage_size"] / 2 ** 20:>10.1f}'
+              f'{figures["index_size"] / 2 ** 20:>11.1f}')
+
+
+def main() -> None:
+    """
+    Runs the comparison and writes JSON results
+
+    :return: None
+    """
+    parser = argparse.ArgumentParser(description='Compare the document and bucket message layouts')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(INBOX_SIZES),
+                        help='messages per inbox (default: 1000 100000 1000000)')
+    parser.add_argument('--message-size', type=int, default=64, help='plain text bytes per message (default: 64)')
+    parser.add_argument('--output', default='buckets_results.json', help="JSON results file ('-' for stdout)")
+    parser.add_argument('--quick', action='store_true', help='fewer, shorter runs')
+    args = parser.parse_args()
+
+    repeats, min_time = (3, 0.05) if args.quick else (5, 0.2)
+    measurements, storage = run(sorted(args.sizes), args.message_size, repeats, min_time)
+    print_measurements(measurements)
+    print_storage(storage)
+
+    results = to_json(measurements, {'message_size': args.message_size, 'quick': args.quick, **environment()})
+    results['storage'] = storage
+    save_results(args.output, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Micro-benchmarks for EncryptionManager: derived cipher cache and batch API
+
+Usage: poetry run python -m benchmarks.encryption
+"""
+
+# --- IMPORTS ---
+from cryptography.fernet import Fernet
+from ciphermail.services.encryption import EncryptionManager
+
+import timeit
+
+
+# --- GLOBALS ---
+KEY = 'correct horse battery staple'
+MESSAGE = 'Meet me at the usual place at 10pm.'
+ITERATIONS = 20000
+BATCH_SIZE = 20000
+
+
+# --- CODE ---
+def uncached_decrypt(token: str) -> str:
+    """
+    Decrypts the way EncryptionManager did before caching: derive key and build Fernet per call
+
+    :param token: Fernet token to decrypt
+
+    :return: Decrypted message
+    """
+    fernet = Fernet(EncryptionManager.normalize_key(KEY))
+    return fernet.decrypt(token.encode()).decode()
+
+
+def per_call_microseconds(statement, iterations: int = ITERATIONS) -> float:
+    """
+    Returns the best per-call time of a statement in microseconds
+
+    :param statement: Callable to time
+    :param iterations: Calls per timing run
+
+    :return: Microseconds per call
+    """
+    return min(timeit.repeat(statement, number=iterations, repeat=5)) / iterations * 1e6
+
+
+def main() -> None:
+    """
+    Runs the benchmark and prints the per-message saving
+
+    :return: None
+    """
+    token = EncryptionManager.encrypt(MESSAGE, KEY)
+
+    # Setup cost alone: key derivation + Fernet construction vs cache lookup
+    setup_uncached = per_call_microseconds(lambda: Fernet(EncryptionManager.normalize_key(KEY)))
+    setup_cached = per_call_microseconds(lambda: EncryptionManager.get_cipher(KEY))
+
+    # Full decrypt path
+    decrypt_uncached = per_call_microseconds(lambda: uncached_decrypt(token))
+    decrypt_cached = per_call_microseconds(lambda: EncryptionManager.decrypt(token, KEY))
+
+    print(f'{"path":<24}{"uncached (us)":>16}{"cached (us)":>16}{"saving (us)":>16}')
+    print(f'{"cipher setup":<24}{setup_uncached:>16.2f}{setup_cached:>16.2f}'
+          f'{setup_uncached - setup_cached:>16.2f}')
+    print(f'{"decrypt per message":<24}{decrypt_uncached:>16.2f}{decrypt_cached:>16.2f}'
+          f'{decrypt_uncached - decrypt_cached:>16.2f}')
+
+    # Batch path: serial loop vs decrypt_many (thread pool above the threshold)
+    tokens = [token] * BATCH_SIZE
+    serial = min(timeit.repeat(lambda: [EncryptionManager.decrypt(t, KEY) for t in tokens],
+                               number=1, repeat=3))
+    batched = min(timeit.repeat(lambda: EncryptionManager.decrypt_many(tokens, KEY),
+                                number=1, repeat=3))
+
+    print(f'\n{"batch of " + str(BATCH_SIZE):<24}{"serial (ms)":>16}{"batched (ms)":>16}{"speedup":>16}')
+    print(f'{"decrypt":<24}{serial * 1e3:>16.1f}{batched * 1e3:>16.1f}{serial / batched:>15.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+"""
+Timing, JSON results and baseline comparison shared by the benchmark suite
+"""
+
+# --- IMPORTS ---
+from datetime import datetime
+from datetime import timezone
+
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+
+# --- TYPES ---
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+
+
+# --- GLOBALS ---
+# Results file format version (bump when the layout changes)
+RESULTS_VERSION = 1
+
+# Default slowdown (fraction of the baseline median) reported as a regression
+REGRESSION_THRESHOLD = 0.10
+
+
+# --- CODE ---
+class Measurement(NamedTuple):
+    """
+    Per-call timings of one benchmark case, in microseconds
+    """
+    name: str
+    median: float
+    minimum: float
+    stdev: float
+    calls: int
+    repeats: int
+
+
+class Comparison(NamedTuple):
+    """
+    One benchmark case compared to its baseline
+    """
+    name: str
+    baseline: float
+    current: float
+    ratio: float
+    regression: bool
+
+
+def measure(name: str, function: Callable[[], object], repeats: int = 5, min_time: float = 0.2) -> Measurement:
+    """
+    Times a callable: calibrates the calls per run to last at least min_time, then repeats the runs
+
+    :param name: Case name
+    :param function: Callable to time
+    :param repeats: Number of timed runs
+    :param min_time: Minimum duration of one run, in seconds
+
+    :return: Measurement with per-call timings
+    """
+
+    # Calibrate: double the calls until one run is long enough
+    calls = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(calls):
+            function()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        calls *= 2
+
+    # Timed runs
+    per_call = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(calls):
+            function()
+        per_call.append((time.perf_counter() - start) / calls * 1e6)
+
+    return Measurement(
+        name=name,
+        median=statistics.median(per_call),
+        minimum=min(per_call),
+        stdev=statistics.stdev(per_call) if len(per_call) > 1 else 0.0,
+        calls=calls,
+        repeats=repeats
+    )
+
+
+def git_revision() -> Optional[str]:
+    """
+    Returns the current git commit, if the suite runs from a checkout
+
+    :return: Commit hash, or None
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+
+    # Not a checkout or git missing: no revision
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment() -> Dict[str, object]:
+    """
+    Describes the machine and interpreter the results were taken on
+
+    :return: Dictionary of environment details
+    """
+    return {
+        'python': sys.version.split()[0],
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'revision': git_revision(),
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+    }
+
+
+def to_json(measurements: List[Measurement], metadata: Dict[str, object]) -> Dict[str, object]:
+    """
+    Builds the results document written by the suite
+
+    :param measurements: Measurements to include
+    :param metadata: Run details (backend, environment, ...)
+
+    :return: Results document
+    """
+    return {
+        'version': RESULTS_VERSION,
+        'unit': 'us/call',
+        'metadata': metadata,
+        'results': {measurement.name: measurement._asdict() for measurement in measurements},
+    }
+
+
+def save_results(path: str, results: Dict[str, object]) -> None:
+    """
+    Writes a results document
+
+    :param path: Output file path ('-' for stdout)
+    :param results: Results document
+
+    :return: None
+    """
+
+    # Stdout: print instead of writing a file
+    if path == '-':
+        print(json.dumps(results, indent=2))
+        return
+
+    with open(path, 'w') as output:
+        json.dump(results, output, indent=2)
+
+
+def load_results(path: str) -> Dict[str, object]:
+    """
+    Reads a results document
+
+    :param path: Results file path
+
+    :return: Results document
+    """
+    with open(path) as results_file:
+        return json.load(results_file)
+
+
+def compare(baseline: Dict[str, object],
+            current: Dict[str, object],
+            threshold: float = REGRESSION_THRESHOLD) -> List[Comparison]:
+    """
+    Compares the medians of the cases present in both results documents
+
+    :param baseline: Baseline results document
+    :param current: Current results document
+    :param threshold: Slowdown (fraction of the baseline median) reported as a regression
+
+    :return: List of comparisons, in the current run's order
+    """
+    comparisons = []
+
+    for name, result in current['results'].items():
+
+        # New case: nothing to compare against
+        if name not in baseline['results']:
+            continue
+
+        baseline_median = baseline['results'][name]['median']
+        ratio = result['median'] / baseline_median if baseline_median else float('inf')
+        comparisons.append(Comparison(name, baseline_median, result['median'], ratio, ratio > 1 + threshold))
+
+    return comparisons
+
+
+def print_measurements(measurements: List[Measurement]) -> None:
+    """
+    Prints measurements as a table
+
+    :param measurements: Measurements to print
+
+    :return: None
+    """
+    print(f'{"case":<48}{"median (us)":>14}{"min (us)":>12}{"stdev":>10}{"calls":>8}')
+    for measurement in measurements:
+        print(f'{measurement.name:<48}{measurement.median:>14.2f}{measurement.minimum:>12.2f}'
+              f'{measurement.stdev:>10.2f}{measurement.calls:>8}')
+
+
+def print_comparisons(comparisons: List[Comparison], threshold: float) -> None:
+    """
+    Prints a baseline comparison as a table, flagging regressions
+
+    :param comparisons: Comparisons to print
+    :param threshold: Slowdown reported as a regression
+
+    :return: None
+    """
+    print(f'\n{"case":<48}{"baseline (us)":>14}{"current (us)":>14}{"change":>10}')
+    for comparison in comparisons:
+        flag = '  REGRESSION' if comparison.regression else ''
+        print(f'{comparison.name:<48}{comparison.baseline:>14.2f}{comparison.current:>14.2f}'
+              f'{(comparison.ratio - 1) * 100:>+9.1f}%{flag}')
+
+    regressions = sum(comparison.regression for comparison in comparisons)
+    print(f'\n{regressions} regression(s) above {threshold * 100:.0f}% out of {len(comparisons)} compared case(s)')
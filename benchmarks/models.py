@@ -0,0 +1,107 @@
+"""
+Memory benchmark for Message models on a 100k-message inbox
+
+Usage: poetry run python -m benchmarks.models
+"""
+
+# --- IMPORTS ---
+from bson import ObjectId
+from datetime import datetime
+from ciphermail.models.message import Message
+from ciphermail.services.encryption import EncryptionManager
+
+import gc
+import tracemalloc
+
+
+# --- TYPES ---
+from typing import Callable
+from typing import Iterator
+
+
+# --- GLOBALS ---
+INBOX_SIZE = 100_000
+CONTENT = 'x' * 280
+
+
+# --- CODE ---
+class LegacyMessage:
+    """
+    Message model as it was before __slots__ and lazy loading (plain __dict__, eager fields)
+    """
+
+    def __init__(self, sender, recipient, encrypted_content, timestamp, read, _id) -> None:
+        self.sender = sender
+        self.recipient = recipient
+        self.encrypted_content = encrypted_content
+        self.timestamp = timestamp
+        self.read = read
+        self._id = _id
+
+
+def documents(token: str, with_content: bool) -> Iterator[dict]:
+    """
+    Yields fresh documents the way a cursor does
+
+    :param token: Encrypted content template
+    :param with_content: Whether documents carry encrypted_content (False mimics the header projection)
+
+    :return: Iterator of message documents
+    """
+    for i in range(INBOX_SIZE):
+        document = {'_id': ObjectId(), 'sender': f'user{i % 500}', 'recipient': 'alice',
+                    'timestamp': datetime.now(), 'read': False}
+
+        # Full document: each one owns its own ciphertext string
+        if with_content:
+            document['encrypted_content'] = token[:-1] + str(i % 10)
+
+        yield document
+
+
+def retained_megabytes(build: Callable[[], list]) -> float:
+    """
+    Measures the memory retained by the objects a builder returns
+
+    :param build: Callable building the inbox
+
+    :return: Retained memory in MiB
+    """
+    gc.collect()
+    tracemalloc.start()
+    inbox = build()
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del inbox
+    return current / (1024 * 1024)
+
+
+def main() -> None:
+    """
+    Runs the benchmark and prints retained memory per model variant
+
+    :return: None
+    """
+    token = EncryptionManager.encrypt(CONTENT, 'benchmark-key')
+    loader = lambda message_id: token
+
+    variants = [
+        ('legacy __dict__, full documents',
+         lambda: [LegacyMessage(d['sender'], d['recipient'], d['encrypted_content'],
+                                d['timestamp'], d.get('read', False), d.get('_id'))
+                  for d in documents(token, True)]),
+        ('__slots__, full documents',
+         lambda: [Message.from_dict(d) for d in documents(token, True)]),
+        ('__slots__, header projection (lazy)',
+         lambda: [Message.from_dict(d, loader) for d in documents(token, False)]),
+    ]
+
+    print(f'{"variant (" + str(INBOX_SIZE) + " messages)":<44}{"MiB":>10}{"bytes/msg":>12}')
+    for name, build in variants:
+        megabytes = retained_megabytes(build)
+        print(f'{name:<44}{megabytes:>10.1f}{megabytes * 1024 * 1024 / INBOX_SIZE:>12.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Login throughput benchmark for each password KDF cost setting
+
+Usage: poetry run python -m benchmarks.passwords [seconds per setting]
+"""
+
+# --- IMPORTS ---
+from concurrent.futures import ThreadPoolExecutor
+from ciphermail.services.passwords import LegacySha256KDF
+from ciphermail.services.passwords import PASSWORD_HASH_WORKERS
+from ciphermail.services.passwords import PasswordHasher
+from ciphermail.services.passwords import ScryptKDF
+
+import sys
+import time
+
+
+# --- GLOBALS ---
+PASSWORD = 'correct horse battery staple'
+
+# (label, KDF) pairs, cheapest first
+SETTINGS = [
+    ('sha256 (legacy)', LegacySha256KDF()),
+    ('scrypt ln=12 r=8 p=1', ScryptKDF(log_n=12)),
+    ('scrypt ln=14 r=8 p=1', ScryptKDF(log_n=14)),
+    ('scrypt ln=15 r=8 p=1', ScryptKDF(log_n=15)),
+    ('scrypt ln=16 r=8 p=1', ScryptKDF(log_n=16)),
+]
+
+
+# --- CODE ---
+def logins_per_second(hasher: PasswordHasher, encoded: str, clients: int, duration: float) -> float:
+    """
+    Runs concurrent password verifications (the CPU part of a login) for a fixed duration
+
+    :param hasher: PasswordHasher to benchmark
+    :param encoded: Stored hash to verify against
+    :param clients: Number of concurrent login sessions
+    :param duration: Seconds to run
+
+    :return: Verified logins per second
+    """
+    deadline = time.perf_counter() + duration
+
+    def session() -> int:
+        count = 0
+        while time.perf_counter() < deadline:
+            hasher.verify(PASSWORD, encoded)
+            count += 1
+        return count
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as sessions:
+        total = sum(sessions.map(lambda _: session(), range(clients)))
+
+    return total / (time.perf_counter() - start)
+
+
+def main() -> None:
+    """
+    Runs the benchmark and prints logins per second per cost setting
+
+    :return: None
+    """
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 3.0
+    clients = PASSWORD_HASH_WORKERS * 2
+
+    print(f'{PASSWORD_HASH_WORKERS} hashing workers, {clients} concurrent sessions, {duration:.0f}s per setting\n')
+    print(f'{"setting":<24}{"ms/login":>12}{"logins/s":>12}')
+
+    for label, kdf in SETTINGS:
+        hasher = PasswordHasher(kdf)
+        encoded = kdf.hash(PASSWORD)
+
+        # Single-login latency, then throughput under concurrency
+        start = time.perf_counter()
+        hasher.verify(PASSWORD, encoded)
+        latency = (time.perf_counter() - start) * 1000
+
+        rate = logins_per_second(hasher, encoded, clients, duration)
+        print(f'{label:<24}{latency:>12.2f}{rate:>12.1f}')
+
+        hasher.pool.shutdown()
+
+
+if __name__ == '__main__':
+    main()
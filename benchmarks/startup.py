@@ -0,0 +1,166 @@
+"""
+Startup cost of the interactive CLI: import time (-X importtime) and wall-clock time to the first prompt
+
+Usage: poetry run python -m benchmarks.startup [--runs 10] [--top 15] [--output startup.json]
+                                               [--budget-ms 300]
+
+Exits with status 1 when a budget is given and the median time to the first prompt exceeds it.
+"""
+
+# --- IMPORTS ---
+from benchmarks.harness import save_results
+
+import argparse
+import os
+import select
+import statistics
+import subprocess
+import sys
+import time
+
+
+# --- TYPES ---
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+
+# --- GLOBALS ---
+# What the process imports before showing the first menu
+STARTUP_IMPORTS = 'import ciphermail.app, ciphermail.interface.cli'
+
+# Packages that should stay out of startup (loaded on first use instead)
+DEFERRED_PACKAGES = ('pymongo', 'bson', 'cryptography', 'dotenv')
+
+# Text of the first prompt, and how long to wait for it
+FIRST_PROMPT = b'Choose an option'
+PROMPT_TIMEOUT = 30.0
+
+
+# --- CODE ---
+def import_times(statement: str = STARTUP_IMPORTS) -> Dict[str, Tuple[int, int]]:
+    """
+    Runs a statement in a fresh interpreter with -X importtime
+
+    :param statement: Python statement importing the modules to profile
+
+    :return: Dictionary of module name to (self, cumulative) import time in microseconds
+    """
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement],
+                               capture_output=True, text=True, check=True)
+    times = {}
+
+    for line in completed.stderr.splitlines():
+
+        # Only 'import time: self | cumulative | name' lines (skip the header)
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+
+    return times
+
+
+def time_to_prompt() -> float:
+    """
+    Starts the interactive CLI and waits for its first prompt
+
+    :return: Seconds from process start to the prompt appearing on stdout
+
+    :raises TimeoutError: If no prompt appears within PROMPT_TIMEOUT
+    """
+    environment = dict(os.environ, TERM=os.getenv('TERM', 'dumb'))
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, '-m', 'ciphermail.main'], stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, env=environment)
+    output = b''
+
+    try:
+        while FIRST_PROMPT not in output:
+            remaining = PROMPT_TIMEOUT - (time.perf_counter() - start)
+            readable, _, _ = select.select([process.stdout], [], [], max(remaining, 0))
+
+            # Nothing in time, or the process exited: give up
+            if not readable:
+                raise TimeoutError('No prompt within the timeout')
+            data = os.read(process.stdout.fileno(), 65536)
+            if not data:
+                raise TimeoutError('Process exited before prompting')
+
+            output += data
+
+        return time.perf_counter() - start
+
+    # Never leave the CLI running
+    finally:
+        process.kill()
+        process.wait()
+
+
+def summarize(times: Dict[str, Tuple[int, int]], top: int) -> dict:
+    """
+    Summarizes an import profile
+
+    :param times: Output of import_times()
+    :param top: Number of slowest modules (by self time) to keep
+
+    :return: Dictionary with the total, the slowest modules and the deferred packages that were loaded
+    """
+    slowest = sorted(times.items(), key=lambda item: item[1][0], reverse=True)[:top]
+
+    return {
+        'total_ms': sum(self_us for self_us, _ in times.values()) / 1000,
+        'modules': len(times),
+        'slowest': [{'module': name, 'self_ms': self_us / 1000, 'cumulative_ms': cumulative_us / 1000}
+                    for name, (self_us, cumulative_us) in slowest],
+        'deferred_loaded': sorted({name.split('.')[0] for name in times} & set(DEFERRED_PACKAGES)),
+    }
+
+
+def main() -> None:
+    """
+    Runs the benchmark, prints the results and checks the budget if given
+
+    :return: None
+    """
+    parser = argparse.ArgumentParser(description='CipherMail startup benchmark')
+    parser.add_argument('--runs', type=int, default=10, help='CLI starts to time (default: 10)')
+    parser.add_argument('--top', type=int, default=15, help='slowest imports to list (default: 15)')
+    parser.add_argument('--output', help="JSON results file ('-' for stdout)")
+    parser.add_argument('--budget-ms', type=float, help='fail if the median time to first prompt exceeds this')
+    args = parser.parse_args()
+
+    imports = summarize(import_times(), args.top)
+    print(f'Startup imports: {imports["total_ms"]:.1f} ms over {imports["modules"]} modules')
+    print(f'{"module":<56}{"self (ms)":>12}{"cumul. (ms)":>14}')
+    for entry in imports['slowest']:
+        print(f'{entry["module"]:<56}{entry["self_ms"]:>12.2f}{entry["cumulative_ms"]:>14.2f}')
+
+    # Deferred packages showing up at startup: a new eager import crept in
+    if imports['deferred_loaded']:
+        print(f'\nLoaded at startup but meant to be deferred: {", ".join(imports["deferred_loaded"])}')
+
+    samples: List[float] = [time_to_prompt() * 1000 for _ in range(args.runs)]
+    prompt = {'median_ms': statistics.median(samples), 'min_ms': min(samples), 'max_ms': max(samples),
+              'runs': args.runs}
+    print(f'\nTime to first prompt: median {prompt["median_ms"]:.1f} ms, min {prompt["min_ms"]:.1f} ms, '
+          f'max {prompt["max_ms"]:.1f} ms ({args.runs} runs)')
+
+    results = {'imports': imports, 'first_prompt': prompt, 'python': sys.version.split()[0]}
+
+    # Output file requested: write JSON ('-' for stdout)
+    if args.output:
+        save_results(args.output, results)
+
+    budget: Optional[float] = args.budget_ms
+
+    # Over budget: fail, so CI can gate on it
+    if budget is not None and prompt['median_ms'] > budget:
+        print(f'Over budget: {prompt["median_ms"]:.1f} ms > {budget:.1f} ms')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
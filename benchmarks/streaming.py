@@ -0,0 +1,84 @@
+"""
+Peak memory of inline vs streamed (chunked) encryption for large bodies
+
+Usage: poetry run python -m benchmarks.streaming
+"""
+
+# --- IMPORTS ---
+from ciphermail.services.encryption import EncryptionManager
+
+import gc
+import io
+import time
+import tracemalloc
+
+
+# --- TYPES ---
+from typing import Callable
+from typing import Tuple
+
+
+# --- GLOBALS ---
+KEY = 'benchmark-key'
+BODY_SIZES_MIB = (1, 16, 64)
+
+
+# --- CODE ---
+class NullWriter:
+    """
+    Binary writer discarding everything (stands in for a file or socket)
+    """
+
+    def write(self, data: bytes) -> int:
+        return len(data)
+
+
+def peak_megabytes(function: Callable[[], object]) -> Tuple[float, float]:
+    """
+    Measures the peak memory allocated while a callable runs
+
+    :param function: Callable to measure
+
+    :return: Tuple of (peak MiB, seconds)
+    """
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / (1024 * 1024), elapsed
+
+
+def main() -> None:
+    """
+    Runs the benchmark and prints peak memory per body size and mode
+
+    :return: None
+    """
+    print(f'{"body":>8}{"mode":>22}{"peak MiB":>12}{"seconds":>10}')
+
+    for size in BODY_SIZES_MIB:
+        body = 'x' * (size * 1024 * 1024)
+        raw = body.encode()
+        token = EncryptionManager.encrypt(body, KEY)
+        nonce_prefix, chunks = EncryptionManager.encrypt_stream(io.BytesIO(raw), KEY)
+        chunks = list(chunks)
+
+        modes = [
+            ('inline encrypt', lambda: EncryptionManager.encrypt(body, KEY)),
+            ('inline decrypt', lambda: EncryptionManager.decrypt(token, KEY)),
+            ('streamed encrypt', lambda: sum(1 for _ in EncryptionManager.encrypt_stream(
+                io.BytesIO(raw), KEY)[1])),
+            ('streamed decrypt', lambda: EncryptionManager.decrypt_stream(nonce_prefix, iter(chunks), KEY,
+                                                                          NullWriter())),
+        ]
+
+        for mode, function in modes:
+            megabytes, seconds = peak_megabytes(function)
+            print(f'{str(size) + " MiB":>8}{mode:>22}{megabytes:>12.1f}{seconds:>10.3f}')
+
+
+if __name__ == '__main__':
+    main()
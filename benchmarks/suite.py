@@ -0,0 +1,331 @@
+"""
+Benchmark suite: crypto, model serialization and service paths, with JSON results and baseline comparison
+
+Usage: poetry run python -m benchmarks.suite [--backend memory|mongo] [--output results.json]
+                                             [--baseline baseline.json] [--threshold 0.10]
+                                             [--filter text] [--quick]
+
+Exits with status 1 when a baseline is given and a case regressed beyond the threshold.
+"""
+
+# --- IMPORTS ---
+from benchmarks.harness import REGRESSION_THRESHOLD
+from benchmarks.harness import Measurement
+from benchmarks.harness import compare
+from benchmarks.harness import environment
+from benchmarks.harness import load_results
+from benchmarks.harness import measure
+from benchmarks.harness import print_comparisons
+from benchmarks.harness import print_measurements
+from benchmarks.harness import save_results
+from benchmarks.harness import to_json
+from datetime import datetime
+from ciphermail.config.database import DatabaseManager
+from ciphermail.config.settings import load_database_settings
+from ciphermail.models.message import Message
+from ciphermail.services.auth import AuthManager
+from ciphermail.services.compression import COMPRESSORS
+from ciphermail.services.compression import compress
+from ciphermail.services.encryption import EncryptionManager
+from ciphermail.services.messaging import MessagingManager
+from ciphermail.storage.base import StorageBackend
+from ciphermail.storage.memory import InMemoryBackend
+
+import argparse
+import random
+import sys
+
+
+# --- TYPES ---
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Tuple
+
+
+# --- GLOBALS ---
+KEY = 'benchmark-key'
+PASSWORD = 'correct horse battery staple'
+
+# Plain text sizes (bytes) for the crypto and message paths
+MESSAGE_SIZES = (64, 1024, 16 * 1024, 256 * 1024)
+
+# Vocabulary for text-like message bodies (compression ratios depend on realistic input)
+WORDS = ('the meeting is moved to thursday please bring the quarterly report and the updated figures '
+         'for review we still need approval from finance before sending the contract to the client '
+         'let me know if the new schedule works for you thanks again for your help with the launch').split()
+
+# Unread messages per inbox for the inbox paths
+INBOX_SIZES = (10, 100, 1000)
+
+# Messages read at once by the bulk read case
+BULK_READ_SIZE = 100
+
+# Database used with --backend mongo (dropped afterwards)
+BENCHMARK_DATABASE = 'ciphermail_benchmark'
+
+
+# --- CODE ---
+def payload(size: int) -> str:
+    """
+    Builds a plain text message of a given size
+
+    :param size: Size in bytes
+
+    :return: Message text
+    """
+    return ('lorem ipsum ' * (size // 12 + 1))[:size]
+
+
+def sample_text(size: int) -> str:
+    """
+    Builds a text-like message of a given size (deterministic pseudo-random words and punctuation)
+
+    :param size: Size in bytes
+
+    :return: Message text
+    """
+    generator = random.Random(size)
+    words = []
+    length = 0
+
+    while length < size:
+        word = generator.choice(WORDS) + generator.choice(('', '', '', '', ',', '.'))
+        words.append(word)
+        length += len(word) + 1
+
+    return ' '.join(words)[:size]
+
+
+def crypto_cases() -> List[Tuple[str, Callable[[], object]]]:
+    """
+    Builds the EncryptionManager cases, per message size
+
+    :return: List of (case name, callable) tuples
+    """
+    cases = []
+
+    for size in MESSAGE_SIZES:
+        text = payload(size)
+        token = EncryptionManager.encrypt(text, KEY)
+        cases.append((f'crypto.encrypt[{size}B]', lambda text=text: EncryptionManager.encrypt(text, KEY)))
+        cases.append((f'crypto.decrypt[{size}B]', lambda token=token: EncryptionManager.decrypt(token, KEY)))
+
+    # Compress-then-encrypt pipeline, per available algorithm, on text-like bodies above the threshold
+    for algorithm in COMPRESSORS:
+        for size in MESSAGE_SIZES[1:]:
+            text = sample_text(size)
+            data, used = compress(text.encode(), algorithm)
+            token = EncryptionManager.get_cipher(KEY).encrypt(data).decode()
+            cases.append((f'crypto.encrypt+{algorithm}[{size}B]',
+                          lambda text=text, algorithm=algorithm: EncryptionManager.get_cipher(KEY).encrypt(
+                              compress(text.encode(), algorithm)[0])))
+            cases.append((f'crypto.decrypt+{algorithm}[{size}B]',
+                          lambda token=token, used=used: EncryptionManager.decrypt(token, KEY, used)))
+
+    return cases
+
+
+def compression_ratios() -> Dict[str, Dict[str, float]]:
+    """
+    Measures stored ciphertext size with and without compression, on text-like bodies
+
+    :return: Dictionary of '<algorithm>[<size>B]' to plain, stored and ratio (plain / stored) figures
+    """
+    ratios = {}
+
+    for algorithm in ('none',) + tuple(COMPRESSORS):
+        for size in MESSAGE_SIZES:
+            text = sample_text(size)
+            data = text.encode() if algorithm == 'none' else compress(text.encode(), algorithm)[0]
+            stored = len(EncryptionManager.get_cipher(KEY).encrypt(data))
+            ratios[f'{algorithm}[{size}B]'] = {'plain': size, 'stored': stored, 'ratio': size / stored}
+
+    return ratios
+
+
+def print_ratios(ratios: Dict[str, Dict[str, float]]) -> None:
+    """
+    Prints compression ratios as a table
+
+    :param ratios: Ratios from compression_ratios()
+
+    :return: None
+    """
+    print(f'\n{"stored size":<48}{"plain (B)":>14}{"stored (B)":>12}{"ratio":>10}')
+    for name, figures in ratios.items():
+        print(f'{name:<48}{figures["plain"]:>14}{figures["stored"]:>12}{figures["ratio"]:>10.2f}')
+
+
+def model_cases() -> List[Tuple[str, Callable[[], object]]]:
+    """
+    Builds the Message serialization cases, per message size
+
+    :return: List of (case name, callable) tuples
+    """
+    cases = []
+
+    for size in MESSAGE_SIZES:
+        message = Message('alice', 'bob', EncryptionManager.encrypt(payload(size), KEY), datetime.now(), False)
+        document = message.to_dict()
+        cases.append((f'models.Message.to_dict[{size}B]', message.to_dict))
+        cases.append((f'models.Message.from_dict[{size}B]', lambda document=document: Message.from_dict(document)))
+
+    return cases
+
+
+def seed_inbox(backend: StorageBackend, recipient: str, count: int, size: int = 1024) -> None:
+    """
+    Stores unread messages for a recipient directly through the message repository
+
+    :param backend: StorageBackend to seed
+    :param recipient: Recipient's username
+    :param count: Number of messages
+    :param size: Plain text size of each message
+
+    :return: None
+    """
+    token = EncryptionManager.encrypt(payload(size), KEY)
+    backend.get_message_repository().insert_many([
+        Message('alice', recipient, token, datetime.now(), False).to_dict() for _ in range(count)
+    ])
+
+
+def service_cases(backend: StorageBackend) -> List[Tuple[str, Callable[[], object]]]:
+    """
+    Builds the AuthManager and MessagingManager cases on a storage backend
+
+    :param backend: StorageBackend to run against (seeded here)
+
+    :return: List of (case name, callable) tuples
+    """
+    auth_manager = AuthManager(backend)
+    messaging_manager = MessagingManager(backend)
+
+    # Sender, a recipient collecting sent messages, and one recipient per inbox size
+    for username in ['alice', 'sink'] + [f'inbox{size}' for size in INBOX_SIZES]:
+        auth_manager.register(username, PASSWORD)
+
+    cases = [('auth.AuthManager.login', lambda: auth_manager.login('alice', PASSWORD))]
+
+    # Send and read paths, per message size
+    for size in MESSAGE_SIZES:
+        text = payload(size)
+        message_id = backend.get_message_repository().insert(
+            Message('alice', 'sink', EncryptionManager.encrypt(text, KEY), datetime.now(), False).to_dict()
+        )
+        cases.append((f'messaging.send_message[{size}B]',
+                      lambda text=text: messaging_manager.send_message('alice', 'sink', text, KEY)))
+        cases.append((f'messaging.read_message[{size}B]',
+                      lambda message_id=message_id: messaging_manager.read_message(message_id, KEY)))
+
+    # Inbox listing paths, per inbox size
+    for size in INBOX_SIZES:
+        recipient = f'inbox{size}'
+        seed_inbox(backend, recipient, size)
+        cases.append((f'messaging.get_unread_messages[{size} msgs]',
+                      lambda recipient=recipient: messaging_manager.get_unread_messages(recipient)))
+        cases.append((f'messaging.get_unread_page[{size} msgs]',
+                      lambda recipient=recipient: messaging_manager.get_unread_page(recipient)))
+
+    # Bulk read of the largest inbox's newest messages (already-read messages decrypt the same way)
+    bulk_ids = [message._id for message in messaging_manager.get_unread_page(f'inbox{INBOX_SIZES[-1]}',
+                                                                             BULK_READ_SIZE)[0]]
+    cases.append((f'messaging.read_messages_bulk[{BULK_READ_SIZE} msgs]',
+                  lambda: messaging_manager.read_messages_bulk(bulk_ids, KEY)))
+
+    return cases
+
+
+def create_benchmark_backend(name: str) -> StorageBackend:
+    """
+    Creates an empty backend for the suite
+
+    :param name: 'memory' or 'mongo' (a dedicated database, emptied first)
+
+    :return: StorageBackend instance
+    """
+
+    # In-memory backend: always empty
+    if name == 'memory':
+        return InMemoryBackend()
+
+    # MongoDB: dedicated database on the configured server, unshared client
+    settings = load_database_settings()._replace(database_name=BENCHMARK_DATABASE)
+    backend = DatabaseManager(settings, shared=False)
+    backend.client.drop_database(BENCHMARK_DATABASE)
+    backend.ensure_indexes()
+    return backend
+
+
+def run(backend_name: str, name_filter: str, repeats: int, min_time: float) -> List[Measurement]:
+    """
+    Runs every selected case
+
+    :param backend_name: Storage backend for the service cases
+    :param name_filter: Only run cases whose name contains this text
+    :param repeats: Timed runs per case
+    :param min_time: Minimum duration of one run, in seconds
+
+    :return: List of measurements
+    """
+    backend = create_benchmark_backend(backend_name)
+    measurements = []
+
+    try:
+        cases = crypto_cases() + model_cases() + service_cases(backend)
+        for name, function in cases:
+            if name_filter in name:
+                measurements.append(measure(name, function, repeats, min_time))
+
+    # Leave nothing behind on a real server
+    finally:
+        if isinstance(backend, DatabaseManager):
+            backend.client.drop_database(BENCHMARK_DATABASE)
+        backend.close()
+
+    return measurements
+
+
+def main() -> None:
+    """
+    Runs the suite, writes JSON results and compares them against a baseline if given
+
+    :return: None
+    """
+    parser = argparse.ArgumentParser(description='CipherMail benchmark suite')
+    parser.add_argument('--backend', choices=('memory', 'mongo'), default='memory',
+                        help='storage backend for the service cases (default: memory)')
+    parser.add_argument('--output', default='bench_results.json', help="JSON results file ('-' for stdout)")
+    parser.add_argument('--baseline', help='results file to compare against')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                        help='slowdown reported as a regression, as a fraction (default: 0.10)')
+    parser.add_argument('--filter', default='', help='only run cases whose name contains this text')
+    parser.add_argument('--quick', action='store_true', help='fewer, shorter runs (smoke checks, not baselines)')
+    args = parser.parse_args()
+
+    repeats, min_time = (3, 0.05) if args.quick else (5, 0.2)
+    measurements = run(args.backend, args.filter, repeats, min_time)
+    print_measurements(measurements)
+
+    ratios = compression_ratios()
+    print_ratios(ratios)
+
+    results = to_json(measurements, {'backend': args.backend, 'quick': args.quick, **environment()})
+    results['compression'] = ratios
+    save_results(args.output, results)
+
+    # No baseline: done
+    if not args.baseline:
+        return
+
+    comparisons = compare(load_results(args.baseline), results, args.threshold)
+    print_comparisons(comparisons, args.threshold)
+
+    # Any regression: fail, so CI can gate on it
+    if any(comparison.regression for comparison in comparisons):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,14 +3,26 @@ Global application module.
 """
 
 # --- IMPORTS ---
-from ciphermail.interface.cli import MainCLI
+from ciphermail.interface.arguments import build_parser
+
+import sys
 
 
 # --- CODE ---
 def main() -> None:
     """
     Function to run the application.
+    Runs a subcommand or a batch when given, the interactive menu otherwise.
     """
+    args = build_parser().parse_args()
+
+    # Subcommand or batch: run it non-interactively and exit with its status
+    # (each mode imports only what it needs, so the menu comes up without loading the services)
+    if args.command is not None or args.batch:
+        from ciphermail.interface.commands import run_commands
+        sys.exit(run_commands(args))
+
+    from ciphermail.interface.cli import MainCLI
 
     # Initialize CLI context
     app = MainCLI()
@@ -22,9 +34,9 @@ def main() -> None:
     # Keyboard interrupt error: exit and close DB connection
     except KeyboardInterrupt:
         print("\n\nGoodbye!")
-        app.db_manager.close()
+        app.close()
     
     # Other exceptions: print error and close DB connection
     except Exception as e:
         print(f"\nError: {e}")
-        app.db_manager.close()
+        app.close()
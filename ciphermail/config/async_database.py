@@ -0,0 +1,176 @@
+"""
+Asynchronous database configuration and connection management
+"""
+
+# --- IMPORTS ---
+from ciphermail.config.database import INDEX_OPTIONS_CONFLICT
+from ciphermail.config.database import MESSAGE_CHUNKS_INDEXES
+from ciphermail.config.database import MESSAGE_LAYOUT
+from ciphermail.config.database import MESSAGE_LAYOUTS
+from ciphermail.config.database import MESSAGES_INDEXES
+from ciphermail.config.database import READ_MESSAGE_TTL
+from ciphermail.config.database import SESSIONS_INDEXES
+from ciphermail.config.database import USERS_INDEXES
+from ciphermail.config.database import read_ttl_index
+from ciphermail.config.settings import DatabaseSettings
+from ciphermail.config.settings import load_database_settings
+from ciphermail.services.metrics import client_event_listeners
+from pymongo import AsyncMongoClient
+from pymongo.asynchronous.collection import AsyncCollection
+from pymongo.errors import OperationFailure
+from pymongo.errors import PyMongoError
+
+import sys
+
+
+# --- TYPES ---
+from typing import Optional
+
+
+# --- CODE ---
+class AsyncDatabaseManager:
+    """
+    Manages an asyncio MongoDB connection
+    """
+
+    def __init__(self, settings: Optional[DatabaseSettings] = None, layout: Optional[str] = None) -> None:
+        """
+        Initializes the AsyncDatabaseManager with an asyncio MongoDB client
+        The client connects lazily; call ensure_indexes() once the event loop is running
+        Async clients are bound to their event loop, so share the manager rather than the client
+
+        :param settings: Optional DatabaseSettings (loaded from the environment/config file by default)
+        :param layout: Message storage layout (MESSAGE_LAYOUT by default); only 'document' is served on asyncio
+
+        :return: None
+
+        :raises ValueError: If the layout is unknown or is the bucket layout
+        """
+        self.settings = settings or load_database_settings()
+        self.layout = layout or MESSAGE_LAYOUT
+
+        # Unknown layout: refuse before connecting
+        if self.layout not in MESSAGE_LAYOUTS:
+            raise ValueError(f"Unknown message layout '{self.layout}' (expected one of {', '.join(MESSAGE_LAYOUTS)})")
+
+        # Bucket layout: the async services query the messages collection directly, they would see an empty one
+        if self.layout == 'bucket':
+            raise ValueError("The asyncio services do not support the 'bucket' message layout")
+
+        users_collection_name = 'users'
+        messages_collection_name = 'messages'
+        sessions_collection_name = 'sessions'
+        message_chunks_collection_name = 'message_chunks'
+        inbox_summaries_collection_name = 'inbox_summaries'
+
+        # Initialize MongoDB connection
+        self.client = AsyncMongoClient(self.settings.uri, **self.settings.client_options(),
+                                       **client_event_listeners())
+        self.db = self.client[self.settings.database_name]
+        self.users = self.db[users_collection_name]
+        self.messages = self.db[messages_collection_name]
+        self.sessions = self.db[sessions_collection_name]
+        self.message_chunks = self.db[message_chunks_collection_name]
+        self.inbox_summaries = self.db[inbox_summaries_collection_name]
+
+
+    async def ensure_indexes(self) -> bool:
+        """
+        Creates the indexes used by the services (idempotent)
+
+        :return: True if all indexes exist, False otherwise
+        """
+        try:
+
+            # Existing indexes with the same spec are left untouched
+            await self.users.create_indexes(USERS_INDEXES)
+            await self.messages.create_indexes(MESSAGES_INDEXES)
+            await self.sessions.create_indexes(SESSIONS_INDEXES)
+            await self.message_chunks.create_indexes(MESSAGE_CHUNKS_INDEXES)
+
+            # Read message TTL configured: expire read messages and their chunks
+            if READ_MESSAGE_TTL > 0:
+                await self.ensure_read_ttl(self.messages, READ_MESSAGE_TTL)
+                await self.ensure_read_ttl(self.message_chunks, READ_MESSAGE_TTL)
+
+            # Indexes in place
+            return True
+
+        # Errors creating indexes (e.g. duplicate usernames): print and return False
+        except PyMongoError as e:
+            print(f'Error creating indexes: {e}', file=sys.stderr)
+            return False
+
+
+    async def ensure_read_ttl(self, collection: AsyncCollection, ttl: int) -> None:
+        """
+        Creates the read TTL index on a collection, or changes its age if it exists with another one
+
+        :param collection: Messages or message chunks collection
+        :param ttl: Seconds after the first read
+
+        :return: None
+        """
+        try:
+            await collection.create_indexes([read_ttl_index(ttl)])
+
+        # Index exists with another age: change it in place (no rebuild)
+        except OperationFailure as e:
+            if e.code != INDEX_OPTIONS_CONFLICT:
+                raise
+            await self.db.command('collMod', collection.name,
+                                  index={'name': 'read_at_ttl', 'expireAfterSeconds': ttl})
+
+
+    async def close(self) -> None:
+        """
+        Close database connection
+
+        :return: None
+        """
+        await self.client.close()
+
+
+    def get_users_collection(self) -> AsyncCollection:
+        """
+        Returns users collection
+
+        :return: User collection
+        """
+        return self.users
+
+
+    def get_messages_collection(self) -> AsyncCollection:
+        """
+        Returns messages collection
+
+        :return: Message collection
+        """
+        return self.messages
+
+
+    def get_sessions_collection(self) -> AsyncCollection:
+        """
+        Returns sessions collection
+
+        :return: Session collection
+        """
+        return self.sessions
+
+
+    def get_message_chunks_collection(self) -> AsyncCollection:
+        """
+        Returns message chunks collection
+
+        :return: Message chunks collection
+        """
+        return self.message_chunks
+
+
+    def get_inbox_summaries_collection(self) -> AsyncCollection:
+        """
+        Returns inbox summaries collection
+
+        :return: Inbox summaries collection
+        """
+        return self.inbox_summaries
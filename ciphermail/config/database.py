@@ -3,48 +3,281 @@ Database configuration and connection management
 """
 
 # --- IMPORTS ---
-from dotenv import load_dotenv
+from ciphermail.config.settings import DatabaseSettings
+from ciphermail.config.settings import load_database_settings
+from ciphermail.services.metrics import client_event_listeners
+from ciphermail.storage.base import StorageBackend
+from ciphermail.storage.buckets import MongoBucketMessageRepository
+from ciphermail.storage.buckets import bucket_feed_pipeline
+from ciphermail.storage.mongo import MongoMessageFeed
+from ciphermail.storage.mongo import MongoMessageRepository
+from ciphermail.storage.mongo import MongoSessionRepository
+from ciphermail.storage.mongo import MongoSummaryRepository
+from ciphermail.storage.mongo import MongoUserRepository
+from pymongo import ASCENDING
+from pymongo import DESCENDING
+from pymongo import IndexModel
 from pymongo import MongoClient
 from pymongo.collection import Collection
+from pymongo.errors import OperationFailure
+from pymongo.errors import PyMongoError
 
 import os
+import sys
+import threading
+
+
+# --- TYPES ---
+from typing import Dict
+from typing import Optional
 
 
 # --- GLOBALS ---
-# Load environment variables
-load_dotenv()
+# Indexes backing the service queries, per collection
+USERS_INDEXES = [
+    IndexModel([('username', ASCENDING)], name='username_unique', unique=True),
+]
+MESSAGES_INDEXES = [
+    IndexModel([('recipient', ASCENDING), ('read', ASCENDING),
+                ('timestamp', DESCENDING), ('_id', DESCENDING)],
+               name='recipient_read_timestamp_id'),
+    IndexModel([('read_at', ASCENDING), ('_id', ASCENDING)], name='read_at_id'),
+    IndexModel([('recipient', ASCENDING), ('read_changed_at', ASCENDING)], name='recipient_read_changed_at'),
+]
+MESSAGE_CHUNKS_INDEXES = [
+    IndexModel([('message_id', ASCENDING), ('n', ASCENDING)], name='message_id_n_unique', unique=True),
+]
+MESSAGE_BUCKETS_INDEXES = [
+    IndexModel([('recipient', ASCENDING), ('count', ASCENDING)], name='recipient_count'),
+    IndexModel([('recipient', ASCENDING), ('end', DESCENDING), ('start', ASCENDING)],
+               name='recipient_end_start_unread', partialFilterExpression={'unread': {'$gt': 0}}),
+    IndexModel([('messages._id', ASCENDING)], name='messages_id'),
+    IndexModel([('recipient', ASCENDING), ('read_changed_at', ASCENDING)], name='recipient_read_changed_at'),
+]
+SESSIONS_INDEXES = [
+    IndexModel([('expires_at', ASCENDING)], name='expires_at_ttl', expireAfterSeconds=0),
+]
+
+
+# Message storage layout: one document per message, or per-recipient buckets of messages
+MESSAGE_LAYOUTS = ('document', 'bucket')
+MESSAGE_LAYOUT = os.getenv('MESSAGE_LAYOUT', 'document').lower()
+
+# Delete read messages (and their streamed chunks) this many seconds after they were first read (0: keep them)
+# Turning it off again needs the read_at_ttl indexes dropped by hand
+READ_MESSAGE_TTL = int(os.getenv('READ_MESSAGE_TTL', '0'))
+
+# Server error code: an index with the same keys exists with other options
+INDEX_OPTIONS_CONFLICT = 85
+
+
+# Process-wide clients, one per distinct settings, with their reference counts
+_shared_clients: Dict[DatabaseSettings, MongoClient] = {}
+_shared_client_refs: Dict[DatabaseSettings, int] = {}
+_shared_clients_lock = threading.Lock()
+
+# Databases whose indexes were already ensured by this process
+_indexed_databases = set()
 
 
 # --- CODE ---
-class DatabaseManager:
+def acquire_shared_client(settings: DatabaseSettings) -> MongoClient:
+    """
+    Returns the process-wide client for these settings, creating it on first use
+    Every call must be balanced by release_shared_client()
+
+    :param settings: DatabaseSettings instance
+
+    :return: Shared MongoClient
     """
-    Manages MongoDB connection and operations
+    with _shared_clients_lock:
+        client = _shared_clients.get(settings)
+
+        # First user of these settings: open one pool for the whole process
+        if client is None:
+            client = MongoClient(settings.uri, **settings.client_options(), **client_event_listeners())
+            _shared_clients[settings] = client
+            _shared_client_refs[settings] = 0
+
+        _shared_client_refs[settings] += 1
+        return client
+
+
+def read_ttl_index(ttl: int) -> IndexModel:
+    """
+    Builds the TTL index expiring read documents (messages and streamed chunks carry read_at once read)
+
+    :param ttl: Seconds after the first read
+
+    :return: IndexModel
+    """
+    return IndexModel([('read_at', ASCENDING)], name='read_at_ttl', expireAfterSeconds=ttl)
+
+
+def release_shared_client(settings: DatabaseSettings) -> None:
     """
+    Releases one reference to a shared client, closing it when the last user is gone
+
+    :param settings: DatabaseSettings instance
 
-    def __init__(self) -> None:
+    :return: None
+    """
+    with _shared_clients_lock:
+
+        # Unknown or already closed client: nothing to release
+        if settings not in _shared_clients:
+            return
+
+        _shared_client_refs[settings] -= 1
+
+        # Still in use elsewhere: keep the pool open
+        if _shared_client_refs[settings] > 0:
+            return
+
+        # Last user gone: close the pool
+        client = _shared_clients.pop(settings)
+        del _shared_client_refs[settings]
+        _indexed_databases.difference_update((settings.uri, settings.database_name, layout)
+                                             for layout in MESSAGE_LAYOUTS)
+
+    client.close()
+
+
+class DatabaseManager(StorageBackend):
+    """
+    Manages MongoDB connection and operations (the MongoDB storage backend)
+    """
+
+    def __init__(self,
+                 settings: Optional[DatabaseSettings] = None,
+                 shared: bool = True,
+                 layout: Optional[str] = None) -> None:
         """
         Initializes the DatabaseManager with MongoDB connection
-        
+
+        :param settings: Optional DatabaseSettings (loaded from the environment/config file by default)
+        :param shared: Whether to reuse the process-wide client for these settings
+        :param layout: Message storage layout, 'document' or 'bucket' (MESSAGE_LAYOUT by default)
+
         :return: None
+
+        :raises ValueError: If the layout is unknown
         """
-        connection_string = os.getenv('MONGODB_URI')
-        database_name = 'ciphermail_db'
+        self.settings = settings or load_database_settings()
+        self.shared = shared
+        self.layout = layout or MESSAGE_LAYOUT
+
+        # Unknown layout: refuse before connecting
+        if self.layout not in MESSAGE_LAYOUTS:
+            raise ValueError(f"Unknown message layout '{self.layout}' (expected one of {', '.join(MESSAGE_LAYOUTS)})")
+
         users_collection_name = 'users'
         messages_collection_name = 'messages'
+        sessions_collection_name = 'sessions'
+        message_chunks_collection_name = 'message_chunks'
+        inbox_summaries_collection_name = 'inbox_summaries'
+        feed_positions_collection_name = 'feed_positions'
+        message_buckets_collection_name = 'message_buckets'
 
-        # Initialize MongoDB connection
-        self.client = MongoClient(connection_string)
-        self.db = self.client[database_name]
+        # Initialize MongoDB connection (shared pool by default)
+        if shared:
+            self.client = acquire_shared_client(self.settings)
+        else:
+            self.client = MongoClient(self.settings.uri, **self.settings.client_options(), **client_event_listeners())
+
+        self.db = self.client[self.settings.database_name]
         self.users = self.db[users_collection_name]
         self.messages = self.db[messages_collection_name]
+        self.sessions = self.db[sessions_collection_name]
+        self.message_chunks = self.db[message_chunks_collection_name]
+        self.inbox_summaries = self.db[inbox_summaries_collection_name]
+        self.feed_positions = self.db[feed_positions_collection_name]
+        self.message_buckets = self.db[message_buckets_collection_name]
+
+        # Repositories used by the services
+        self.user_repository = MongoUserRepository(self.users)
+        self.session_repository = MongoSessionRepository(self.sessions)
+        self.summary_repository = MongoSummaryRepository(self.inbox_summaries)
+
+        # Bucket layout: messages and their feed live in the buckets collection
+        if self.layout == 'bucket':
+            self.message_repository = MongoBucketMessageRepository(self.message_buckets, self.message_chunks)
+            self.message_feed = MongoMessageFeed(self.message_buckets, self.feed_positions,
+                                                 pipeline=bucket_feed_pipeline,
+                                                 to_message=self.message_repository.change_message)
+        else:
+            self.message_repository = MongoMessageRepository(self.messages, self.message_chunks)
+            self.message_feed = MongoMessageFeed(self.messages, self.feed_positions)
+
+        # Make sure service queries are index-backed (once per database, layout and process)
+        database_key = (self.settings.uri, self.settings.database_name, self.layout)
+        if database_key not in _indexed_databases and self.ensure_indexes():
+            _indexed_databases.add(database_key)
+
+
+    def ensure_indexes(self) -> bool:
+        """
+        Creates the indexes used by the services (idempotent)
+
+        :return: True if all indexes exist, False otherwise
+        """
+        try:
+
+            # Existing indexes with the same spec are left untouched
+            self.users.create_indexes(USERS_INDEXES)
+            self.messages.create_indexes(MESSAGES_INDEXES)
+            self.sessions.create_indexes(SESSIONS_INDEXES)
+            self.message_chunks.create_indexes(MESSAGE_CHUNKS_INDEXES)
+
+            # Bucket layout: index the buckets as well
+            if self.layout == 'bucket':
+                self.message_buckets.create_indexes(MESSAGE_BUCKETS_INDEXES)
+
+            # Read message TTL configured: expire read messages and their chunks
+            if READ_MESSAGE_TTL > 0:
+                self.ensure_read_ttl(self.messages, READ_MESSAGE_TTL)
+                self.ensure_read_ttl(self.message_chunks, READ_MESSAGE_TTL)
+
+            # Indexes in place
+            return True
+
+        # Errors creating indexes (e.g. duplicate usernames): print and return False
+        except PyMongoError as e:
+            print(f'Error creating indexes: {e}', file=sys.stderr)
+            return False
+
+
+    def ensure_read_ttl(self, collection: Collection, ttl: int) -> None:
+        """
+        Creates the read TTL index on a collection, or changes its age if it exists with another one
+
+        :param collection: Messages or message chunks collection
+        :param ttl: Seconds after the first read
+
+        :return: None
+        """
+        try:
+            collection.create_indexes([read_ttl_index(ttl)])
+
+        # Index exists with another age: change it in place (no rebuild)
+        except OperationFailure as e:
+            if e.code != INDEX_OPTIONS_CONFLICT:
+                raise
+            self.db.command('collMod', collection.name, index={'name': 'read_at_ttl', 'expireAfterSeconds': ttl})
 
 
     def close(self) -> None:
         """
-        Close database connection
+        Close database connection (or release this manager's hold on the shared one)
 
         :return: None
         """
+
+        # Shared client: closed only when its last manager releases it
+        if self.shared:
+            release_shared_client(self.settings)
+            return
+
         self.client.close()
 
 
@@ -64,3 +297,58 @@ class DatabaseManager:
         :return: Message collection
         """
         return self.messages
+
+
+    def get_sessions_collection(self) -> Collection:
+        """
+        Returns sessions collection
+
+        :return: Session collection
+        """
+        return self.sessions
+
+
+    def get_user_repository(self) -> MongoUserRepository:
+        """
+        Returns the user repository
+
+        :return: MongoUserRepository on the users collection
+        """
+        return self.user_repository
+
+
+    def get_message_repository(self) -> MongoMessageRepository:
+        """
+        Returns the message repository
+
+        :return: MongoMessageRepository on the messages collection (MongoBucketMessageRepository on the
+                 message_buckets collection with the bucket layout)
+        """
+        return self.message_repository
+
+
+    def get_session_repository(self) -> MongoSessionRepository:
+        """
+        Returns the session repository
+
+        :return: MongoSessionRepository on the sessions collection
+        """
+        return self.session_repository
+
+
+    def get_summary_repository(self) -> MongoSummaryRepository:
+        """
+        Returns the inbox summary repository
+
+        :return: MongoSummaryRepository on the inbox_summaries collection
+        """
+        return self.summary_repository
+
+
+    def get_message_feed(self) -> MongoMessageFeed:
+        """
+        Returns the new-message feed
+
+        :return: MongoMessageFeed on the messages collection (message_buckets with the bucket layout)
+        """
+        return self.message_feed
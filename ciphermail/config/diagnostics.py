@@ -0,0 +1,188 @@
+"""
+Query-plan diagnostics for the service queries
+
+Usage: poetry run python -m ciphermail.config.diagnostics
+"""
+
+# --- IMPORTS ---
+from bson import ObjectId
+from datetime import datetime
+from ciphermail.config.database import DatabaseManager
+from ciphermail.storage.buckets import BUCKET_CAPACITY
+from ciphermail.storage.buckets import BUCKET_MAX_BYTES
+from ciphermail.storage.mongo import HEADER_PROJECTION
+from ciphermail.storage.mongo import INBOX_SORT
+
+import sys
+
+
+# --- TYPES ---
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Tuple
+
+
+# --- GLOBALS ---
+# Placeholder values: plans depend on query shape, not on the values
+SAMPLE_USERNAME = '__diagnostics__'
+
+
+# --- CODE ---
+def service_queries(db_manager: DatabaseManager) -> List[Tuple[str, Callable[[], Dict]]]:
+    """
+    Returns the queries issued by the services, each paired with a callable running explain()
+
+    :param db_manager: DatabaseManager instance
+
+    :return: List of (query name, explain callable) tuples
+    """
+    users = db_manager.get_users_collection()
+    messages = db_manager.get_messages_collection()
+    message_chunks = db_manager.message_chunks
+    inbox_summaries = db_manager.inbox_summaries
+    message_buckets = db_manager.message_buckets
+
+    queries = [
+        ('AuthManager.register / login: users by username',
+         lambda: users.find({'username': SAMPLE_USERNAME}).limit(1).explain()),
+
+        ('MessagingManager.recipient_exists: users by username, _id only',
+         lambda: users.find({'username': SAMPLE_USERNAME}, {'_id': 1}).limit(1).explain()),
+
+        ('MessagingManager.send_bulk: users by username $in',
+         lambda: users.find({'username': {'$in': [SAMPLE_USERNAME, SAMPLE_USERNAME + '2']}},
+                            {'_id': 0, 'username': 1}).explain()),
+
+        ('MessagingManager.get_unread_messages: unread by recipient, newest first',
+         lambda: messages.find({'recipient': SAMPLE_USERNAME, 'read': False})
+                         .sort('timestamp', -1).explain()),
+
+        ('MessagingManager.get_unread_page: unread headers after a keyset position',
+         lambda: messages.find({'recipient': SAMPLE_USERNAME, 'read': False,
+                                '$or': [{'timestamp': {'$lt': datetime.now()}},
+                                        {'timestamp': datetime.now(), '_id': {'$lt': ObjectId()}}]},
+                               HEADER_PROJECTION).sort(INBOX_SORT).limit(21).explain()),
+
+        ('MessagingManager.sync_inbox_cache: IDs of the messages read since the last sync',
+         lambda: messages.find({'recipient': SAMPLE_USERNAME, 'read_changed_at': {'$gte': datetime.now()},
+                                'read': True}, {'_id': 1}).explain()),
+
+        ('MessagingManager.sync_inbox_cache: unread messages sent or marked unread since the last sync',
+         lambda: messages.find({'recipient': SAMPLE_USERNAME, 'read': False,
+                                '$or': [{'timestamp': {'$gte': datetime.now()}},
+                                        {'read_changed_at': {'$gte': datetime.now()}}]}).explain()),
+
+        ('MessagingManager.read_message: message by _id',
+         lambda: messages.find({'_id': None}).limit(1).explain()),
+
+        ('retention.archive_read_messages: read before a cutoff, oldest first',
+         lambda: messages.find({'read_at': {'$lt': datetime.now()}}).sort([('read_at', 1), ('_id', 1)])
+                         .limit(500).explain()),
+
+        ('MessagingManager.get_inbox_summary: summary by recipient',
+         lambda: inbox_summaries.find({'_id': SAMPLE_USERNAME}).limit(1).explain()),
+
+        ('MessagingManager.read_stream: chunks of a message, in order',
+         lambda: message_chunks.find({'message_id': None}, {'_id': 0, 'data': 1}).sort('n', 1).explain()),
+    ]
+
+    # Bucket layout: the message queries run against the buckets
+    if db_manager.layout == 'bucket':
+        queries += [
+            ('MongoBucketMessageRepository.insert: open bucket of a recipient',
+             lambda: message_buckets.find({'recipient': SAMPLE_USERNAME, 'count': {'$lt': BUCKET_CAPACITY},
+                                           'size': {'$lte': BUCKET_MAX_BYTES}}).limit(1).explain()),
+
+            ('MongoBucketMessageRepository.find_unread_page: buckets with unread messages, latest first',
+             lambda: message_buckets.find({'recipient': SAMPLE_USERNAME, 'unread': {'$gt': 0},
+                                           'start': {'$lte': datetime.now()}}).sort('end', -1).explain()),
+
+            ('MongoBucketMessageRepository.find_read_since: buckets with read state changes since the last sync',
+             lambda: message_buckets.find({'recipient': SAMPLE_USERNAME,
+                                           'read_changed_at': {'$gte': datetime.now()}}).explain()),
+
+            ('MongoBucketMessageRepository.find_unread_since: buckets with unread messages changed since the last sync',
+             lambda: message_buckets.find({'recipient': SAMPLE_USERNAME, 'unread': {'$gt': 0},
+                                           '$or': [{'end': {'$gte': datetime.now()}},
+                                                   {'read_changed_at': {'$gte': datetime.now()}}]}).explain()),
+
+            ('MongoBucketMessageRepository.acknowledge / get_encrypted_content: bucket by message _id',
+             lambda: message_buckets.find({'messages._id': None}, {'messages': {'$elemMatch': {'_id': None}}})
+                                    .limit(1).explain()),
+        ]
+
+    return queries
+
+
+def plan_stages(plan: Any) -> List[str]:
+    """
+    Collects every stage name in an explain() plan tree
+
+    :param plan: Plan document (or any nested part of it)
+
+    :return: List of stage names
+    """
+    stages = []
+
+    # Document: record its stage and walk its children
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            stages.append(plan['stage'])
+        for value in plan.values():
+            stages.extend(plan_stages(value))
+
+    # List of child plans: walk each of them
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(plan_stages(value))
+
+    return stages
+
+
+def verify_query_plans(db_manager: DatabaseManager) -> bool:
+    """
+    Explains every service query and reports the ones falling back to COLLSCAN
+
+    :param db_manager: DatabaseManager instance
+
+    :return: True if no query uses a collection scan, False otherwise
+    """
+    all_indexed = True
+
+    for name, explain in service_queries(db_manager):
+
+        # Only the winning plan matters
+        winning_plan = explain().get('queryPlanner', {}).get('winningPlan', {})
+        stages = plan_stages(winning_plan)
+
+        # Collection scan: flag the query
+        if 'COLLSCAN' in stages:
+            all_indexed = False
+            print(f'[FAIL] {name}: {" <- ".join(stages)}')
+            continue
+
+        print(f'[ OK ] {name}: {" <- ".join(stages)}')
+
+    return all_indexed
+
+
+def main() -> None:
+    """
+    Runs the diagnostics and exits non-zero if any query is a collection scan
+
+    :return: None
+    """
+    db_manager = DatabaseManager()
+
+    try:
+        all_indexed = verify_query_plans(db_manager)
+    finally:
+        db_manager.close()
+
+    sys.exit(0 if all_indexed else 1)
+
+
+if __name__ == '__main__':
+    main()
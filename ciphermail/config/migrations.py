@@ -0,0 +1,167 @@
+"""
+Resumable in-place migration of stored message content between base64 text and BSON Binary
+
+Usage: poetry run python -m ciphermail.config.migrations [--to binary|base64] [--batch-size 500]
+                                                         [--pause 0] [--restart]
+
+Messages are walked in _id order, a batch at a time; the last _id handled is saved after every batch,
+so an interrupted run picks up where it stopped. Each update only applies if the content is still the
+value that was read, so messages changed meanwhile are left alone.
+"""
+
+# --- IMPORTS ---
+from datetime import datetime
+from ciphermail.config.database import DatabaseManager
+from ciphermail.models.message import BASE64_FORMAT
+from ciphermail.models.message import BINARY_FORMAT
+from ciphermail.models.message import decode_content
+from ciphermail.models.message import encode_content
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+
+import argparse
+import sys
+import time
+
+
+# --- TYPES ---
+from typing import List
+from typing import Optional
+
+
+# --- GLOBALS ---
+# Collection keeping migration progress, one document per migration
+MIGRATIONS_COLLECTION = 'migrations'
+
+# Messages read and updated per round trip
+DEFAULT_BATCH_SIZE = 500
+
+
+# --- CODE ---
+def conversion(message_data: dict, target: str) -> Optional[UpdateOne]:
+    """
+    Builds the update converting one message to the target format
+
+    :param message_data: Message document (_id, encrypted_content, content_format)
+    :param target: BINARY_FORMAT or BASE64_FORMAT
+
+    :return: UpdateOne, or None if the message is already in the target format (or has no inline content)
+    """
+    value = message_data.get('encrypted_content')
+
+    # Streamed body: nothing stored inline
+    if value is None:
+        return None
+
+    current = BINARY_FORMAT if isinstance(value, bytes) else BASE64_FORMAT
+
+    # Already converted and marked: skip
+    if current == target and message_data.get('content_format') == target:
+        return None
+
+    return UpdateOne(
+        {'_id': message_data['_id'], 'encrypted_content': value},
+        {'$set': {'encrypted_content': encode_content(decode_content(value), target), 'content_format': target}}
+    )
+
+
+def migrate_content_format(db_manager: DatabaseManager,
+                           target: str = BINARY_FORMAT,
+                           batch_size: int = DEFAULT_BATCH_SIZE,
+                           pause: float = 0.0,
+                           restart: bool = False) -> bool:
+    """
+    Converts every message's encrypted content to the target format, in batches
+
+    :param db_manager: DatabaseManager instance
+    :param target: BINARY_FORMAT or BASE64_FORMAT
+    :param batch_size: Messages per batch
+    :param pause: Seconds to sleep between batches (limits the load on a busy server)
+    :param restart: Ignore saved progress and start from the first message
+
+    :return: True if every message was visited, False if the run stopped on an error
+    """
+    messages = db_manager.get_messages_collection()
+    progress = db_manager.db[MIGRATIONS_COLLECTION]
+    migration_id = f'content_format:{target}'
+
+    try:
+        state = None if restart else progress.find_one({'_id': migration_id})
+        last_id = state['last_id'] if state else None
+        converted = state['converted'] if state else 0
+
+        # Resuming: say from where
+        if last_id is not None:
+            print(f'Resuming after {last_id} ({converted} converted so far)')
+
+        while True:
+            query = {} if last_id is None else {'_id': {'$gt': last_id}}
+            batch = list(messages.find(query, {'encrypted_content': 1, 'content_format': 1})
+                                 .sort('_id', 1).limit(batch_size))
+
+            # Nothing left: done
+            if not batch:
+                break
+
+            updates: List[UpdateOne] = [update for update in (conversion(message_data, target)
+                                                              for message_data in batch) if update is not None]
+
+            # Anything to convert in this batch: one unordered round trip
+            if updates:
+                converted += messages.bulk_write(updates, ordered=False).modified_count
+
+            # Save progress so an interrupted run resumes after this batch
+            last_id = batch[-1]['_id']
+            progress.update_one(
+                {'_id': migration_id},
+                {'$set': {'last_id': last_id, 'converted': converted, 'updated_at': datetime.now()}},
+                upsert=True
+            )
+            print(f'{converted} converted, up to {last_id}')
+
+            # Throttle: give the server room between batches
+            if pause:
+                time.sleep(pause)
+
+        print(f'Done: {converted} messages converted to {target}')
+        return True
+
+    # Server errors: print and stop (progress up to the last full batch is kept)
+    except PyMongoError as e:
+        print(f'Error migrating messages: {e}')
+        return False
+
+
+def main() -> None:
+    """
+    Runs the migration and exits non-zero if it stopped on an error (or the bucket layout is configured)
+
+    :return: None
+    """
+    parser = argparse.ArgumentParser(description='Convert stored message content between base64 and BSON Binary')
+    parser.add_argument('--to', choices=(BINARY_FORMAT, BASE64_FORMAT), default=BINARY_FORMAT,
+                        help='target format (default: binary; base64 rolls back)')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help=f'messages per batch (default: {DEFAULT_BATCH_SIZE})')
+    parser.add_argument('--pause', type=float, default=0.0, help='seconds to sleep between batches')
+    parser.add_argument('--restart', action='store_true', help='ignore saved progress and start over')
+    args = parser.parse_args()
+
+    db_manager = DatabaseManager()
+
+    # Bucket layout: message content lives in the buckets collection (the migration works on the messages collection)
+    if db_manager.layout == 'bucket':
+        print('The content format migration only supports the document layout (MESSAGE_LAYOUT=document)')
+        db_manager.close()
+        sys.exit(1)
+
+    try:
+        completed = migrate_content_format(db_manager, args.to, args.batch_size, args.pause, args.restart)
+    finally:
+        db_manager.close()
+
+    sys.exit(0 if completed else 1)
+
+
+if __name__ == '__main__':
+    main()
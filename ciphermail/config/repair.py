@@ -0,0 +1,46 @@
+"""
+Inbox summary repair: recomputes unread counters from the messages with one aggregation
+
+Usage: poetry run python -m ciphermail.config.repair [--recipient username]
+
+Run it once after upgrading (messages sent before summaries existed are not counted yet), and whenever
+counters may have drifted (a summary write failing after its message was stored).
+"""
+
+# --- IMPORTS ---
+from ciphermail.config.database import DatabaseManager
+from ciphermail.services.messaging import MessagingManager
+from pymongo.errors import PyMongoError
+
+import argparse
+import sys
+
+
+# --- CODE ---
+def main() -> None:
+    """
+    Repairs every summary (or one recipient's) and exits non-zero on a database error
+
+    :return: None
+    """
+    parser = argparse.ArgumentParser(description='Recompute inbox summaries from the messages')
+    parser.add_argument('--recipient', help="only repair this user's summary")
+    args = parser.parse_args()
+
+    db_manager = DatabaseManager()
+
+    try:
+        repaired = MessagingManager(db_manager).repair_inbox_summaries(args.recipient)
+        print(f'Repaired {repaired} inbox summaries')
+
+    # Server errors: print and fail
+    except PyMongoError as e:
+        print(f'Error repairing inbox summaries: {e}')
+        sys.exit(1)
+
+    finally:
+        db_manager.close()
+
+
+if __name__ == '__main__':
+    main()
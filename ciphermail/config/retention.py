@@ -0,0 +1,324 @@
+"""
+Retention of read messages: moves the ones read before a cutoff out of the hot messages collection into
+messages_archive (streamed body chunks into message_chunks_archive), optionally appending them to a
+gzip-compressed extended JSON export as well
+
+Usage: poetry run python -m ciphermail.config.retention [--older-than-days 90] [--batch-size 500]
+                                                        [--max-rate 0] [--export archive.jsonl.gz]
+                                                        [--backfill] [--restart]
+
+Messages are moved oldest read first, a batch at a time: copied, then deleted from messages only if still
+read before the cutoff. The cutoff and count are saved after every batch, so an interrupted run resumes with
+the same cutoff; copies already made by an interrupted batch are skipped when it is redone (the export may
+then hold a batch twice). To delete read messages outright instead, set READ_MESSAGE_TTL.
+"""
+
+# --- IMPORTS ---
+from bson import json_util
+from datetime import datetime
+from datetime import timedelta
+from ciphermail.config.database import DatabaseManager
+from ciphermail.config.migrations import MIGRATIONS_COLLECTION
+from pymongo import ASCENDING
+from pymongo import DESCENDING
+from pymongo import IndexModel
+from pymongo.collection import Collection
+from pymongo.errors import BulkWriteError
+from pymongo.errors import PyMongoError
+
+import argparse
+import gzip
+import os
+import sys
+import time
+
+
+# --- TYPES ---
+from typing import IO
+from typing import Iterable
+from typing import List
+from typing import Optional
+
+
+# --- GLOBALS ---
+# Archive tier collections
+ARCHIVE_COLLECTION = 'messages_archive'
+CHUNKS_ARCHIVE_COLLECTION = 'message_chunks_archive'
+
+# Indexes of the archive tier (lookups by recipient, chunks in order)
+ARCHIVE_INDEXES = [
+    IndexModel([('recipient', ASCENDING), ('timestamp', DESCENDING)], name='recipient_timestamp'),
+]
+CHUNKS_ARCHIVE_INDEXES = [
+    IndexModel([('message_id', ASCENDING), ('n', ASCENDING)], name='message_id_n_unique', unique=True),
+]
+
+# Age after the first read at which messages are archived (days)
+READ_MESSAGE_RETENTION_DAYS = float(os.getenv('READ_MESSAGE_RETENTION_DAYS', '90'))
+
+# Messages moved per batch, and streamed body chunks copied per round trip
+DEFAULT_BATCH_SIZE = 500
+CHUNK_COPY_BATCH = 8
+
+# Progress document of the archiver
+RETENTION_ID = 'retention:archive'
+
+# Server error code: document with this _id already exists
+DUPLICATE_KEY = 11000
+
+
+# --- CODE ---
+def copy_documents(target: Collection, documents: List[dict]) -> None:
+    """
+    Inserts documents into an archive collection, skipping the ones already there (redone batches)
+
+    :param target: Archive collection
+    :param documents: Documents to copy (with their _id)
+
+    :return: None
+
+    :raises BulkWriteError: If a document could not be written for another reason
+    """
+
+    # Nothing to copy
+    if not documents:
+        return
+
+    try:
+        target.insert_many(documents, ordered=False)
+
+    # Already archived by an interrupted run: fine; anything else: stop
+    except BulkWriteError as e:
+        if any(error['code'] != DUPLICATE_KEY for error in e.details.get('writeErrors', [])):
+            raise
+
+
+def export_documents(export: IO[str], kind: str, documents: Iterable[dict]) -> None:
+    """
+    Appends documents to the export, one canonical extended JSON line each ({kind: document})
+
+    :param export: Text stream of the open export file
+    :param kind: 'message' or 'chunk'
+    :param documents: Documents to write
+
+    :return: None
+    """
+    for document in documents:
+        export.write(json_util.dumps({kind: document}, json_options=json_util.CANONICAL_JSON_OPTIONS) + '\n')
+
+
+def move_chunks(db_manager: DatabaseManager, message_ids: List, export: Optional[IO[str]]) -> None:
+    """
+    Copies the chunks of streamed bodies to the archive (and export), a few at a time whatever the body size
+
+    :param db_manager: DatabaseManager instance
+    :param message_ids: IDs of the streamed messages being archived
+    :param export: Text stream of the open export file, or None
+
+    :return: None
+    """
+    chunks_archive = db_manager.db[CHUNKS_ARCHIVE_COLLECTION]
+    batch = []
+
+    for chunk in db_manager.message_chunks.find({'message_id': {'$in': message_ids}}, batch_size=CHUNK_COPY_BATCH):
+        batch.append(chunk)
+
+        # Batch full: write it out and start the next one
+        if len(batch) == CHUNK_COPY_BATCH:
+            if export is not None:
+                export_documents(export, 'chunk', batch)
+            copy_documents(chunks_archive, batch)
+            batch = []
+
+    # Remainder
+    if export is not None:
+        export_documents(export, 'chunk', batch)
+    copy_documents(chunks_archive, batch)
+
+
+def archive_batch(db_manager: DatabaseManager, batch: List[dict], cutoff: datetime, export: Optional[IO[str]]) -> int:
+    """
+    Moves one batch of messages (and their streamed chunks) to the archive tier
+
+    :param db_manager: DatabaseManager instance
+    :param batch: Full message documents read before the cutoff
+    :param cutoff: Messages first read before this time are moved
+    :param export: Text stream of the open export file, or None
+
+    :return: Number of messages removed from the messages collection
+    """
+    messages = db_manager.get_messages_collection()
+    message_ids = [message_data['_id'] for message_data in batch]
+    streamed_ids = [message_data['_id'] for message_data in batch if message_data.get('stream') is not None]
+
+    # Copy first: a message is never deleted before its archived copy exists
+    if export is not None:
+        export_documents(export, 'message', batch)
+        export.flush()
+    copy_documents(db_manager.db[ARCHIVE_COLLECTION], batch)
+    if streamed_ids:
+        move_chunks(db_manager, streamed_ids, export)
+
+    # Delete only what is still read before the cutoff
+    deleted = messages.delete_many({'_id': {'$in': message_ids}, 'read_at': {'$lt': cutoff}}).deleted_count
+
+    # Streamed bodies: drop the chunks of the messages that were deleted
+    if streamed_ids:
+        kept = {message_data['_id'] for message_data in messages.find({'_id': {'$in': streamed_ids}}, {'_id': 1})}
+        db_manager.message_chunks.delete_many({'message_id': {'$in': [message_id for message_id in streamed_ids
+                                                                     if message_id not in kept]}})
+
+    return deleted
+
+
+def backfill_read_at(db_manager: DatabaseManager, batch_size: int = DEFAULT_BATCH_SIZE) -> int:
+    """
+    Dates read messages stored before read_at existed with their send time (their first read is unknown)
+
+    :param db_manager: DatabaseManager instance
+    :param batch_size: Messages updated per round trip
+
+    :return: Number of messages dated
+    """
+    messages = db_manager.get_messages_collection()
+    query = {'read': True, 'read_at': {'$exists': False}}
+    last_id = None
+    dated = 0
+
+    while True:
+        page_query = query if last_id is None else {**query, '_id': {'$gt': last_id}}
+        message_ids = [message_data['_id'] for message_data in messages.find(page_query, {'_id': 1})
+                                                                        .sort('_id', 1).limit(batch_size)]
+
+        # Nothing left: done
+        if not message_ids:
+            return dated
+
+        dated += messages.update_many({'_id': {'$in': message_ids}, **query},
+                                      [{'$set': {'read_at': '$timestamp'}}]).modified_count
+        last_id = message_ids[-1]
+
+
+def archive_read_messages(db_manager: DatabaseManager,
+                          older_than_days: float = READ_MESSAGE_RETENTION_DAYS,
+                          batch_size: int = DEFAULT_BATCH_SIZE,
+                          max_rate: float = 0.0,
+                          export_path: Optional[str] = None,
+                          restart: bool = False) -> bool:
+    """
+    Moves every message read before the cutoff to the archive tier, in rate-limited batches
+
+    :param db_manager: DatabaseManager instance
+    :param older_than_days: Messages first read more than this many days ago are moved
+    :param batch_size: Messages per batch
+    :param max_rate: Maximum messages moved per second, on average (0: no limit)
+    :param export_path: Gzip file the moved documents are also appended to (None: no export)
+    :param restart: Ignore a saved run and start over with a new cutoff
+
+    :return: True if every message before the cutoff was moved, False if the run stopped early
+    """
+    messages = db_manager.get_messages_collection()
+    progress = db_manager.db[MIGRATIONS_COLLECTION]
+    export = gzip.open(export_path, 'at', encoding='utf-8') if export_path else None
+
+    try:
+        db_manager.db[ARCHIVE_COLLECTION].create_indexes(ARCHIVE_INDEXES)
+        db_manager.db[CHUNKS_ARCHIVE_COLLECTION].create_indexes(CHUNKS_ARCHIVE_INDEXES)
+
+        state = None if restart else progress.find_one({'_id': RETENTION_ID})
+        cutoff = state['cutoff'] if state else datetime.now() - timedelta(days=older_than_days)
+        archived = state['archived'] if state else 0
+
+        # Resuming: keep the interrupted run's cutoff
+        if state:
+            print(f'Resuming the run with cutoff {cutoff} ({archived} archived so far)')
+
+        while True:
+            started = time.monotonic()
+            batch = list(messages.find({'read_at': {'$lt': cutoff}}).sort([('read_at', 1), ('_id', 1)])
+                                 .limit(batch_size))
+
+            # Nothing left: done
+            if not batch:
+                break
+
+            moved = archive_batch(db_manager, batch, cutoff, export)
+
+            # Nothing could be removed: stop rather than fetch the same batch forever
+            if not moved:
+                print('No message of the batch could be removed, stopping')
+                return False
+
+            # Save progress so an interrupted run resumes with the same cutoff
+            archived += moved
+            progress.update_one(
+                {'_id': RETENTION_ID},
+                {'$set': {'cutoff': cutoff, 'archived': archived, 'updated_at': datetime.now()}},
+                upsert=True
+            )
+            print(f'{archived} archived, read up to {batch[-1]["read_at"]}')
+
+            # Rate limit: spread the batches so the average stays under max_rate
+            if max_rate > 0:
+                time.sleep(max(len(batch) / max_rate - (time.monotonic() - started), 0))
+
+        # Run complete: the next one starts with a fresh cutoff
+        progress.delete_one({'_id': RETENTION_ID})
+        print(f'Done: {archived} messages read before {cutoff} archived')
+        return True
+
+    # Server errors: print and stop (progress up to the last full batch is kept)
+    except PyMongoError as e:
+        print(f'Error archiving messages: {e}')
+        return False
+
+    # Always close the export, so it stays a valid gzip file
+    finally:
+        if export is not None:
+            export.close()
+
+
+def main() -> None:
+    """
+    Runs the archiver and exits non-zero if it stopped early
+
+    :return: None
+    """
+    parser = argparse.ArgumentParser(description='Move read messages to the archive tier')
+    parser.add_argument('--older-than-days', type=float, default=READ_MESSAGE_RETENTION_DAYS,
+                        help=f'archive messages first read more than this many days ago '
+                             f'(default: {READ_MESSAGE_RETENTION_DAYS:g})')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help=f'messages per batch (default: {DEFAULT_BATCH_SIZE})')
+    parser.add_argument('--max-rate', type=float, default=0.0,
+                        help='maximum messages moved per second (default: no limit)')
+    parser.add_argument('--export', help='also append the moved documents to this gzip file (extended JSON lines)')
+    parser.add_argument('--backfill', action='store_true',
+                        help='first date read messages stored before read_at existed with their send time')
+    parser.add_argument('--restart', action='store_true', help='ignore an interrupted run and start over')
+    args = parser.parse_args()
+
+    db_manager = DatabaseManager()
+
+    # Bucket layout: read messages stay in their buckets (the archiver works on the messages collection)
+    if db_manager.layout == 'bucket':
+        print('The archiver only supports the document layout (MESSAGE_LAYOUT=document)')
+        db_manager.close()
+        sys.exit(1)
+
+    try:
+
+        # Backfill requested: older read messages become eligible too
+        if args.backfill:
+            print(f'{backfill_read_at(db_manager, args.batch_size)} read messages dated')
+
+        completed = archive_read_messages(db_manager, args.older_than_days, args.batch_size, args.max_rate,
+                                          args.export, args.restart)
+    finally:
+        db_manager.close()
+
+    sys.exit(0 if completed else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+"""
+Database settings loaded from the environment or a TOML file
+"""
+
+# --- IMPORTS ---
+from dotenv import load_dotenv
+
+import importlib.util
+import os
+import tomllib
+
+
+# --- TYPES ---
+from typing import Any
+from typing import Dict
+from typing import NamedTuple
+from typing import Optional
+from typing import Tuple
+
+
+# --- GLOBALS ---
+# Load environment variables
+load_dotenv()
+
+# Wire compressors that can be enabled (none by default), with the module each one needs (None for built-in)
+COMPRESSOR_MODULES = {
+    'zstd': 'zstandard',
+    'snappy': 'snappy',
+    'zlib': None,
+}
+
+# Environment variable -> (settings field, parser)
+ENVIRONMENT_FIELDS = {
+    'MONGODB_URI': ('uri', str),
+    'MONGODB_DATABASE': ('database_name', str),
+    'MONGODB_MIN_POOL_SIZE': ('min_pool_size', int),
+    'MONGODB_MAX_POOL_SIZE': ('max_pool_size', int),
+    'MONGODB_MAX_IDLE_TIME_MS': ('max_idle_time_ms', int),
+    'MONGODB_CONNECT_TIMEOUT_MS': ('connect_timeout_ms', int),
+    'MONGODB_SERVER_SELECTION_TIMEOUT_MS': ('server_selection_timeout_ms', int),
+    'MONGODB_SOCKET_TIMEOUT_MS': ('socket_timeout_ms', int),
+    'MONGODB_COMPRESSORS': ('compressors', lambda value: tuple(c.strip() for c in value.split(',') if c.strip())),
+    'MONGODB_ZLIB_LEVEL': ('zlib_level', int),
+    'MONGODB_READ_CONCERN': ('read_concern', str),
+    'MONGODB_WRITE_CONCERN': ('write_concern', lambda value: int(value) if value.isdigit() else value),
+    'MONGODB_WRITE_TIMEOUT_MS': ('write_timeout_ms', int),
+    'MONGODB_APP_NAME': ('app_name', str),
+}
+
+
+# --- CODE ---
+class DatabaseSettings(NamedTuple):
+    """
+    MongoDB connection settings (immutable, so they can key the shared client registry)
+    """
+    uri: Optional[str] = None
+    database_name: str = 'ciphermail_db'
+    min_pool_size: int = 0
+    max_pool_size: int = 100
+    max_idle_time_ms: Optional[int] = None
+    connect_timeout_ms: int = 20000
+    server_selection_timeout_ms: int = 30000
+    socket_timeout_ms: Optional[int] = None
+    compressors: Tuple[str, ...] = ()
+    zlib_level: int = -1
+    read_concern: Optional[str] = None
+    write_concern: Optional[Any] = None
+    write_timeout_ms: Optional[int] = None
+    app_name: str = 'ciphermail'
+
+
+    def available_compressors(self) -> Tuple[str, ...]:
+        """
+        Returns the configured compressors whose optional modules are installed
+
+        :return: Tuple of compressor names, in order of preference
+        """
+        available = []
+
+        for compressor in self.compressors:
+
+            # Unknown compressor: skip it
+            if compressor not in COMPRESSOR_MODULES:
+                continue
+
+            # Needs a module that is not installed: skip it
+            module = COMPRESSOR_MODULES[compressor]
+            if module is not None and importlib.util.find_spec(module) is None:
+                continue
+
+            available.append(compressor)
+
+        return tuple(available)
+
+
+    def client_options(self) -> Dict[str, Any]:
+        """
+        Builds keyword arguments for MongoClient / AsyncMongoClient
+
+        :return: Dictionary of client options
+        """
+        options = {
+            'minPoolSize': self.min_pool_size,
+            'maxPoolSize': self.max_pool_size,
+            'connectTimeoutMS': self.connect_timeout_ms,
+            'serverSelectionTimeoutMS': self.server_selection_timeout_ms,
+            'appname': self.app_name,
+        }
+
+        # Optional settings: only pass what was configured, driver defaults otherwise
+        if self.max_idle_time_ms is not None:
+            options['maxIdleTimeMS'] = self.max_idle_time_ms
+        if self.socket_timeout_ms is not None:
+            options['socketTimeoutMS'] = self.socket_timeout_ms
+        if self.read_concern is not None:
+            options['readConcernLevel'] = self.read_concern
+        if self.write_concern is not None:
+            options['w'] = self.write_concern
+        if self.write_timeout_ms is not None:
+            options['wTimeoutMS'] = self.write_timeout_ms
+
+        # Wire compression: only compressors the driver can actually use
+        compressors = self.available_compressors()
+        if compressors:
+            options['compressors'] = ','.join(compressors)
+            if 'zlib' in compressors:
+                options['zlibCompressionLevel'] = self.zlib_level
+
+        return options
+
+
+def load_database_settings(path: Optional[str] = None) -> DatabaseSettings:
+    """
+    Loads database settings from a TOML file and the environment
+    Values from the environment override the file; missing values keep their defaults
+
+    :param path: Optional TOML file with a [database] table (defaults to $CIPHERMAIL_CONFIG)
+
+    :return: DatabaseSettings instance
+    """
+    values: Dict[str, Any] = {}
+    path = path or os.getenv('CIPHERMAIL_CONFIG')
+
+    # Config file given: read its [database] table
+    if path:
+        with open(path, 'rb') as config_file:
+            file_values = tomllib.load(config_file).get('database', {})
+
+        for field, value in file_values.items():
+
+            # Unknown key: reject it rather than silently ignoring a typo
+            if field not in DatabaseSettings._fields:
+                raise ValueError(f'Unknown database setting: {field}')
+
+            values[field] = tuple(value) if isinstance(value, list) else value
+
+    # Environment variables take precedence
+    for variable, (field, parse) in ENVIRONMENT_FIELDS.items():
+        value = os.getenv(variable)
+        if value:
+            values[field] = parse(value)
+
+    return DatabaseSettings(**values)
@@ -0,0 +1,76 @@
+"""
+Command line arguments
+Kept free of service and database imports, so the interactive menu starts without loading them
+"""
+
+# --- IMPORTS ---
+import argparse
+import os
+
+
+# --- GLOBALS ---
+# Default number of headers listed by the inbox command
+INBOX_LIMIT = 20
+
+
+# --- CODE ---
+def positive_int(text: str) -> int:
+    """
+    Parses a strictly positive integer argument
+
+    :param text: Argument text
+
+    :return: Integer value
+
+    :raises argparse.ArgumentTypeError: If the text is not an integer of at least 1
+    """
+    try:
+        value = int(text)
+
+    # Not a number: report it like argparse does
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid int value: {text!r}')
+
+    # Zero or negative: no page could hold a message
+    if value < 1:
+        raise argparse.ArgumentTypeError(f'must be at least 1, got {value}')
+
+    return value
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """
+    Builds the command line parser (no subcommand and no --batch starts the interactive menu)
+
+    :return: ArgumentParser instance
+    """
+    parser = argparse.ArgumentParser(prog='ciphermail', description='CipherMail encrypted messaging')
+    parser.add_argument('--username', default=os.getenv('CIPHERMAIL_USERNAME'),
+                        help='acting user (default: $CIPHERMAIL_USERNAME)')
+    parser.add_argument('--password-fd', type=int, help='read the password from this file descriptor '
+                                                        '(default: $CIPHERMAIL_PASSWORD)')
+    parser.add_argument('--key-fd', type=int, help='read the encryption key from this file descriptor '
+                                                   '(default: $CIPHERMAIL_KEY)')
+    parser.add_argument('--batch', action='store_true',
+                        help='read JSONL operations from stdin and write JSONL results to stdout')
+    subparsers = parser.add_subparsers(dest='command')
+
+    subparsers.add_parser('register', help='create the account given by --username and the password')
+
+    send_parser = subparsers.add_parser('send', help='send an encrypted message')
+    send_parser.add_argument('recipient', help='recipient username')
+    send_parser.add_argument('message', nargs='?', help='message text (default: read from stdin)')
+
+    inbox_parser = subparsers.add_parser('inbox', help='list unread message headers, newest first')
+    inbox_parser.add_argument('--limit', type=positive_int, default=INBOX_LIMIT, help=f'headers per page '
+                                                                              f'(default: {INBOX_LIMIT})')
+    inbox_parser.add_argument('--page-token', help='continuation token printed with the previous page')
+
+    read_parser = subparsers.add_parser('read', help='decrypt messages and mark them read')
+    read_parser.add_argument('message_ids', nargs='+', help='message IDs (from inbox)')
+
+    watch_parser = subparsers.add_parser('watch', help='print new message headers as they arrive, until interrupted')
+    watch_parser.add_argument('--name', help='subscriber name: save the position and resume after it next time')
+    watch_parser.add_argument('--timeout', type=float, help='stop after this many seconds without a new message')
+
+    return parser
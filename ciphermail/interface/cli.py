@@ -5,29 +5,60 @@ CLI Application
 # --- IMPORTS ---
 from colorama import Fore
 from colorama import Style
-from ciphermail.config.database import DatabaseManager
-from ciphermail.services.auth import AuthManager
-from ciphermail.services.messaging import MessagingManager
-from ciphermail.models.user import User
 from ciphermail.interface.ui import UI
 
 import getpass
+import os
+import threading
+
+
+# --- TYPES ---
+from typing import TYPE_CHECKING
+from typing import List
+from typing import Optional
+
+# Services, models and database drivers are imported on first use (see MainCLI.connect)
+if TYPE_CHECKING:
+    from ciphermail.models.message import Message
+    from ciphermail.models.user import User
+    from ciphermail.services.auth import AuthManager
+    from ciphermail.services.messaging import InboxSubscription
+    from ciphermail.services.messaging import MessagingManager
+    from ciphermail.storage.base import StorageBackend
+
+
+# --- GLOBALS ---
+# Number of message headers shown per inbox page
+INBOX_PAGE_SIZE = 10
+
+# Import the services and connect in the background while the first menu is shown
+STARTUP_WARMUP = os.getenv('CIPHERMAIL_WARMUP', 'false').lower() in ('1', 'true', 'yes')
 
 
 # --- CODE ---
 class MainCLI:
     """
     Main CLI application
+    The first menu needs neither the database nor crypto: both are loaded on first use (or warmed up
+    in the background), so the banner and prompt appear without waiting for imports or a connection
     """
 
     def __init__(self):
         """
-        Initializes the CLI application
+        Initializes the CLI application (without connecting)
         """
-        self.db_manager = DatabaseManager()
-        self.auth_manager = AuthManager(self.db_manager)
-        self.messaging_manager = MessagingManager(self.db_manager)
-        self.current_user: User = None
+        self.current_user: Optional['User'] = None
+        self.session_token: Optional[str] = None
+
+        # Live feed of the logged-in user's new messages (see start_inbox_watch)
+        self.inbox_subscription: Optional['InboxSubscription'] = None
+
+        # Set by connect()
+        self._db_manager: Optional['StorageBackend'] = None
+        self._auth_manager: Optional['AuthManager'] = None
+        self._messaging_manager: Optional['MessagingManager'] = None
+        self.metrics_writer = None
+        self.connect_lock = threading.Lock()
 
         # Auth menu options
         self.auth_menu_options = {
@@ -44,6 +75,95 @@ class MainCLI:
         }
 
 
+    def connect(self) -> None:
+        """
+        Imports the services and connects to the storage backend, once
+
+        :return: None
+        """
+
+        # Already connected: no lock needed
+        if self._db_manager is not None:
+            return
+
+        with self.connect_lock:
+
+            # Connected while waiting for the lock (first use and warm-up raced)
+            if self._db_manager is not None:
+                return
+
+            from ciphermail.services.auth import AuthManager
+            from ciphermail.services.inbox_cache import open_inbox_cache
+            from ciphermail.services.messaging import MessagingManager
+            from ciphermail.services.metrics import start_metrics_file_writer
+            from ciphermail.services.sessions import SessionManager
+            from ciphermail.storage.factory import create_backend
+
+            db_manager = create_backend()
+            session_manager = SessionManager(db_manager)
+            self._auth_manager = AuthManager(db_manager, session_manager=session_manager)
+            self._messaging_manager = MessagingManager(db_manager, session_manager=session_manager,
+                                                       inbox_cache=open_inbox_cache())
+
+            # Periodic metrics snapshots (only when metrics and a metrics file are configured)
+            self.metrics_writer = start_metrics_file_writer()
+
+            # Published last: its presence means everything above is ready
+            self._db_manager = db_manager
+
+
+    def warm_up(self) -> threading.Thread:
+        """
+        Connects in a background thread, so the first login does not wait for it
+
+        :return: Started daemon thread
+        """
+        def connect_quietly() -> None:
+
+            # Failures are left for the first real use to report, instead of printing over the menu
+            try:
+                self.connect()
+            except Exception:
+                pass
+
+        thread = threading.Thread(target=connect_quietly, name='ciphermail-warmup', daemon=True)
+        thread.start()
+        return thread
+
+
+    @property
+    def db_manager(self) -> 'StorageBackend':
+        """
+        Returns the storage backend, connecting on first use
+
+        :return: StorageBackend instance
+        """
+        self.connect()
+        return self._db_manager
+
+
+    @property
+    def auth_manager(self) -> 'AuthManager':
+        """
+        Returns the authentication service, connecting on first use
+
+        :return: AuthManager instance
+        """
+        self.connect()
+        return self._auth_manager
+
+
+    @property
+    def messaging_manager(self) -> 'MessagingManager':
+        """
+        Returns the messaging service, connecting on first use
+
+        :return: MessagingManager instance
+        """
+        self.connect()
+        return self._messaging_manager
+
+
     def run(self) -> None:
         """
         Main application loop
@@ -55,6 +175,10 @@ class MainCLI:
         UI.clear_screen()
         UI.print_banner()
 
+        # Warm-up enabled: connect while the user reads the menu
+        if STARTUP_WARMUP:
+            self.warm_up()
+
         # Main loop
         while True:
 
@@ -95,6 +219,78 @@ class MainCLI:
         action()
 
 
+    def close(self) -> None:
+        """
+        Writes the last metrics snapshot, closes the inbox cache and the DB connection
+
+        :return: None
+        """
+
+        with self.connect_lock:
+
+            # Never connected: nothing to close
+            if self._db_manager is None:
+                return
+
+            # Metrics file configured: flush the final numbers
+            if self.metrics_writer is not None:
+                self.metrics_writer.stop()
+
+            # Local inbox cache configured: close its file
+            if self._messaging_manager.inbox_cache is not None:
+                self._messaging_manager.inbox_cache.close()
+
+            self._db_manager.close()
+
+
+    def start_inbox_watch(self) -> None:
+        """
+        Subscribes to the logged-in user's new messages and announces each one as it arrives,
+        from a background thread, instead of waiting for the inbox to be opened again
+
+        :return: None
+        """
+        try:
+            subscription = self.messaging_manager.subscribe(self.session_token)
+
+        # Feed unavailable: the menus work without live notices
+        except Exception:
+            return
+
+        self.inbox_subscription = subscription
+
+        def announce() -> None:
+
+            # Errors (e.g. connection lost) only end the notices
+            try:
+                for message in subscription:
+                    UI.print_info(f'New message from @{message.sender}')
+            except Exception:
+                pass
+
+        threading.Thread(target=announce, name='ciphermail-inbox-watch', daemon=True).start()
+
+
+    def stop_inbox_watch(self) -> None:
+        """
+        Stops announcing new messages
+
+        :return: None
+        """
+
+        # Not watching: nothing to stop
+        if self.inbox_subscription is None:
+            return
+
+        subscription, self.inbox_subscription = self.inbox_subscription, None
+
+        # Errors closing (e.g. connection lost): nothing left to stop
+        try:
+            subscription.close()
+        except Exception:
+            pass
+
+
     def exit_app(self) -> None:
         """
         Exits the application
@@ -104,8 +300,9 @@ class MainCLI:
         # Print goodbye message
         UI.print_goodbye()
 
-        # Close DB connection
-        self.db_manager.close()
+        # Stop new message notices and close DB connection
+        self.stop_inbox_watch()
+        self.close()
 
         # Exit program
         exit(0)
@@ -127,21 +324,25 @@ class MainCLI:
         # Get password (hidden input)
         password = getpass.getpass(f'\033[93m▶ Password: \033[37m')
 
-        # Attempt login
-        user = self.auth_manager.login(username, password)
+        # Attempt login and open a session
+        session_token = self.auth_manager.create_session(username, password)
 
         # Invalid credentials: show error and exit
-        if user is None:
+        if session_token is None:
             UI.print_error('Access denied! Invalid credentials.')
             return
 
-        # Set current user
-        self.current_user = user
+        # Set current session and user
+        self.session_token = session_token
+        self.current_user = self.auth_manager.authenticate(session_token)
 
         # Show success message
         UI.clear_screen()
         UI.print_success(f'Access granted! Welcome, @{username}!')
 
+        # Announce new messages as they arrive
+        self.start_inbox_watch()
+
 
     def register(self) -> None:
         """
@@ -178,8 +379,17 @@ class MainCLI:
         :return: None
         """
 
-        # Display main menu
-        UI.print_user_status(self.current_user.username)
+        # Session expired: back to the auth menu
+        if self.auth_manager.authenticate(self.session_token) is None:
+            UI.print_warning('Session expired! Please login again.')
+            self.stop_inbox_watch()
+            self.session_token = None
+            self.current_user = None
+            return
+
+        # Display main menu, with the unread badge from the inbox summary (one key lookup)
+        summary = self.messaging_manager.get_inbox_summary(self.current_user)
+        UI.print_user_status(self.current_user.username, summary.unread)
         UI.print_menu_option('1', 'Send encrypted message', '📨')
         UI.print_menu_option('2', 'Read my messages', '📬')
         UI.print_menu_option('3', 'Logout', '🚪')
@@ -224,7 +434,7 @@ class MainCLI:
         encryption_key = getpass.getpass(f'\033[93m▶ Encryption key: \033[37m')
 
         # Send the message
-        send_message_result = self.messaging_manager.send_message(self.current_user.username,
+        send_message_result = self.messaging_manager.send_message(self.session_token,
                                                                   recipient,
                                                                   content,
                                                                   encryption_key)
@@ -241,37 +451,82 @@ class MainCLI:
 
     def read_messages(self) -> None:
         """
-        Handles reading messages
+        Handles reading messages, one inbox page at a time
 
         :return: None
         """
 
-        # Clear screen and display messages header
-        UI.clear_screen()
-        UI.print_section('YOUR ENCRYPTED MESSAGES')
+        # Continuation tokens of the pages seen so far (None is the first page)
+        page_tokens = [None]
 
-        # Get unread messages for current user
-        messages = self.messaging_manager.get_unread_messages(self.current_user.username)
+        while True:
 
-        # No messages: show info and exit
-        if not messages:
-            UI.print_info('No new messages. Your inbox is empty.')
-            return
+            # Clear screen and display messages header
+            UI.clear_screen()
+            UI.print_section(f'YOUR ENCRYPTED MESSAGES (PAGE {len(page_tokens)})')
 
-        # Display messages
-        for idx, msg in enumerate(messages, 1):
-            UI.print_menu_option(
-                str(idx),
-                f'From: @{msg.sender} | {msg.timestamp.strftime("%Y-%m-%d %H:%M:%S")}',
-                '🔒'
+            # Get current page of unread message headers
+            messages, next_token = self.messaging_manager.get_unread_page(
+                self.session_token,
+                INBOX_PAGE_SIZE,
+                page_tokens[-1]
             )
 
+            # No messages: show info and exit
+            if not messages:
+                UI.print_info('No new messages. Your inbox is empty.')
+                return
+
+            # Display messages
+            for idx, msg in enumerate(messages, 1):
+                UI.print_menu_option(
+                    str(idx),
+                    f'From: @{msg.sender} | {msg.timestamp.strftime("%Y-%m-%d %H:%M:%S")}',
+                    '🔒'
+                )
+
+            # Build navigation hint for this page
+            navigation = []
+            if next_token is not None:
+                navigation.append('n: next page')
+            if len(page_tokens) > 1:
+                navigation.append('p: previous page')
+            navigation.append('0 to cancel')
+
+            # Get user choice
+            choice = UI.get_input(f'\nSelect message number to read ({", ".join(navigation)}): ').lower()
+
+            # Next page requested: move forward
+            if choice == 'n' and next_token is not None:
+                page_tokens.append(next_token)
+                continue
+
+            # Previous page requested: move back
+            if choice == 'p' and len(page_tokens) > 1:
+                page_tokens.pop()
+                continue
+
+            # Message chosen (or cancelled): open it and leave the inbox
+            self.open_message(messages, choice)
+            return
+
+
+    def open_message(self, messages: List['Message'], choice: str) -> None:
+        """
+        Decrypts and displays the message chosen from an inbox page
+
+        :param messages: Messages of the current inbox page
+        :param choice: User input selecting the message
+
+        :return: None
+        """
+
         # Choose message to read
         try:
 
-            # Get user choice
-            choice = int(UI.get_input('\nSelect message number to read (0 to cancel): '))
-            
+            # Parse user choice
+            choice = int(choice)
+
             # Choice 0: cancel and return
             if choice == 0:
                 UI.clear_screen()
@@ -329,5 +584,11 @@ class MainCLI:
         UI.clear_screen()
         UI.print_goodbye(self.current_user.username)
 
-        # Clear current user
+        # Stop new message notices, close the session and clear current user
+        self.stop_inbox_watch()
+        self.auth_manager.end_session(self.session_token)
+        self.session_token = None
         self.current_user = None
+
+        # Drop cached ciphers derived from this session's keys
+        self.messaging_manager.encryption_manager.clear_cache()
@@ -0,0 +1,439 @@
+"""
+Non-interactive subcommands and JSONL batch mode
+
+Usage: python -m ciphermail.main register|send|inbox|read|watch ... | --batch
+
+Credentials never go on the command line (it is visible to other users through ps):
+- password: CIPHERMAIL_PASSWORD, or the first line read from --password-fd
+- encryption key: CIPHERMAIL_KEY, or the first line read from --key-fd
+- username: --username or CIPHERMAIL_USERNAME
+
+Every command prints one JSON object per result line; the exit status is 0 if everything succeeded.
+"""
+
+# --- IMPORTS ---
+from bson import ObjectId
+from bson.errors import InvalidId
+from ciphermail.interface.arguments import INBOX_LIMIT
+from ciphermail.models.message import Message
+from ciphermail.models.user import User
+from ciphermail.services.auth import AuthManager
+from ciphermail.services.inbox_cache import open_inbox_cache
+from ciphermail.services.messaging import MessagingManager
+from ciphermail.services.metrics import start_metrics_file_writer
+from ciphermail.storage.base import StorageBackend
+from ciphermail.storage.factory import create_backend
+
+import argparse
+import json
+import os
+import sys
+
+
+# --- TYPES ---
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import TextIO
+
+
+# --- GLOBALS ---
+# How often watch wakes up without new messages (lets Ctrl+C through)
+WATCH_POLL_INTERVAL = 1.0
+
+# Marks an operand without a default (it must be present)
+REQUIRED = object()
+
+
+# --- CODE ---
+def message_header(message: Message) -> dict:
+    """
+    Describes a message without its content, as listed by inbox and watch
+
+    :param message: Message object
+
+    :return: Dictionary with the id, sender and timestamp
+    """
+    return {'id': str(message._id), 'from': message.sender, 'timestamp': message.timestamp.isoformat()}
+
+
+def operand(operation: dict, name: str, kind: type = str, default: Any = REQUIRED) -> Any:
+    """
+    Returns an operand of a batch operation, checking its type
+
+    :param operation: Operation arguments
+    :param name: Operand name
+    :param kind: Expected type
+    :param default: Value when the operand is absent (REQUIRED: it must be present)
+
+    :return: Operand value (or the default)
+
+    :raises KeyError: If a required operand is missing
+    :raises ValueError: If the operand has another type
+    """
+
+    # Absent: default, if it has one
+    if name not in operation and default is not REQUIRED:
+        return default
+
+    value = operation[name]
+
+    # Wrong type (booleans are not integers here): refuse
+    if not isinstance(value, kind) or (kind is int and isinstance(value, bool)):
+        raise ValueError(f"Field '{name}' must be {'a string' if kind is str else 'an integer'}")
+
+    return value
+
+
+def read_secret(env_name: str, fd: Optional[int]) -> Optional[str]:
+    """
+    Reads a secret from a file descriptor (first line) or, failing that, from the environment
+
+    :param env_name: Environment variable holding the secret
+    :param fd: Open file descriptor to read from, or None
+
+    :return: Secret, or None if not provided
+    """
+
+    # File descriptor given: it wins over the environment
+    if fd is not None:
+        with os.fdopen(fd, 'r') as stream:
+            return stream.readline().rstrip('\r\n')
+
+    return os.getenv(env_name)
+
+
+class CommandRunner:
+    """
+    Runs non-interactive operations for one user over a single backend connection
+    Logs in at most once (password hashing is the expensive part) and reuses the session for every operation
+    """
+
+    def __init__(self,
+                 db_manager: StorageBackend,
+                 username: Optional[str],
+                 password: Optional[str],
+                 encryption_key: Optional[str]) -> None:
+        """
+        Initializes the runner
+
+        :param db_manager: StorageBackend instance
+        :param username: Acting user's username
+        :param password: Acting user's password
+        :param encryption_key: Default encryption key for send and read
+
+        :return: None
+        """
+        self.auth_manager = AuthManager(db_manager)
+        self.messaging_manager = MessagingManager(db_manager, inbox_cache=open_inbox_cache())
+        self.username = username
+        self.password = password
+        self.encryption_key = encryption_key
+        self.user: Optional[User] = None
+
+        # Operation name -> handler taking the operation's arguments
+        self.operations: Dict[str, Callable[[dict], dict]] = {
+            'register': self.register,
+            'send': self.send,
+            'inbox': self.inbox,
+            'read': self.read,
+        }
+
+
+    def current_user(self) -> User:
+        """
+        Returns the logged-in user, logging in on first use
+
+        :return: User object
+
+        :raises PermissionError: If credentials are missing or wrong
+        """
+
+        # Already logged in: reuse
+        if self.user is not None:
+            return self.user
+
+        # Missing credentials: refuse before touching the database
+        if not self.username or self.password is None:
+            raise PermissionError('Username and password required')
+
+        self.user = self.auth_manager.login(self.username, self.password)
+
+        # Wrong credentials: refuse
+        if self.user is None:
+            raise PermissionError('Invalid credentials')
+
+        return self.user
+
+
+    def key(self, operation: dict) -> str:
+        """
+        Returns the encryption key for an operation (its own 'key', or the default one)
+
+        :param operation: Operation arguments
+
+        :return: Encryption key
+
+        :raises ValueError: If no key is available
+        """
+        encryption_key = operand(operation, 'key', default=self.encryption_key)
+
+        # No key anywhere: refuse
+        if not encryption_key:
+            raise ValueError('Encryption key required')
+
+        return encryption_key
+
+
+    def register(self, operation: dict) -> dict:
+        """
+        Registers a user ('username'/'password' in the operation, or the runner's credentials)
+
+        :param operation: Operation arguments
+
+        :return: Result dictionary
+        """
+        username = operand(operation, 'username', default=self.username)
+        password = operand(operation, 'password', default=self.password)
+
+        # Missing credentials: refuse
+        if not username or not password:
+            raise ValueError('Username and password required')
+
+        # Username taken (or database error)
+        if not self.auth_manager.register(username, password):
+            return {'ok': False, 'error': 'Registration failed'}
+
+        return {'ok': True, 'username': username}
+
+
+    def send(self, operation: dict) -> dict:
+        """
+        Sends a message ('to', 'message', optional 'key')
+
+        :param operation: Operation arguments
+
+        :return: Result dictionary
+        """
+        recipient = operand(operation, 'to').lstrip('@')
+        sent = self.messaging_manager.send_message(self.current_user(), recipient, operand(operation, 'message'),
+                                                   self.key(operation))
+
+        # Unknown recipient or database error
+        if not sent:
+            return {'ok': False, 'error': 'Failed to send message'}
+
+        return {'ok': True, 'to': recipient}
+
+
+    def inbox(self, operation: dict) -> dict:
+        """
+        Lists one page of unread message headers (optional 'limit', 'page_token')
+
+        :param operation: Operation arguments
+
+        :return: Result dictionary with the headers and the next page token
+        """
+        limit = operand(operation, 'limit', int, INBOX_LIMIT)
+
+        # Empty or negative page: refuse before logging in
+        if limit < 1:
+            raise ValueError("Field 'limit' must be at least 1")
+
+        messages, next_token = self.messaging_manager.get_unread_page(self.current_user(), limit,
+                                                                      operand(operation, 'page_token', default=None))
+        return {
+            'ok': True,
+            'messages': [message_header(message) for message in messages],
+            'next_page_token': next_token
+        }
+
+
+    def read(self, operation: dict) -> dict:
+        """
+        Decrypts one message addressed to the user and marks it read ('id', optional 'key')
+
+        :param operation: Operation arguments
+
+        :return: Result dictionary with the plain text
+        """
+        message_id = ObjectId(operand(operation, 'id'))
+        content = self.messaging_manager.read_message(message_id, self.key(operation), self.current_user())
+
+        # Not found, not ours, or wrong key: same answer for all three
+        if content is None:
+            return {'ok': False, 'id': str(message_id), 'error': 'Message not found or decryption failed'}
+
+        return {'ok': True, 'id': str(message_id), 'message': content}
+
+
+    def run(self, operation: dict) -> dict:
+        """
+        Runs one operation, turning bad input and refused credentials into error results
+
+        :param operation: Dictionary with an 'op' name and its arguments
+
+        :return: Result dictionary (always has 'ok')
+        """
+        handler = self.operations.get(operation.get('op'))
+
+        # Unknown operation: report it
+        if handler is None:
+            return {'ok': False, 'error': f'Unknown operation: {operation.get("op")}'}
+
+        try:
+            return handler(operation)
+
+        # Missing or mistyped fields, bad IDs/tokens, no key, bad credentials: report and carry on
+        except (KeyError, TypeError, ValueError, InvalidId, PermissionError) as e:
+            return {'ok': False, 'error': str(e) if not isinstance(e, KeyError) else f'Missing field: {e}'}
+
+        # Anything else (e.g. the database): report it on this line, the next operations still run
+        except Exception as e:
+            return {'ok': False, 'error': f'{type(e).__name__}: {e}'}
+
+
+def run_batch(runner: CommandRunner, source: TextIO, output: TextIO) -> bool:
+    """
+    Runs JSONL operations from a stream, writing one JSONL result per operation as it completes
+    A client-chosen 'ref' in an operation is echoed in its result
+
+    :param runner: CommandRunner to run the operations with
+    :param source: Text stream of JSON operations, one per line
+    :param output: Text stream receiving the results
+
+    :return: True if every operation succeeded, False otherwise
+    """
+    all_ok = True
+
+    for line in source:
+
+        # Blank line: skip
+        if not line.strip():
+            continue
+
+        try:
+            operation = json.loads(line)
+            result = runner.run(operation) if isinstance(operation, dict) else {'ok': False,
+                                                                                 'error': 'Expected an object'}
+
+        # Not JSON: report it and carry on
+        except json.JSONDecodeError as e:
+            operation, result = {}, {'ok': False, 'error': f'Invalid JSON: {e}'}
+
+        # Correlation reference: echo it
+        if isinstance(operation, dict) and 'ref' in operation:
+            result = {'ref': operation['ref'], **result}
+
+        all_ok = all_ok and result['ok']
+        output.write(json.dumps(result) + '\n')
+        output.flush()
+
+    return all_ok
+
+
+def watch_inbox(runner: CommandRunner, name: Optional[str], idle_timeout: Optional[float], output: TextIO) -> bool:
+    """
+    Writes one JSONL line per new message as it arrives, after a first line telling whether the watch resumed
+    (when it did not, messages that came before it are only found with the inbox command)
+
+    :param runner: CommandRunner holding the credentials
+    :param name: Subscriber name to save the position under and resume from (None: from now, nothing saved)
+    :param idle_timeout: Stop after this many seconds without a new message (None: until interrupted)
+    :param output: Text stream receiving the lines
+
+    :return: True if the watch ran, False if it could not start
+    """
+    try:
+        subscription = runner.messaging_manager.subscribe(runner.current_user(), name)
+
+    # Bad credentials: report and stop
+    except PermissionError as e:
+        output.write(json.dumps({'ok': False, 'error': str(e)}) + '\n')
+        return False
+
+    with subscription:
+        output.write(json.dumps({'ok': True, 'resumed': subscription.resumed}) + '\n')
+        output.flush()
+
+        try:
+            while True:
+                message = subscription.poll(idle_timeout if idle_timeout is not None else WATCH_POLL_INTERVAL)
+
+                # Quiet for the whole idle timeout: done
+                if message is None and idle_timeout is not None:
+                    return True
+
+                # New message: one line, right away
+                if message is not None:
+                    output.write(json.dumps({'ok': True, **message_header(message)}) + '\n')
+                    output.flush()
+
+        # Interrupted: a normal way to stop watching (the position is saved on the way out)
+        except KeyboardInterrupt:
+            return True
+
+
+def command_operations(args: argparse.Namespace) -> List[dict]:
+    """
+    Translates parsed subcommand arguments into runner operations
+
+    :param args: Parsed arguments
+
+    :return: List of operations
+    """
+
+    # Send: message from the argument, or the whole of stdin
+    if args.command == 'send':
+        message = args.message if args.message is not None else sys.stdin.read()
+        return [{'op': 'send', 'to': args.recipient, 'message': message}]
+
+    # Inbox: one page
+    if args.command == 'inbox':
+        return [{'op': 'inbox', 'limit': args.limit, 'page_token': args.page_token}]
+
+    # Read: one operation per message
+    if args.command == 'read':
+        return [{'op': 'read', 'id': message_id} for message_id in args.message_ids]
+
+    return [{'op': 'register'}]
+
+
+def run_commands(args: argparse.Namespace) -> int:
+    """
+    Runs a subcommand or a batch over one connection
+
+    :param args: Parsed arguments (a subcommand or --batch)
+
+    :return: Exit status (0 if every operation succeeded, 1 otherwise)
+    """
+    db_manager = create_backend()
+    metrics_writer = start_metrics_file_writer()
+
+    try:
+        runner = CommandRunner(db_manager,
+                               args.username,
+                               read_secret('CIPHERMAIL_PASSWORD', args.password_fd),
+                               read_secret('CIPHERMAIL_KEY', args.key_fd))
+
+        # Batch: operations from stdin
+        if args.batch:
+            return 0 if run_batch(runner, sys.stdin, sys.stdout) else 1
+
+        # Watch: stream new messages until interrupted (or idle for --timeout)
+        if args.command == 'watch':
+            return 0 if watch_inbox(runner, args.name, args.timeout, sys.stdout) else 1
+
+        results = [runner.run(operation) for operation in command_operations(args)]
+        for result in results:
+            print(json.dumps(result))
+
+        return 0 if all(result['ok'] for result in results) else 1
+
+    # Always flush metrics and release the connection
+    finally:
+        if metrics_writer is not None:
+            metrics_writer.stop()
+        db_manager.close()
@@ -152,14 +152,18 @@ class UI:
 
 
     @staticmethod
-    def print_user_status(username: str) -> None:
+    def print_user_status(username: str, unread: int = 0) -> None:
         """
         Prints logged in user status
 
+        :param username: Logged in user's username
+        :param unread: Number of unread messages (shown as a badge when non-zero)
+
         :return: None
         """
+        badge = f' {Fore.CYAN}📬 {unread} unread' if unread else ''
         print(f'\n{Fore.MAGENTA}{'━' * 70}')
-        print(f'{Fore.YELLOW}⚡ LOGGED IN AS:{Fore.GREEN} @{username} {Fore.YELLOW}⚡')
+        print(f'{Fore.YELLOW}⚡ LOGGED IN AS:{Fore.GREEN} @{username} {Fore.YELLOW}⚡{badge}')
         print(f'{Fore.MAGENTA}{'━' * 70}{Style.RESET_ALL}')
 
 
@@ -3,45 +3,145 @@ Models for Message
 """
 
 # --- IMPORTS ---
+from bson import Binary
 from datetime import datetime
 
+import base64
+import os
+
 
 # --- TYPES ---
 from bson import ObjectId
+from typing import Any
+from typing import Callable
 from typing import Optional
+from typing import Union
+
+
+# --- GLOBALS ---
+# Storage format of encrypted_content for new messages:
+# 'binary' (raw token bytes as BSON Binary) or 'base64' (the token text, as written by older versions)
+CONTENT_FORMAT = os.getenv('MESSAGE_CONTENT_FORMAT', 'binary').lower()
+
+# Values of the content_format marker (documents without one are 'base64')
+BINARY_FORMAT = 'binary'
+BASE64_FORMAT = 'base64'
 
 
 # --- CODE ---
+def encode_content(token: str, content_format: str = CONTENT_FORMAT) -> Union[str, Binary]:
+    """
+    Converts a Fernet token to its stored form
+
+    :param token: Fernet token (URL-safe base64 text)
+    :param content_format: BINARY_FORMAT or BASE64_FORMAT
+
+    :return: Binary holding the raw token bytes, or the token itself
+    """
+    return Binary(base64.urlsafe_b64decode(token)) if content_format == BINARY_FORMAT else token
+
+
+def decode_content(value: Any) -> Optional[str]:
+    """
+    Converts stored encrypted content back to a Fernet token, whatever its format
+
+    :param value: Stored value (Binary/bytes, token text, or None)
+
+    :return: Fernet token, or None
+    """
+
+    # Binary format: back to the base64 text Fernet expects
+    if isinstance(value, bytes):
+        return base64.urlsafe_b64encode(value).decode()
+
+    return value
+
+
 class Message:
     """
     Represents a message in the system
+    Uses __slots__ and loads the encrypted content only when it is first accessed
+    Large bodies are streamed: encrypted_content is then None and stream describes the stored chunks
+    The token is stored as BSON Binary or as base64 text (content_format marker); both are read back
     """
 
+    __slots__ = ('sender', 'recipient', 'timestamp', 'read', '_id', '_encrypted_content', '_loader', 'stream',
+                 'compression')
+
+
     def __init__(self,
                  sender: str,
                  recipient: str,
-                 encrypted_content: str,
+                 encrypted_content: Optional[str],
                  timestamp: Optional[datetime] = None,
                  read: bool = False,
-                 _id: Optional[ObjectId] = None) -> None:
+                 _id: Optional[ObjectId] = None,
+                 loader: Optional[Callable[[ObjectId], Optional[str]]] = None,
+                 stream: Optional[dict] = None,
+                 compression: Optional[str] = None) -> None:
         """
         Initializes a Message object
 
         :param sender: Sender's username
         :param recipient: Recipient's username
-        :param encrypted_content: Encrypted message content
+        :param encrypted_content: Encrypted message content (None when not loaded)
         :param timestamp: Timestamp of the message
         :param read: Read status of the message
         :param _id: Optional MongoDB document ID
+        :param loader: Optional callable fetching the encrypted content by _id on first access
+        :param stream: Chunked body description (nonce, chunk_size, chunks) for streamed messages
+        :param compression: Algorithm the plain text was compressed with before encryption (None if not)
 
         :return: None
         """
         self.sender = sender
         self.recipient = recipient
-        self.encrypted_content = encrypted_content
         self.timestamp = timestamp or datetime.now()
         self.read = read
         self._id = _id
+        self._encrypted_content = encrypted_content
+        self._loader = loader
+        self.stream = stream
+        self.compression = compression
+
+
+    @property
+    def encrypted_content(self) -> Optional[str]:
+        """
+        Returns the encrypted content, fetching it through the loader if not loaded yet
+
+        :return: Encrypted message content, or None if unavailable
+        """
+
+        # Not loaded but fetchable (streamed bodies have no inline content): load it once
+        if self._encrypted_content is None and self._loader is not None and self._id is not None \
+                and self.stream is None:
+            self._encrypted_content = self._loader(self._id)
+            self._loader = None
+
+        return self._encrypted_content
+
+
+    @encrypted_content.setter
+    def encrypted_content(self, value: Optional[str]) -> None:
+        """
+        Sets the encrypted content
+
+        :param value: Encrypted message content
+
+        :return: None
+        """
+        self._encrypted_content = value
+
+
+    @property
+    def is_loaded(self) -> bool:
+        """
+        Tells whether the encrypted content is already in memory
+
+        :return: True if loaded, False otherwise
+        """
+        return self._encrypted_content is not None
 
 
     def to_dict(self) -> dict:
@@ -51,15 +151,30 @@ class Message:
         :return: Dictionary representation of the message
         """
 
+        encrypted_content = self.encrypted_content
+
         # Convert message to dictionary
         message_dict = {
             'sender': self.sender,
             'recipient': self.recipient,
-            'encrypted_content': self.encrypted_content,
+            'encrypted_content': encrypted_content,
             'timestamp': self.timestamp,
             'read': self.read
         }
 
+        # Inline content: store it in the configured format and say which one
+        if encrypted_content is not None:
+            message_dict['encrypted_content'] = encode_content(encrypted_content)
+            message_dict['content_format'] = BINARY_FORMAT if CONTENT_FORMAT == BINARY_FORMAT else BASE64_FORMAT
+
+        # Streamed body: describe its chunks
+        if self.stream is not None:
+            message_dict['stream'] = self.stream
+
+        # Compressed before encryption: record the algorithm (absent means uncompressed)
+        if self.compression is not None:
+            message_dict['compression'] = self.compression
+
         # _id field present: add it to the dictionary
         if self._id is not None:
             message_dict['_id'] = self._id
@@ -69,19 +184,24 @@ class Message:
 
 
     @staticmethod
-    def from_dict(data: dict) -> 'Message':
+    def from_dict(data: dict, loader: Optional[Callable[[ObjectId], Optional[str]]] = None) -> 'Message':
         """
         Creates Message object from dictionary
-        
-        :param data: Dictionary containing message data
+
+        :param data: Dictionary containing message data (encrypted_content may be projected out, and be
+                     Binary or base64 text)
+        :param loader: Optional callable fetching the encrypted content by _id on first access
 
         :return: Message object
         """
         return Message(
             sender=data['sender'],
             recipient=data['recipient'],
-            encrypted_content=data['encrypted_content'],
+            encrypted_content=decode_content(data.get('encrypted_content')),
             timestamp=data['timestamp'],
             read=data.get('read', False),
-            _id=data.get('_id')
+            _id=data.get('_id'),
+            loader=loader,
+            stream=data.get('stream'),
+            compression=data.get('compression')
         )
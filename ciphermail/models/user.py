@@ -13,12 +13,15 @@ class User:
     Represents a user in the system
     """
 
-    def __init__(self, username: str, password: str, _id: Optional[ObjectId] = None) -> None:
+    __slots__ = ('username', 'password', '_id')
+
+
+    def __init__(self, username: str, password: Optional[str], _id: Optional[ObjectId] = None) -> None:
         """
         Initializes a User object
 
         :param username: Username of the user
-        :param password: Password of the user
+        :param password: Password hash of the user (None for session users)
         :param _id: Optional MongoDB document ID
 
         :return: None
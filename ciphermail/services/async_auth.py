@@ -0,0 +1,122 @@
+"""
+Asynchronous Authentication and Registration Service
+"""
+
+# --- IMPORTS ---
+from ciphermail.config.async_database import AsyncDatabaseManager
+from ciphermail.models.user import User
+from ciphermail.services.messaging import MessagingManager
+from ciphermail.services.passwords import PasswordHasher
+from ciphermail.services.passwords import get_password_hasher
+from ciphermail.services.sessions import is_session_token
+from pymongo.errors import DuplicateKeyError
+
+
+# --- TYPES ---
+from typing import Optional
+
+
+# --- CODE ---
+class AsyncAuthManager:
+    """
+    Handles user authentication and registration on asyncio
+    """
+
+    def __init__(self, db_manager: AsyncDatabaseManager, password_hasher: Optional[PasswordHasher] = None) -> None:
+        """
+        Initializes the AsyncAuthManager with an async database manager
+
+        :param db_manager: AsyncDatabaseManager instance
+        :param password_hasher: Optional PasswordHasher (process-wide hasher by default)
+
+        :return: None
+        """
+        self.db_manager = db_manager
+        self.users_collection = db_manager.get_users_collection()
+        self.password_hasher = password_hasher or get_password_hasher()
+
+
+    async def upgrade_password_hash(self, user_data: dict, password: str) -> None:
+        """
+        Re-hashes a verified password when its stored hash uses an outdated KDF or cost
+
+        :param user_data: User document as loaded at login
+        :param password: Verified plain text password
+
+        :return: None
+        """
+
+        # Hash is current: nothing to do
+        if not self.password_hasher.needs_rehash(user_data['password']):
+            return
+
+        new_hash = await self.password_hasher.hash_async(password)
+
+        # Only replace the hash we verified, in case it changed meanwhile
+        await self.users_collection.update_one(
+            {'_id': user_data['_id'], 'password': user_data['password']},
+            {'$set': {'password': new_hash}}
+        )
+        user_data['password'] = new_hash
+
+
+    async def register(self, username: str, password: str) -> bool:
+        """
+        Registers a new user
+
+        :param username: Desired username
+        :param password: Desired password
+
+        :return: True if registration is successful, False if username exists or is reserved
+        """
+
+        # Username shaped like a session token: reserved
+        if is_session_token(username):
+            return False
+
+        # User already exists: return False
+        if await self.users_collection.find_one({'username': username}, {'_id': 1}):
+            return False
+
+        # Create new user, hashing on the worker pool
+        user = User(username, await self.password_hasher.hash_async(password))
+
+        # Insert user into database (taken meanwhile by a concurrent registration: return False)
+        try:
+            await self.users_collection.insert_one(user.to_dict())
+        except DuplicateKeyError:
+            return False
+
+        # Drop any cached "no such recipient" answer for this username
+        MessagingManager.invalidate_recipient(username)
+
+        # Registration successful
+        return True
+
+
+    async def login(self, username: str, password: str) -> Optional[User]:
+        """
+        Authenticates user
+
+        :param username: Username
+        :param password: Password
+
+        :return: User object if authentication is successful, None otherwise
+        """
+
+        # Find user in database (hashes are salted, so match on username only)
+        user_data = await self.users_collection.find_one({'username': username})
+
+        # Not found user: return None
+        if user_data is None:
+            return None
+
+        # Wrong password: return None
+        if not await self.password_hasher.verify_async(password, user_data['password']):
+            return None
+
+        # Legacy SHA256 or outdated cost: upgrade now that the password is known
+        await self.upgrade_password_hash(user_data, password)
+
+        # Return User object
+        return User.from_dict(user_data)
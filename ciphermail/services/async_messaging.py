@@ -0,0 +1,492 @@
+"""
+Asynchronous messaging service
+"""
+
+# --- IMPORTS ---
+from bson import ObjectId
+from datetime import datetime
+from ciphermail.config.async_database import AsyncDatabaseManager
+from ciphermail.models.message import Message
+from ciphermail.models.message import decode_content
+from ciphermail.services.encryption import EncryptionManager
+from ciphermail.services.encryption import run_in_crypto_pool
+from ciphermail.services.messaging import cache_recipient
+from ciphermail.services.messaging import cached_recipient
+from ciphermail.services.messaging import InboxSummary
+from ciphermail.services.messaging import check_page_size
+from ciphermail.services.messaging import decode_continuation_token
+from ciphermail.services.messaging import fold_unread_counts
+from ciphermail.services.messaging import split_page
+from ciphermail.storage.base import SummaryChange
+from ciphermail.storage.mongo import CHUNK_READ_BATCH
+from ciphermail.storage.mongo import CONTENT_PROJECTION
+from ciphermail.storage.mongo import HEADER_PROJECTION
+from ciphermail.storage.mongo import INBOX_SORT
+from ciphermail.storage.mongo import acknowledge_update
+from ciphermail.storage.mongo import change_stream_token
+from ciphermail.storage.mongo import inbox_feed_pipeline
+from ciphermail.storage.mongo import mark_unread_update
+from ciphermail.storage.mongo import stale_summaries_query
+from ciphermail.storage.mongo import summary_from_document
+from ciphermail.storage.mongo import summary_replacements
+from ciphermail.storage.mongo import summary_update
+from ciphermail.storage.mongo import unread_counts_pipeline
+from ciphermail.storage.mongo import unread_page_query
+from pymongo import ReturnDocument
+from pymongo import UpdateOne
+
+import io
+import sys
+
+
+# --- TYPES ---
+from typing import Any
+from typing import AsyncIterator
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+
+# --- CODE ---
+class AsyncMessagingManager:
+    """
+    Handles message operations on asyncio
+    Shares models, encryption, query shapes and the recipient cache with MessagingManager
+    """
+
+    def __init__(self, db_manager: AsyncDatabaseManager) -> None:
+        """
+        Initializes the AsyncMessagingManager with an async database manager
+
+        :param db_manager: AsyncDatabaseManager instance
+
+        :return: None
+        """
+        self.db_manager = db_manager
+        self.messages_collection = db_manager.get_messages_collection()
+        self.chunks_collection = db_manager.get_message_chunks_collection()
+        self.summaries_collection = db_manager.get_inbox_summaries_collection()
+        self.encryption_manager = EncryptionManager()
+
+
+    async def recipient_exists(self, recipient: str) -> bool:
+        """
+        Checks whether a recipient exists, using the known-recipient cache first
+
+        :param recipient: Recipient's username
+
+        :return: True if the user exists, False otherwise
+        """
+        exists = cached_recipient(recipient)
+
+        # Cache hit (positive or negative): no round trip
+        if exists is not None:
+            return exists
+
+        # Cache miss: only the _id is needed to prove existence
+        users_collection = self.db_manager.get_users_collection()
+        exists = await users_collection.find_one({'username': recipient}, {'_id': 1}) is not None
+
+        # Remember the answer for later sends
+        cache_recipient(recipient, exists)
+        return exists
+
+
+    async def send_message(self, sender: str, recipient: str, content: str, encryption_key: str) -> bool:
+        """
+        Sends an encrypted message
+
+        :param sender: Sender's username
+        :param recipient: Recipient's username
+        :param content: Message content
+        :param encryption_key: Key to encrypt the message
+
+        :return: True if sent successfully, False otherwise
+        """
+        try:
+
+            # Verify recipient exists
+            if not await self.recipient_exists(recipient):
+                return False
+
+            # Compress (when enabled) and encrypt content off the event loop
+            encrypted_content, compression = await run_in_crypto_pool(self.encryption_manager.encrypt_compressed,
+                                                                      content,
+                                                                      encryption_key)
+
+            # Create message object
+            message = Message(
+                sender=sender,
+                recipient=recipient,
+                encrypted_content=encrypted_content,
+                timestamp=datetime.now(),
+                read=False,
+                compression=compression
+            )
+
+            # Store message in database
+            await self.messages_collection.insert_one(message.to_dict())
+
+            # Count it in the recipient's inbox summary
+            await self.update_summaries([SummaryChange(recipient, sender, 1, message.timestamp)])
+
+            # Return success
+            return True
+
+        # Errors during encryption or database operations: print and return False
+        except Exception as e:
+            print(f'Error sending message: {e}', file=sys.stderr)
+            return False
+
+
+    async def get_unread_messages(self, username: str) -> List[Message]:
+        """
+        Gets all unread messages for a user
+
+        :param username: Recipient's username
+
+        :return: List of unread Message objects
+        """
+
+        # Query unread messages
+        cursor = self.messages_collection.find({
+            'recipient': username,
+            'read': False
+        }).sort('timestamp', -1)
+
+        # Return list of Message objects
+        return [Message.from_dict(msg) async for msg in cursor]
+
+
+    async def get_unread_page(self,
+                              username: str,
+                              page_size: int = 20,
+                              continuation_token: Optional[str] = None) -> Tuple[List[Message], Optional[str]]:
+        """
+        Gets one page of unread message headers for a user, newest first
+
+        :param username: Recipient's username
+        :param page_size: Maximum number of messages in the page
+        :param continuation_token: Token returned with the previous page (None for the first page)
+
+        :return: Tuple of (Message objects without encrypted content, token for the next page or None)
+
+        :raises ValueError: If page_size is below 1 or the continuation token is malformed
+        """
+        check_page_size(page_size)
+        after = decode_continuation_token(continuation_token) if continuation_token is not None else None
+        query = unread_page_query(username, after)
+
+        # Fetch one extra header to know whether another page exists
+        cursor = self.messages_collection.find(query, HEADER_PROJECTION) \
+                                         .sort(INBOX_SORT) \
+                                         .limit(page_size + 1)
+        messages = [Message.from_dict(msg) async for msg in cursor]
+
+        # Return the page and its continuation token
+        return split_page(messages, page_size)
+
+
+    async def iter_unread_messages(self, username: str, page_size: int = 100) -> AsyncIterator[Message]:
+        """
+        Streams unread message headers for a user, newest first, one page at a time
+
+        :param username: Recipient's username
+        :param page_size: Number of messages fetched per round trip
+
+        :return: Async iterator of Message objects without encrypted content
+
+        :raises ValueError: If page_size is below 1 (when iteration starts)
+        """
+        check_page_size(page_size)
+        continuation_token = None
+
+        while True:
+            messages, continuation_token = await self.get_unread_page(username, page_size, continuation_token)
+            for message in messages:
+                yield message
+
+            # Last page reached: stop
+            if continuation_token is None:
+                return
+
+
+    async def watch_inbox(self, username: str, resume_token: Any = None) -> AsyncIterator[Tuple[Message, dict]]:
+        """
+        Yields a user's new messages as they are stored, from a change stream (needs a replica set)
+        Each comes with its resume token; pass the last one handled to resume after it
+
+        :param username: Recipient's username
+        :param resume_token: Token of the last message already handled (None from now)
+
+        :return: Async iterator of (Message without encrypted content, resume token) tuples
+        """
+        stream = await self.messages_collection.watch(inbox_feed_pipeline(username),
+                                                      resume_after=change_stream_token(resume_token))
+
+        async with stream:
+            async for change in stream:
+                yield Message.from_dict(change['fullDocument']), change['_id']
+
+
+    async def load_encrypted_content(self, message_id: ObjectId) -> Optional[str]:
+        """
+        Fetches only the encrypted content of a message
+
+        :param message_id: ID of the message
+
+        :return: Encrypted content (as a Fernet token, whatever its storage format), or None if not found
+        """
+        message_data = await self.messages_collection.find_one({'_id': message_id},
+                                                               {'_id': 0, 'encrypted_content': 1})
+
+        # Message not found: nothing to load
+        if message_data is None:
+            return None
+
+        return decode_content(message_data.get('encrypted_content'))
+
+
+    async def load_stream_body(self,
+                               message_id: ObjectId,
+                               nonce_prefix: bytes,
+                               encryption_key: str) -> Optional[str]:
+        """
+        Fetches and decrypts the chunks of a streamed body
+        The whole body is returned as text, so it is held in memory (MessagingManager.read_stream avoids that)
+
+        :param message_id: ID of the message
+        :param nonce_prefix: Nonce prefix stored with the body
+        :param encryption_key: Key to decrypt the body
+
+        :return: Decrypted body, or None if decryption fails or the body is incomplete
+        """
+        cursor = self.chunks_collection.find({'message_id': message_id}, {'_id': 0, 'data': 1}) \
+                                       .sort('n', 1) \
+                                       .batch_size(CHUNK_READ_BATCH)
+        chunks = [bytes(chunk['data']) async for chunk in cursor]
+
+        # Verify and decrypt every chunk off the event loop
+        buffer = io.BytesIO()
+        written = await run_in_crypto_pool(self.encryption_manager.decrypt_stream, nonce_prefix, chunks,
+                                           encryption_key, buffer)
+        return buffer.getvalue().decode(errors='replace') if written is not None else None
+
+
+    async def date_chunks(self, message_id: ObjectId, read_at: Optional[datetime]) -> None:
+        """
+        Sets (or clears) the read time on the chunks of a streamed body, so a read TTL expires them with it
+
+        :param message_id: ID of the message
+        :param read_at: Time of the first read (None: unread again)
+
+        :return: None
+        """
+        update = {'$set': {'read_at': read_at}} if read_at is not None else {'$unset': {'read_at': ''}}
+        await self.chunks_collection.update_many({'message_id': message_id}, update)
+
+
+    async def read_message(self, message_id, encryption_key: str, reader: Optional[str] = None) -> Optional[str]:
+        """
+        Reads and decrypts a message, marks it as read
+        Fetches and acknowledges in a single find_one_and_update round trip
+
+        :param message_id: ID of the message to read
+        :param encryption_key: Key to decrypt the message
+        :param reader: Optional username; the message must then be addressed to them
+
+        :return: Decrypted message content, or None if not found/decryption fails
+        """
+        query = {'_id': message_id} if reader is None else {'_id': message_id, 'recipient': reader}
+        now = datetime.now()
+
+        # Fetch and acknowledge in one round trip (document as it was before the update)
+        message_data = await self.messages_collection.find_one_and_update(
+            query,
+            acknowledge_update(now),
+            return_document=ReturnDocument.BEFORE
+        )
+
+        # If message not found, return None
+        if not message_data:
+            return None
+
+        # Convert to Message object
+        message = Message.from_dict(message_data)
+
+        # Streamed body: decrypt its chunks, dated on the first read like the message
+        if message.stream is not None:
+            if not message.read:
+                await self.date_chunks(message_id, now)
+            decrypted_content = await self.load_stream_body(message_id, message.stream['nonce'], encryption_key)
+
+        # Decrypt content off the event loop
+        else:
+            decrypted_content = await run_in_crypto_pool(self.encryption_manager.decrypt,
+                                                         message.encrypted_content,
+                                                         encryption_key,
+                                                         message.compression)
+
+        # Decryption failed on an unread message: undo the acknowledgement (rare, wrong-key path)
+        if decrypted_content is None and not message.read:
+            await self.messages_collection.update_one(
+                {'_id': message_id},
+                mark_unread_update(datetime.now())
+            )
+            if message.stream is not None:
+                await self.date_chunks(message_id, None)
+
+        # Unread message read: one less in the summary (the acknowledgement is atomic, so only one reader counts it)
+        elif not message.read:
+            await self.update_summaries([SummaryChange(message.recipient, message.sender, -1)])
+
+        # Return decrypted content
+        return decrypted_content
+
+
+    async def read_messages_bulk(self,
+                                 message_ids: Iterable[ObjectId],
+                                 encryption_key: str,
+                                 reader: Optional[str] = None) -> Dict[ObjectId, Optional[str]]:
+        """
+        Reads and decrypts a set of messages, marking every successful one as read
+        Uses one find, one batch decryption and one update_many whatever the number of messages
+        (streamed bodies are read one by one through read_message)
+
+        :param message_ids: IDs of the messages to read
+        :param encryption_key: Key to decrypt the messages
+        :param reader: Optional username; only messages addressed to them are read
+
+        :return: Dictionary of message ID to decrypted content (None if not found/decryption fails)
+        """
+        message_ids = list(dict.fromkeys(message_ids))
+        results: Dict[ObjectId, Optional[str]] = dict.fromkeys(message_ids)
+
+        # Nothing to read: empty result
+        if not message_ids:
+            return results
+
+        query = {'_id': {'$in': message_ids}}
+
+        # Reader given: only their own messages (others read as not found)
+        if reader is not None:
+            query['recipient'] = reader
+
+        # Fetch only what decryption and the summary update need
+        messages_data = await self.messages_collection.find(query, CONTENT_PROJECTION).to_list(None)
+
+        # Streamed bodies: no inline ciphertext to batch, read each from its chunks
+        for message_data in messages_data:
+            if message_data.get('stream') is not None:
+                results[message_data['_id']] = await self.read_message(message_data['_id'], encryption_key, reader)
+        messages_data = [message_data for message_data in messages_data if message_data.get('stream') is None]
+
+        # Decrypt the whole set at once, off the event loop
+        decrypted = await run_in_crypto_pool(
+            self.encryption_manager.decrypt_many,
+            [decode_content(message_data['encrypted_content']) for message_data in messages_data],
+            encryption_key,
+            [message_data.get('compression') for message_data in messages_data]
+        )
+
+        # Collect successful decryptions, counting the unread ones per recipient and sender
+        read_ids = []
+        unread_counts: Dict[Tuple[str, str], int] = {}
+        for message_data, result in zip(messages_data, decrypted):
+            if result.ok:
+                results[message_data['_id']] = result.value
+                read_ids.append(message_data['_id'])
+                if not message_data['read']:
+                    key = (message_data['recipient'], message_data['sender'])
+                    unread_counts[key] = unread_counts.get(key, 0) + 1
+
+        # Mark every successfully decrypted message as read in one round trip
+        if read_ids:
+            now = datetime.now()
+            update_result = await self.messages_collection.update_many(
+                {'_id': {'$in': read_ids}, 'read': False},
+                {'$set': {'read': True, 'read_at': now, 'read_changed_at': now}}
+            )
+
+            # Exactly the unread ones seen were marked: decrement the summaries by them
+            if update_result.modified_count == sum(unread_counts.values()):
+                await self.update_summaries([SummaryChange(recipient, sender, -count)
+                                             for (recipient, sender), count in unread_counts.items()])
+
+            # A concurrent reader marked some first: recount the recipients involved instead of guessing
+            else:
+                for recipient in {recipient for recipient, _ in unread_counts}:
+                    await self.repair_inbox_summaries(recipient)
+
+        # Return content per requested ID
+        return results
+
+
+    async def update_summaries(self, changes: List[SummaryChange]) -> None:
+        """
+        Applies inbox summary changes after a message write, in one round trip
+        The message write already succeeded, so a failure here is reported but not raised
+
+        :param changes: Changes to apply
+
+        :return: None
+        """
+        now = datetime.now()
+
+        try:
+            # Single change: plain update
+            if len(changes) == 1:
+                await self.summaries_collection.update_one({'_id': changes[0].recipient},
+                                                           summary_update(changes[0], now),
+                                                           upsert=changes[0].delta > 0)
+
+            # Several changes: one unordered bulk write
+            elif changes:
+                await self.summaries_collection.bulk_write([
+                    UpdateOne({'_id': change.recipient}, summary_update(change, now), upsert=change.delta > 0)
+                    for change in changes
+                ], ordered=False)
+
+        # Errors updating summaries: print and carry on (the summary drifts until the next repair)
+        except Exception as e:
+            print(f'Error updating inbox summary: {e}', file=sys.stderr)
+
+
+    async def get_inbox_summary(self, username: str) -> InboxSummary:
+        """
+        Returns a user's unread count, last message time and unread count per sender, by key
+
+        :param username: Recipient's username
+
+        :return: InboxSummary (zero unread if the user never received a message)
+        """
+        summary = await self.summaries_collection.find_one({'_id': username})
+
+        # No summary yet: empty inbox
+        if summary is None:
+            return InboxSummary(0, None, {})
+
+        summary = summary_from_document(summary)
+        return InboxSummary(summary['unread'], summary.get('last_message_at'), summary['senders'])
+
+
+    async def repair_inbox_summaries(self, recipient: Optional[str] = None) -> int:
+        """
+        Recomputes inbox summaries from the messages (one aggregation) and replaces the stored ones
+
+        :param recipient: Only repair this recipient's summary (every summary if None)
+
+        :return: Number of summaries written
+        """
+        started = datetime.now()
+        cursor = await self.messages_collection.aggregate(unread_counts_pipeline(recipient), allowDiskUse=True)
+        summaries = fold_unread_counts(await cursor.to_list(None))
+
+        # Recomputed summaries: write them in one round trip
+        if summaries:
+            await self.summaries_collection.bulk_write(summary_replacements(summaries, started), ordered=False)
+
+        await self.summaries_collection.delete_many(stale_summaries_query(started, recipient))
+        return len(summaries)
@@ -3,14 +3,19 @@ Authentication and Registration Service
 """
 
 # --- IMPORTS ---
-from ciphermail.config.database import DatabaseManager
 from ciphermail.models.user import User
-
-import hashlib
+from ciphermail.services.messaging import MessagingManager
+from ciphermail.services.metrics import instrumented
+from ciphermail.services.passwords import PasswordHasher
+from ciphermail.services.passwords import get_password_hasher
+from ciphermail.services.sessions import SessionManager
+from ciphermail.services.sessions import is_session_token
+from ciphermail.storage.base import StorageBackend
 
 
 # --- TYPES ---
 from typing import Optional
+from typing import Union
 
 
 # --- CODE ---
@@ -19,30 +24,60 @@ class AuthManager:
     Handles user authentication and registration
     """
 
-    def __init__(self, db_manager: DatabaseManager) -> None:
+    def __init__(self,
+                 db_manager: StorageBackend,
+                 password_hasher: Optional[PasswordHasher] = None,
+                 session_manager: Optional[SessionManager] = None) -> None:
         """
-        Initializes the AuthManager with a database manager
+        Initializes the AuthManager with a storage backend
 
-        :param db_manager: DatabaseManager instance
+        :param db_manager: StorageBackend instance (DatabaseManager or InMemoryBackend)
+        :param password_hasher: Optional PasswordHasher (process-wide hasher by default)
+        :param session_manager: Optional SessionManager (a new one for this backend by default)
 
         :return: None
         """
         self.db_manager = db_manager
-        self.users_collection = db_manager.get_users_collection()
+        self.users = db_manager.get_user_repository()
+        self.password_hasher = password_hasher or get_password_hasher()
+        self.session_manager = session_manager or SessionManager(db_manager)
 
 
-    @staticmethod
-    def hash_password(password: str) -> str:
+    @instrumented
+    def hash_password(self, password: str) -> str:
         """
-        Hashes password using SHA256
-        
+        Hashes password with the configured KDF on the hashing worker pool
+
         :param password: Plain text password
 
-        :return: Hashed password
+        :return: Encoded hash (KDF name, cost parameters, salt and key)
+        """
+        return self.password_hasher.hash(password)
+
+
+    @instrumented
+    def upgrade_password_hash(self, user_data: dict, password: str) -> None:
         """
-        return hashlib.sha256(password.encode()).hexdigest()
+        Re-hashes a verified password when its stored hash uses an outdated KDF or cost
+
+        :param user_data: User document as loaded at login
+        :param password: Verified plain text password
+
+        :return: None
+        """
+
+        # Hash is current: nothing to do
+        if not self.password_hasher.needs_rehash(user_data['password']):
+            return
 
+        new_hash = self.hash_password(password)
 
+        # Only replace the hash we verified, in case it changed meanwhile
+        self.users.replace_password(user_data['_id'], user_data['password'], new_hash)
+        user_data['password'] = new_hash
+
+
+    @instrumented
     def register(self, username: str, password: str) -> bool:
         """
         Registers a new user
@@ -50,23 +85,32 @@ class AuthManager:
         :param username: Desired username
         :param password: Desired password
 
-        :return: True if registration is successful, False if username exists
+        :return: True if registration is successful, False if username exists or is reserved
         """
 
+        # Username shaped like a session token: reserved
+        if is_session_token(username):
+            return False
+
         # User already exists: return False
-        if self.users_collection.find_one({'username': username}):
+        if self.users.exists(username):
             return False
 
         # Create new user
         user = User(username, self.hash_password(password))
         
-        # Insert user into database
-        self.users_collection.insert_one(user.to_dict())
+        # Insert user into database (taken meanwhile by a concurrent registration: return False)
+        if not self.users.insert(user.to_dict()):
+            return False
+
+        # Drop any cached "no such recipient" answer for this username
+        MessagingManager.invalidate_recipient(username)
 
         # Registration successful
         return True
 
 
+    @instrumented
     def login(self, username: str, password: str) -> Optional[User]:
         """
         Authenticates user
@@ -77,15 +121,62 @@ class AuthManager:
         :return: User object if authentication is successful, None otherwise
         """
 
-        # Find user in database
-        user_data = self.users_collection.find_one({
-            'username': username,
-            'password': self.hash_password(password)
-        })
+        # Find user in database (hashes are salted, so match on username only)
+        user_data = self.users.find_by_username(username)
 
         # Not found user: return None
         if user_data is None:
             return None
 
+        # Wrong password: return None
+        if not self.password_hasher.verify(password, user_data['password']):
+            return None
+
+        # Legacy SHA256 or outdated cost: upgrade now that the password is known
+        self.upgrade_password_hash(user_data, password)
+
         # Return User object
         return User.from_dict(user_data)
+
+
+    @instrumented
+    def create_session(self, username: str, password: str) -> Optional[str]:
+        """
+        Authenticates user and opens a session
+
+        :param username: Username
+        :param password: Password
+
+        :return: Session token if authentication is successful, None otherwise
+        """
+        user = self.login(username, password)
+
+        # Invalid credentials: no session
+        if user is None:
+            return None
+
+        return self.session_manager.issue(user)
+
+
+    @instrumented
+    def authenticate(self, identity: Union[User, str]) -> Optional[User]:
+        """
+        Resolves a User or a session token without re-checking credentials
+
+        :param identity: User object or session token
+
+        :return: User object, or None if the token is unknown or expired
+        """
+        return self.session_manager.authenticate(identity)
+
+
+    @instrumented
+    def end_session(self, token: str) -> bool:
+        """
+        Closes a session
+
+        :param token: Session token
+
+        :return: True if a session was closed, False otherwise
+        """
+        return self.session_manager.revoke(token)
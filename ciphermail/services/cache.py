@@ -0,0 +1,163 @@
+"""
+In-memory caching utilities
+"""
+
+# --- IMPORTS ---
+from collections import OrderedDict
+
+import threading
+import time
+
+
+# --- TYPES ---
+from typing import Any
+from typing import Callable
+from typing import Hashable
+from typing import Optional
+
+
+# --- GLOBALS ---
+# Sentinel used to tell a cached None apart from a cache miss
+_MISSING = object()
+
+
+# --- CODE ---
+class LRUCache:
+    """
+    Thread-safe bounded LRU cache with optional per-entry TTL
+    """
+
+    def __init__(self, max_size: int = 128, ttl: Optional[float] = None) -> None:
+        """
+        Initializes the cache
+
+        :param max_size: Maximum number of entries kept in the cache
+        :param ttl: Default time-to-live in seconds (None for no expiry)
+
+        :return: None
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def __len__(self) -> int:
+        """
+        Returns the number of entries currently stored
+
+        :return: Number of entries
+        """
+        return len(self._entries)
+
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Returns the cached value for a key
+
+        :param key: Cache key
+        :param default: Value returned on miss or expiry
+
+        :return: Cached value or default
+        """
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+
+            # Not cached: return default
+            if entry is _MISSING:
+                return default
+
+            value, expires_at = entry
+
+            # Expired entry: drop it and return default
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._entries[key]
+                return default
+
+            # Mark as most recently used
+            self._entries.move_to_end(key)
+            return value
+
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        """
+        Stores a value, evicting the least recently used entry when full
+
+        :param key: Cache key
+        :param value: Value to store
+        :param ttl: Time-to-live in seconds for this entry (defaults to the cache TTL)
+
+        :return: None
+        """
+
+        # Cache disabled: nothing to store
+        if self.max_size <= 0:
+            return
+
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+
+            # Over capacity: evict least recently used entries
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+    def get_or_create(self, key: Hashable, factory: Callable[[], Any]) -> Any:
+        """
+        Returns the cached value for a key, creating and storing it on miss
+
+        :param key: Cache key
+        :param factory: Callable building the value when not cached
+
+        :return: Cached or newly created value
+        """
+        value = self.get(key, _MISSING)
+
+        # Cache miss: build and store the value
+        if value is _MISSING:
+            value = factory()
+            self.set(key, value)
+
+        return value
+
+
+    def evict(self, key: Hashable) -> bool:
+        """
+        Removes a single entry from the cache
+
+        :param key: Cache key
+
+        :return: True if an entry was removed, False otherwise
+        """
+        with self._lock:
+            return self._entries.pop(key, _MISSING) is not _MISSING
+
+
+    def resize(self, max_size: int) -> None:
+        """
+        Changes the cache capacity, evicting entries if needed
+
+        :param max_size: New maximum number of entries
+
+        :return: None
+        """
+        with self._lock:
+            self.max_size = max_size
+
+            # Over new capacity: evict least recently used entries
+            while self._entries and len(self._entries) > max(max_size, 0):
+                self._entries.popitem(last=False)
+
+
+    def clear(self) -> None:
+        """
+        Removes every entry from the cache
+
+        :return: None
+        """
+        with self._lock:
+            self._entries.clear()
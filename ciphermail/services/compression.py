@@ -0,0 +1,149 @@
+"""
+Optional compression of message plain text before encryption
+"""
+
+# --- IMPORTS ---
+import os
+import zlib
+
+
+# --- TYPES ---
+from typing import Callable
+from typing import Dict
+from typing import Optional
+from typing import Tuple
+
+
+# --- GLOBALS ---
+# Algorithm for new messages: 'none' (default), 'zlib', 'zstd' or 'auto' (zstd when installed, zlib otherwise)
+MESSAGE_COMPRESSION = os.getenv('MESSAGE_COMPRESSION', 'none').lower()
+
+# Plain texts smaller than this (bytes) are stored uncompressed: the headers would cost more than they save
+COMPRESSION_THRESHOLD = int(os.getenv('MESSAGE_COMPRESSION_THRESHOLD', '256'))
+
+# Compression levels (zlib: 0-9, zstd: 1-22)
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# Upper bound on a decompressed message, so a crafted payload cannot exhaust memory
+MAX_DECOMPRESSED_SIZE = int(os.getenv('MAX_DECOMPRESSED_SIZE', str(64 * 1024 * 1024)))
+
+
+# --- CODE ---
+def zlib_decompress(data: bytes) -> bytes:
+    """
+    Decompresses zlib data, refusing output above MAX_DECOMPRESSED_SIZE
+
+    :param data: Compressed data
+
+    :return: Decompressed data
+
+    :raises ValueError: If the output would exceed the limit
+    """
+    decompressor = zlib.decompressobj()
+    output = decompressor.decompress(data, MAX_DECOMPRESSED_SIZE)
+
+    # Output capped with input left over: too large
+    if decompressor.unconsumed_tail:
+        raise ValueError('Decompressed message too large')
+
+    return output + decompressor.flush()
+
+
+# Algorithm name -> (compress, decompress)
+COMPRESSORS: Dict[str, Tuple[Callable[[bytes], bytes], Callable[[bytes], bytes]]] = {
+    'zlib': (lambda data: zlib.compress(data, ZLIB_LEVEL), zlib_decompress),
+}
+
+# zstd: only when the optional zstandard package is installed
+try:
+    import zstandard
+
+    def zstd_decompress(data: bytes) -> bytes:
+        """
+        Decompresses zstd data, refusing output above MAX_DECOMPRESSED_SIZE
+
+        :param data: Compressed data
+
+        :return: Decompressed data
+
+        :raises ValueError: If the output would exceed the limit
+        """
+        size = zstandard.frame_content_size(data)
+
+        # Declared size above the limit: refuse before allocating
+        if size > MAX_DECOMPRESSED_SIZE:
+            raise ValueError('Decompressed message too large')
+
+        return zstandard.ZstdDecompressor().decompress(data, max_output_size=MAX_DECOMPRESSED_SIZE)
+
+    COMPRESSORS['zstd'] = (lambda data: zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data), zstd_decompress)
+
+# Not installed: zlib only
+except ImportError:
+    pass
+
+
+def configured_algorithm() -> Optional[str]:
+    """
+    Resolves MESSAGE_COMPRESSION to an available algorithm
+
+    :return: Algorithm name, or None for no compression
+    """
+
+    # Automatic: best available
+    if MESSAGE_COMPRESSION == 'auto':
+        return 'zstd' if 'zstd' in COMPRESSORS else 'zlib'
+
+    # zstd requested but not installed: fall back to zlib
+    if MESSAGE_COMPRESSION == 'zstd' and 'zstd' not in COMPRESSORS:
+        return 'zlib'
+
+    return MESSAGE_COMPRESSION if MESSAGE_COMPRESSION in COMPRESSORS else None
+
+
+def compress(data: bytes, algorithm: Optional[str] = None) -> Tuple[bytes, Optional[str]]:
+    """
+    Compresses plain text when worthwhile
+
+    :param data: Plain text bytes
+    :param algorithm: Algorithm to use (configured one by default)
+
+    :return: Tuple of (data to encrypt, algorithm used or None if stored as is)
+    """
+    algorithm = algorithm or configured_algorithm()
+
+    # Disabled or too small to gain anything: store as is
+    if algorithm is None or len(data) < COMPRESSION_THRESHOLD:
+        return data, None
+
+    compressed = COMPRESSORS[algorithm][0](data)
+
+    # Incompressible (e.g. already compressed): store as is
+    if len(compressed) >= len(data):
+        return data, None
+
+    return compressed, algorithm
+
+
+def decompress(data: bytes, algorithm: Optional[str]) -> bytes:
+    """
+    Reverses compress()
+
+    :param data: Decrypted bytes
+    :param algorithm: Algorithm recorded with the message (None for uncompressed)
+
+    :return: Plain text bytes
+
+    :raises ValueError: If the algorithm is unknown or unavailable, or the output is too large
+    """
+
+    # Stored as is (includes every message written before compression existed)
+    if algorithm is None:
+        return data
+
+    # Written by a process with an algorithm this one lacks (e.g. zstandard not installed)
+    if algorithm not in COMPRESSORS:
+        raise ValueError(f'Unsupported compression: {algorithm}')
+
+    return COMPRESSORS[algorithm][1](data)
@@ -3,22 +3,168 @@ Service for encrypting and decrypting messages.
 """
 
 # --- IMPORTS ---
+from concurrent.futures import ThreadPoolExecutor
+from cryptography.exceptions import InvalidTag
 from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from ciphermail.services.cache import LRUCache
+from ciphermail.services.compression import compress
+from ciphermail.services.compression import decompress
+from ciphermail.services.metrics import instrumented
+from ciphermail.services.metrics import record_error
 
+import asyncio
 import base64
+import functools
 import hashlib
+import os
+import secrets
+import threading
 
 
 # --- TYPES ---
+from typing import Any
+from typing import BinaryIO
+from typing import Callable
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import NamedTuple
 from typing import Optional
+from typing import Tuple
+
+
+# --- GLOBALS ---
+# Default size and TTL (seconds) of the derived cipher cache
+CIPHER_CACHE_SIZE = int(os.getenv('CIPHER_CACHE_SIZE', '64'))
+CIPHER_CACHE_TTL = float(os.getenv('CIPHER_CACHE_TTL', '300'))
+
+# Per-process secret used to derive cache keys, so user keys never index the cache
+_CACHE_KEY_SECRET = secrets.token_bytes(32)
+
+# Batches at least this large are spread over the crypto thread pool
+BATCH_PARALLEL_THRESHOLD = int(os.getenv('CRYPTO_BATCH_THRESHOLD', '256'))
+
+# Crypto worker threads (OpenSSL releases the GIL, so one per core)
+CRYPTO_WORKERS = int(os.getenv('CRYPTO_WORKERS', '0')) or os.cpu_count() or 1
+
+# Plain text bytes per chunk of a streamed body
+STREAM_CHUNK_SIZE = int(os.getenv('STREAM_CHUNK_SIZE', str(256 * 1024)))
+
+# Streamed chunks: HKDF info for the AES-GCM key, and the associated data prefix of every chunk
+STREAM_KEY_INFO = b'ciphermail stream key v1'
+STREAM_AAD_PREFIX = b'ciphermail stream v1'
+
+# Shared worker pool, created on first large batch
+_crypto_pool: Optional[ThreadPoolExecutor] = None
+_crypto_pool_lock = threading.Lock()
 
 
 # --- CODE ---
+class CryptoResult(NamedTuple):
+    """
+    Outcome of encrypting or decrypting a single batch item
+    """
+    ok: bool
+    value: Optional[str] = None
+    error: Optional[str] = None
+
+
+def get_crypto_pool() -> ThreadPoolExecutor:
+    """
+    Returns the shared crypto thread pool, creating it on first use
+
+    :return: ThreadPoolExecutor instance
+    """
+    global _crypto_pool
+
+    # Pool already created: reuse it
+    if _crypto_pool is not None:
+        return _crypto_pool
+
+    with _crypto_pool_lock:
+
+        # Create pool if another thread did not beat us to it
+        if _crypto_pool is None:
+            _crypto_pool = ThreadPoolExecutor(max_workers=CRYPTO_WORKERS,
+                                              thread_name_prefix='ciphermail-crypto')
+
+    return _crypto_pool
+
+
+async def run_in_crypto_pool(function: Callable[..., Any], *args: Any) -> Any:
+    """
+    Runs CPU-bound crypto or hashing work on the shared pool without blocking the event loop
+
+    :param function: Callable to run
+    :param args: Positional arguments for the callable
+
+    :return: Result of the callable
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_crypto_pool(), functools.partial(function, *args))
+
+
+def read_chunk(reader: BinaryIO, size: int) -> bytes:
+    """
+    Reads exactly size bytes, fewer only at end of stream (pipes and sockets may return short reads)
+
+    :param reader: Binary file-like object
+    :param size: Bytes to read
+
+    :return: Bytes read (empty at end of stream)
+    """
+    parts = []
+    remaining = size
+
+    while remaining > 0:
+        part = reader.read(remaining)
+
+        # End of stream: return what was read
+        if not part:
+            break
+
+        parts.append(part)
+        remaining -= len(part)
+
+    return b''.join(parts)
+
+
+def stream_nonce(nonce_prefix: bytes, index: int) -> bytes:
+    """
+    Builds the AES-GCM nonce of a chunk: the body's random prefix followed by the chunk index
+
+    :param nonce_prefix: 8 random bytes chosen per body
+    :param index: Chunk position
+
+    :return: 12-byte nonce
+    """
+    return nonce_prefix + index.to_bytes(4, 'big')
+
+
+def stream_aad(index: int, final: bool) -> bytes:
+    """
+    Builds the associated data of a chunk, binding its position and whether it ends the body
+
+    :param index: Chunk position
+    :param final: Whether this is the last chunk
+
+    :return: Associated data
+    """
+    return STREAM_AAD_PREFIX + index.to_bytes(4, 'big') + (b'\x01' if final else b'\x00')
+
+
 class EncryptionManager:
     """
     Handles message encryption and decryption
     """
 
+    # Ready-to-use Fernet instances, keyed by a keyed digest of the user key
+    _cipher_cache = LRUCache(max_size=CIPHER_CACHE_SIZE, ttl=CIPHER_CACHE_TTL)
+
+
     @staticmethod
     def normalize_key(key: str) -> bytes:
         """
@@ -34,20 +180,101 @@ class EncryptionManager:
 
 
     @staticmethod
+    def cache_key(key: str) -> bytes:
+        """
+        Derives the cache lookup key for a user key
+        Uses keyed BLAKE2b so the cache never holds the raw or normalized key
+
+        :param key: User-provided key
+
+        :return: Digest identifying the key in the cipher cache
+        """
+        return hashlib.blake2b(key.encode(), key=_CACHE_KEY_SECRET, digest_size=16).digest()
+
+
+    @staticmethod
+    def get_cipher(key: str) -> Fernet:
+        """
+        Returns a Fernet instance for the key, reusing a cached one when possible
+
+        :param key: User-provided key
+
+        :return: Fernet instance
+        """
+        return EncryptionManager._cipher_cache.get_or_create(
+            EncryptionManager.cache_key(key),
+            lambda: Fernet(EncryptionManager.normalize_key(key))
+        )
+
+
+    @staticmethod
+    def get_stream_cipher(key: str) -> AESGCM:
+        """
+        Returns the AES-GCM cipher used for streamed bodies, reusing a cached one when possible
+        Its key is derived from the normalized key with HKDF, so it never equals the Fernet keys
+
+        :param key: User-provided key
+
+        :return: AESGCM instance
+        """
+        return EncryptionManager._cipher_cache.get_or_create(
+            EncryptionManager.cache_key(key) + b'stream',
+            lambda: AESGCM(HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=STREAM_KEY_INFO)
+                           .derive(base64.urlsafe_b64decode(EncryptionManager.normalize_key(key))))
+        )
+
+
+    @staticmethod
+    def configure_cache(max_size: int, ttl: Optional[float] = None) -> None:
+        """
+        Changes the size and TTL of the cipher cache (0 disables caching)
+
+        :param max_size: Maximum number of cached ciphers
+        :param ttl: Time-to-live in seconds for new entries (None for no expiry)
+
+        :return: None
+        """
+        EncryptionManager._cipher_cache.ttl = ttl
+        EncryptionManager._cipher_cache.resize(max_size)
+
+
+    @staticmethod
+    def evict_key(key: str) -> bool:
+        """
+        Removes the cached cipher for a key
+
+        :param key: User-provided key
+
+        :return: True if a cached cipher was removed, False otherwise
+        """
+        cache_key = EncryptionManager.cache_key(key)
+        stream_evicted = EncryptionManager._cipher_cache.evict(cache_key + b'stream')
+        return EncryptionManager._cipher_cache.evict(cache_key) or stream_evicted
+
+
+    @staticmethod
+    def clear_cache() -> None:
+        """
+        Removes every cached cipher (e.g. on logout)
+
+        :return: None
+        """
+        EncryptionManager._cipher_cache.clear()
+
+
+    @staticmethod
+    @instrumented
     def encrypt(message: str, key: str) -> str:
         """
         Encrypts a message using the provided key
-        
+
         :param message: Message to encrypt
         :param key: Key to use for encryption
 
         :return: Encrypted message as a string
         """
-        # Normalize the key
-        normalized_key = EncryptionManager.normalize_key(key)
-
-        # Create Fernet instance
-        fernet = Fernet(normalized_key)
+        # Get Fernet instance for the key
+        fernet = EncryptionManager.get_cipher(key)
 
         # Encrypt the message
         encrypted = fernet.encrypt(message.encode())
@@ -57,29 +284,216 @@ class EncryptionManager:
 
 
     @staticmethod
-    def decrypt(encrypted_message: str, key: str) -> Optional[str]:
+    @instrumented
+    def encrypt_compressed(message: str, key: str) -> Tuple[str, Optional[str]]:
+        """
+        Compresses a message (per MESSAGE_COMPRESSION and its threshold), then encrypts it
+
+        :param message: Message to encrypt
+        :param key: Key to use for encryption
+
+        :return: Tuple of (encrypted message as a string, compression algorithm to store with it or None)
+        """
+        data, compression = compress(message.encode())
+        return EncryptionManager.get_cipher(key).encrypt(data).decode(), compression
+
+
+    @staticmethod
+    @instrumented
+    def decrypt(encrypted_message: str, key: str, compression: Optional[str] = None) -> Optional[str]:
         """
         Decrypts a message using the provided key
 
         :param encrypted_message: Encrypted message to decrypt
         :param key: Key to use for decryption
+        :param compression: Compression algorithm stored with the message (None if uncompressed)
 
         :return: Decrypted message as a string, or None if decryption fails
         """
         try:
 
-            # Normalize the key
-            normalized_key = EncryptionManager.normalize_key(key)
-
-            # Create Fernet instance
-            fernet = Fernet(normalized_key)
+            # Get Fernet instance for the key
+            fernet = EncryptionManager.get_cipher(key)
 
             # Decrypt the message
             decrypted = fernet.decrypt(encrypted_message.encode())
 
             # Return decrypted message as string
-            return decrypted.decode()
+            return decompress(decrypted, compression).decode()
 
         # Error during decryption: return None
         except Exception:
+            record_error('EncryptionManager.decrypt')
             return None
+
+
+    @staticmethod
+    @instrumented
+    def encrypt_many(messages: Iterable[str], key: str) -> List[CryptoResult]:
+        """
+        Encrypts a batch of messages with the same key
+
+        :param messages: Messages to encrypt
+        :param key: Key to use for encryption
+
+        :return: One CryptoResult per message, in input order
+        """
+        fernet = EncryptionManager.get_cipher(key)
+        return EncryptionManager._run_batch(
+            list(messages),
+            lambda message: fernet.encrypt(message.encode()).decode()
+        )
+
+
+    @staticmethod
+    @instrumented
+    def decrypt_many(encrypted_messages: Iterable[str],
+                     key: str,
+                     compressions: Optional[Iterable[Optional[str]]] = None) -> List[CryptoResult]:
+        """
+        Decrypts a batch of messages with the same key
+
+        :param encrypted_messages: Encrypted messages to decrypt
+        :param key: Key to use for decryption
+        :param compressions: Compression algorithm of each message (all uncompressed by default)
+
+        :return: One CryptoResult per message, in input order
+        """
+        fernet = EncryptionManager.get_cipher(key)
+        encrypted_messages = list(encrypted_messages)
+
+        # No compression given: every message stored as is
+        if compressions is None:
+            return EncryptionManager._run_batch(
+                encrypted_messages,
+                lambda encrypted_message: fernet.decrypt(encrypted_message.encode()).decode()
+            )
+
+        return EncryptionManager._run_batch(
+            list(zip(encrypted_messages, compressions)),
+            lambda item: decompress(fernet.decrypt(item[0].encode()), item[1]).decode()
+        )
+
+
+    @staticmethod
+    def encrypt_stream(reader: BinaryIO,
+                       key: str,
+                       chunk_size: int = STREAM_CHUNK_SIZE) -> Tuple[bytes, Iterator[bytes]]:
+        """
+        Encrypts a body in fixed-size AES-GCM chunks, reading it as the chunks are consumed
+        Each chunk authenticates its position and whether it is the last one,
+        so chunks cannot be reordered, dropped or truncated without decryption failing
+
+        :param reader: Binary file-like object holding the plain text body
+        :param key: Key to use for encryption
+        :param chunk_size: Plain text bytes per chunk
+
+        :return: Tuple of (nonce prefix to store with the body, iterator of encrypted chunks)
+        """
+        cipher = EncryptionManager.get_stream_cipher(key)
+        nonce_prefix = secrets.token_bytes(8)
+
+        def chunks() -> Iterator[bytes]:
+            index = 0
+            current = read_chunk(reader, chunk_size)
+
+            # Read one chunk ahead to know which chunk is the last (an empty body is one empty chunk)
+            while True:
+                following = read_chunk(reader, chunk_size)
+                final = not following
+                yield cipher.encrypt(stream_nonce(nonce_prefix, index), current, stream_aad(index, final))
+
+                # Last chunk written: done
+                if final:
+                    return
+
+                current = following
+                index += 1
+
+        return nonce_prefix, chunks()
+
+
+    @staticmethod
+    @instrumented
+    def decrypt_stream(nonce_prefix: bytes, chunks: Iterable[bytes], key: str, writer: BinaryIO) -> Optional[int]:
+        """
+        Decrypts a chunked body incrementally, writing each chunk as soon as it is verified
+        On failure the writer may already hold the verified chunks that came before
+
+        :param nonce_prefix: Nonce prefix stored with the body
+        :param chunks: Encrypted chunks, in order
+        :param key: Key to use for decryption
+        :param writer: Binary file-like object receiving the plain text
+
+        :return: Number of plain text bytes written, or None if decryption fails or the body is incomplete
+        """
+        cipher = EncryptionManager.get_stream_cipher(key)
+        written = 0
+        final_seen = False
+
+        try:
+            for index, chunk in enumerate(chunks):
+
+                # Chunks after the last one: tampered body
+                if final_seen:
+                    raise ValueError('Data after the final chunk')
+
+                nonce = stream_nonce(nonce_prefix, index)
+
+                # Most chunks are not the last one: try that first
+                try:
+                    plain_text = cipher.decrypt(nonce, chunk, stream_aad(index, False))
+                except InvalidTag:
+                    plain_text = cipher.decrypt(nonce, chunk, stream_aad(index, True))
+                    final_seen = True
+
+                writer.write(plain_text)
+                written += len(plain_text)
+
+            # Body ended before its final chunk: truncated
+            if not final_seen:
+                raise ValueError('Missing final chunk')
+
+            return written
+
+        # Wrong key, tampered or truncated body: return None
+        except Exception:
+            record_error('EncryptionManager.decrypt_stream')
+            return None
+
+
+    @staticmethod
+    def _run_batch(items: List[Any], operation: Callable[[Any], str]) -> List[CryptoResult]:
+        """
+        Applies an operation to every item, in parallel for large batches
+
+        :param items: Batch items
+        :param operation: Per-item operation, raising on failure
+
+        :return: One CryptoResult per item, in input order
+        """
+
+        def run_slice(batch_slice: List[Any]) -> List[CryptoResult]:
+            results = []
+            for item in batch_slice:
+                try:
+                    results.append(CryptoResult(True, operation(item)))
+
+                # Error on this item only: record it and keep going
+                except Exception as e:
+                    results.append(CryptoResult(False, error=type(e).__name__))
+            return results
+
+        # Small batch: thread hand-off costs more than it saves
+        if len(items) < BATCH_PARALLEL_THRESHOLD or CRYPTO_WORKERS < 2:
+            return run_slice(items)
+
+        # Large batch: one contiguous slice per worker keeps ordering trivial
+        slice_size = -(-len(items) // CRYPTO_WORKERS)
+        slices = [items[i:i + slice_size] for i in range(0, len(items), slice_size)]
+
+        results = []
+        for slice_results in get_crypto_pool().map(run_slice, slices):
+            results.extend(slice_results)
+
+        return results
@@ -0,0 +1,210 @@
+"""
+Local inbox cache: unread message documents (headers and ciphertext, never plain text) in a SQLite file,
+so opening the inbox only downloads the documents it does not hold yet
+"""
+
+# --- IMPORTS ---
+from bson import ObjectId
+from datetime import datetime
+
+import bson
+import os
+import sqlite3
+import sys
+import threading
+
+
+# --- TYPES ---
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+
+
+# --- GLOBALS ---
+# Cache file (empty: no cache); one file per server, as messages are keyed by recipient only
+INBOX_CACHE_PATH = os.path.expanduser(os.getenv('INBOX_CACHE_PATH', ''))
+
+# Seconds before the last sync a sync looks back from (writes still in flight, clocks of other clients)
+INBOX_CACHE_SYNC_OVERLAP = float(os.getenv('INBOX_CACHE_SYNC_OVERLAP', '60'))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id TEXT PRIMARY KEY,
+    recipient TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    document BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_recipient_timestamp_id ON messages (recipient, timestamp DESC, id DESC);
+-- Positions of the former _id based syncs: dropped, so older cache files resync in full once
+DROP TABLE IF EXISTS sync_state;
+CREATE TABLE IF NOT EXISTS sync_times (
+    recipient TEXT PRIMARY KEY,
+    synced_at TEXT NOT NULL
+);
+"""
+
+
+# --- CODE ---
+def sortable_timestamp(timestamp: datetime) -> str:
+    """
+    Formats a timestamp so text order is time order, at the millisecond precision BSON keeps
+    (the cached documents and the continuation tokens built from them carry no more)
+
+    :param timestamp: Message timestamp
+
+    :return: Fixed-width ISO 8601 text
+    """
+    return timestamp.isoformat(timespec='milliseconds')
+
+
+class InboxCache:
+    """
+    Unread messages of the users of this machine, as stored on the server, in a SQLite file
+    Holds what the server holds (ciphertext, headers), plus the time of the last sync per recipient
+    """
+
+    def __init__(self, path: str) -> None:
+        """
+        Opens (or creates) the cache file, readable by its owner only
+
+        :param path: SQLite file path
+
+        :return: None
+        """
+        directory = os.path.dirname(path)
+
+        # Missing directory: create it, private as well
+        if directory:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+
+        # Create the file owner-only before SQLite opens it (it holds headers and ciphertext)
+        os.close(os.open(path, os.O_CREAT | os.O_RDWR, 0o600))
+
+        # One connection shared by the CLI threads, serialized by the lock
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.executescript(SCHEMA)
+
+
+    def synced_at(self, recipient: str) -> Optional[datetime]:
+        """
+        Returns the time a recipient's last sync started
+
+        :param recipient: Recipient's username
+
+        :return: Time of the last sync, or None if the recipient was never synced
+        """
+        with self.lock:
+            row = self.connection.execute('SELECT synced_at FROM sync_times WHERE recipient = ?',
+                                          (recipient,)).fetchone()
+        return datetime.fromisoformat(row[0]) if row is not None else None
+
+
+    def message_ids(self, recipient: str) -> Set[ObjectId]:
+        """
+        Returns the IDs of a recipient's cached messages
+
+        :param recipient: Recipient's username
+
+        :return: Set of message IDs
+        """
+        with self.lock:
+            rows = self.connection.execute('SELECT id FROM messages WHERE recipient = ?', (recipient,)).fetchall()
+        return {ObjectId(row[0]) for row in rows}
+
+
+    def apply(self, recipient: str, added: List[dict], removed: Iterable[ObjectId], synced_at: datetime) -> None:
+        """
+        Applies one sync to a recipient's cached messages, atomically
+
+        :param recipient: Recipient's username
+        :param added: Full message documents to store
+        :param removed: IDs of the messages no longer unread
+        :param synced_at: Time the sync started (the next one looks for changes after it)
+
+        :return: None
+        """
+        with self.lock, self.connection:
+            self.connection.executemany('DELETE FROM messages WHERE id = ?',
+                                        [(str(message_id),) for message_id in removed])
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO messages (id, recipient, timestamp, document) VALUES (?, ?, ?, ?)',
+                [(str(message_data['_id']), recipient, sortable_timestamp(message_data['timestamp']),
+                  bson.encode(message_data)) for message_data in added]
+            )
+            self.connection.execute('INSERT OR REPLACE INTO sync_times (recipient, synced_at) VALUES (?, ?)',
+                                    (recipient, synced_at.isoformat()))
+
+
+    def discard(self, message_ids: Iterable[ObjectId]) -> None:
+        """
+        Removes messages (just read here) from the cache
+
+        :param message_ids: IDs of the messages
+
+        :return: None
+        """
+        with self.lock, self.connection:
+            self.connection.executemany('DELETE FROM messages WHERE id = ?',
+                                        [(str(message_id),) for message_id in message_ids])
+
+
+    def find_unread_page(self,
+                         recipient: str,
+                         after: Optional[Tuple[datetime, ObjectId]],
+                         limit: int) -> List[dict]:
+        """
+        Returns cached messages of a recipient, newest first, after a keyset position
+
+        :param recipient: Recipient's username
+        :param after: (timestamp, _id) of the last message already returned, or None from the start
+        :param limit: Maximum number of messages
+
+        :return: List of full message documents
+        """
+        query = 'SELECT document FROM messages WHERE recipient = ?'
+        parameters = [recipient]
+
+        # Continuing: only what sorts after the position
+        if after is not None:
+            timestamp, message_id = sortable_timestamp(after[0]), str(after[1])
+            query += ' AND (timestamp < ? OR (timestamp = ? AND id < ?))'
+            parameters += [timestamp, timestamp, message_id]
+
+        with self.lock:
+            rows = self.connection.execute(query + ' ORDER BY timestamp DESC, id DESC LIMIT ?',
+                                           parameters + [limit]).fetchall()
+        return [bson.decode(row[0]) for row in rows]
+
+
+    def close(self) -> None:
+        """
+        Closes the cache file
+
+        :return: None
+        """
+        with self.lock:
+            self.connection.close()
+
+
+def open_inbox_cache() -> Optional[InboxCache]:
+    """
+    Opens the configured inbox cache
+
+    :return: InboxCache on INBOX_CACHE_PATH, or None if no cache is configured or it cannot be opened
+    """
+
+    # No cache configured
+    if not INBOX_CACHE_PATH:
+        return None
+
+    try:
+        return InboxCache(INBOX_CACHE_PATH)
+
+    # Unusable cache file: work without it
+    except (OSError, sqlite3.Error) as e:
+        print(f'Inbox cache disabled: {e}', file=sys.stderr)
+        return None
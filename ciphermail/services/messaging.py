@@ -3,41 +3,367 @@ Messaging service
 """
 
 # --- IMPORTS ---
+from bson import ObjectId
 from datetime import datetime
-from ciphermail.config.database import DatabaseManager
+from datetime import timedelta
 from ciphermail.models.message import Message
+from ciphermail.models.message import decode_content
+from ciphermail.models.user import User
+from ciphermail.services.cache import LRUCache
+from ciphermail.services.encryption import STREAM_CHUNK_SIZE
 from ciphermail.services.encryption import EncryptionManager
+from ciphermail.services.inbox_cache import INBOX_CACHE_SYNC_OVERLAP
+from ciphermail.services.inbox_cache import InboxCache
+from ciphermail.services.metrics import instrumented
+from ciphermail.services.metrics import record_error
+from ciphermail.services.sessions import SessionManager
+from ciphermail.services.sessions import is_session_token
+from ciphermail.storage.base import FeedSubscription
+from ciphermail.storage.base import StorageBackend
+from ciphermail.storage.base import SummaryChange
+
+import base64
+import io
+import os
+import sqlite3
+import sys
 
 
 # --- TYPES ---
+from typing import BinaryIO
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
 from typing import List
+from typing import Mapping
+from typing import NamedTuple
 from typing import Optional
+from typing import Tuple
+from typing import Union
+
+
+# --- GLOBALS ---
+# Known-recipient cache: size, TTL of positive entries and TTL of "no such user" entries (seconds)
+RECIPIENT_CACHE_SIZE = int(os.getenv('RECIPIENT_CACHE_SIZE', '10000'))
+RECIPIENT_CACHE_TTL = float(os.getenv('RECIPIENT_CACHE_TTL', '300'))
+RECIPIENT_NEGATIVE_TTL = float(os.getenv('RECIPIENT_NEGATIVE_TTL', '5'))
+
+# Username -> exists flag, shared by every MessagingManager in the process
+_recipient_cache = LRUCache(max_size=RECIPIENT_CACHE_SIZE, ttl=RECIPIENT_CACHE_TTL)
 
 
 # --- CODE ---
+class BulkSendResult(NamedTuple):
+    """
+    Outcome of a multi-recipient send
+    """
+    delivered: List[str]
+    unknown: List[str]
+    failed: List[str]
+
+
+class InboxSummary(NamedTuple):
+    """
+    Unread messages of a user at a glance
+    """
+    unread: int
+    last_message_at: Optional[datetime]
+    senders: Dict[str, int]
+
+
+class InboxSubscription:
+    """
+    Live feed of a user's new messages, in arrival order (headers; encrypted content loaded on access)
+    Iterating blocks until each next message; poll() waits at most a given time
+    A named subscription saves its position once a message is handled (the next one is asked for, or the
+    subscription is closed), and the next subscription under that name resumes after it
+    """
+
+    def __init__(self,
+                 messaging_manager: 'MessagingManager',
+                 subscription: FeedSubscription,
+                 position_key: Optional[str] = None) -> None:
+        """
+        Initializes the subscription (see MessagingManager.subscribe)
+
+        :param messaging_manager: MessagingManager loading the encrypted content
+        :param subscription: Feed subscription delivering the messages
+        :param position_key: Key the position is saved under (None: not saved)
+
+        :return: None
+        """
+        self.messaging_manager = messaging_manager
+        self.subscription = subscription
+        self.position_key = position_key
+        self.pending_token = None
+        self.closed = False
+
+
+    @property
+    def resumed(self) -> bool:
+        """
+        Whether the subscription picked up exactly where the saved one stopped
+        When False, messages may have arrived unseen before it started: list the inbox once
+
+        :return: True if resumed, False otherwise
+        """
+        return self.subscription.resumed
+
+
+    def save_position(self) -> None:
+        """
+        Saves the position after the last message handed out, if the subscription is named
+
+        :return: None
+        """
+
+        # Nothing handed out since the last save, or nowhere to save: nothing to do
+        if self.pending_token is None or self.position_key is None:
+            return
+
+        self.messaging_manager.feed.save_position(self.position_key, self.pending_token)
+        self.pending_token = None
+
+
+    def poll(self, timeout: float = 1.0) -> Optional[Message]:
+        """
+        Waits for the next new message
+
+        :param timeout: Maximum time to wait, in seconds
+
+        :return: Message (encrypted content loaded on access), or None if nothing arrived in time
+        """
+
+        # Previous message handled: remember the position after it
+        self.save_position()
+
+        event = self.subscription.next(timeout)
+
+        # Nothing in time
+        if event is None:
+            return None
+
+        self.pending_token = event.token
+        return Message.from_dict(event.message, self.messaging_manager.load_encrypted_content)
+
+
+    def __iter__(self) -> Iterator[Message]:
+        """
+        Yields new messages as they arrive, until the subscription is closed
+
+        :return: Iterator of Message objects
+        """
+        while not self.closed:
+            message = self.poll()
+            if message is not None:
+                yield message
+
+
+    def close(self) -> None:
+        """
+        Saves the position and stops the subscription
+
+        :return: None
+        """
+        self.closed = True
+        self.save_position()
+        self.subscription.close()
+
+
+    def __enter__(self) -> 'InboxSubscription':
+        """
+        Uses the subscription as a context manager (closed on exit)
+
+        :return: This subscription
+        """
+        return self
+
+
+    def __exit__(self, *exc_info) -> None:
+        """
+        Closes the subscription
+
+        :return: None
+        """
+        self.close()
+
+
+def encode_continuation_token(message: Message) -> str:
+    """
+    Encodes the keyset position after a message as an opaque token
+
+    :param message: Last message of a page
+
+    :return: Continuation token
+    """
+    position = f'{message.timestamp.isoformat()}|{message._id}'
+    return base64.urlsafe_b64encode(position.encode()).decode()
+
+
+def decode_continuation_token(token: str) -> Tuple[datetime, ObjectId]:
+    """
+    Decodes a continuation token into its keyset position
+
+    :param token: Continuation token
+
+    :return: Tuple of (timestamp, _id) of the last message already returned
+    """
+    try:
+        timestamp, message_id = base64.urlsafe_b64decode(token.encode()).decode().split('|')
+        return datetime.fromisoformat(timestamp), ObjectId(message_id)
+
+    # Malformed token: report it as a bad argument
+    except Exception:
+        raise ValueError('Invalid continuation token')
+
+
+def check_page_size(page_size: int) -> None:
+    """
+    Rejects page sizes that cannot hold a message
+
+    :param page_size: Requested number of messages per page
+
+    :return: None
+
+    :raises ValueError: If page_size is below 1
+    """
+    if page_size < 1:
+        raise ValueError(f'Page size must be at least 1, got {page_size}')
+
+
+def split_page(messages: List[Message], page_size: int) -> Tuple[List[Message], Optional[str]]:
+    """
+    Trims a page fetched with one extra message and derives the next continuation token
+
+    :param messages: Up to page_size + 1 messages
+    :param page_size: Maximum number of messages in the page
+
+    :return: Tuple of (page messages, token for the next page or None)
+    """
+
+    # Last page: no continuation
+    if len(messages) <= page_size:
+        return messages, None
+
+    # More pages: token points after the last message of this page
+    messages = messages[:page_size]
+    return messages, encode_continuation_token(messages[-1])
+
+
+def fold_unread_counts(groups: Iterable[dict]) -> List[dict]:
+    """
+    Folds per-recipient, per-sender unread counts into one inbox summary per recipient
+
+    :param groups: {'recipient', 'sender', 'unread', 'last_message_at'} documents
+
+    :return: List of summary documents ({'_id': recipient, 'unread', 'last_message_at', 'senders'})
+    """
+    summaries: Dict[str, dict] = {}
+
+    for group in groups:
+        summary = summaries.setdefault(group['recipient'], {'_id': group['recipient'], 'unread': 0,
+                                                            'last_message_at': group['last_message_at'],
+                                                            'senders': {}})
+        summary['unread'] += group['unread']
+        summary['last_message_at'] = max(summary['last_message_at'], group['last_message_at'])
+
+        # Senders are listed only while they have unread messages
+        if group['unread']:
+            summary['senders'][group['sender']] = group['unread']
+
+    return list(summaries.values())
+
+
+def cached_recipient(recipient: str) -> Optional[bool]:
+    """
+    Looks up a recipient in the known-recipient cache
+
+    :param recipient: Recipient's username
+
+    :return: True/False if cached, None on cache miss
+    """
+    return _recipient_cache.get(recipient)
+
+
+def cache_recipient(recipient: str, exists: bool) -> None:
+    """
+    Stores a recipient lookup result in the known-recipient cache
+    Negative answers expire quickly so new registrations show up soon even without invalidation
+
+    :param recipient: Recipient's username
+    :param exists: Whether the user exists
+
+    :return: None
+    """
+    _recipient_cache.set(recipient, exists, None if exists else RECIPIENT_NEGATIVE_TTL)
+
+
 class MessagingManager:
     """
     Handles message operations
     """
 
-    def __init__(self, db_manager: DatabaseManager) -> None:
+    def __init__(self,
+                 db_manager: StorageBackend,
+                 session_manager: Optional[SessionManager] = None,
+                 inbox_cache: Optional[InboxCache] = None) -> None:
         """
-        Initializes the MessagingManager with a database manager
+        Initializes the MessagingManager with a storage backend
 
-        :param db_manager: DatabaseManager instance
+        :param db_manager: StorageBackend instance (DatabaseManager or InMemoryBackend)
+        :param session_manager: Optional SessionManager resolving session tokens passed as identities
+        :param inbox_cache: Optional local InboxCache the inbox pages are served from (synced on the first page)
 
         :return: None
         """
         self.db_manager = db_manager
-        self.messages_collection = db_manager.get_messages_collection()
+        self.users = db_manager.get_user_repository()
+        self.messages = db_manager.get_message_repository()
+        self.summaries = db_manager.get_summary_repository()
+        self.feed = db_manager.get_message_feed()
         self.encryption_manager = EncryptionManager()
+        self.session_manager = session_manager
+        self.inbox_cache = inbox_cache
+
+
+    def resolve_username(self, identity: Union[User, str]) -> str:
+        """
+        Resolves the acting user's username from a User, a session token or a plain username
+
+        :param identity: User object, session token or username
 
+        :return: Username
 
-    def send_message(self, sender: str, recipient: str, content: str, encryption_key: str) -> bool:
+        :raises PermissionError: If a session token is unknown or expired
+        """
+
+        # Authenticated user object: use its username
+        if isinstance(identity, User):
+            return identity.username
+
+        # Plain username (or no session support): use as is
+        if self.session_manager is None or not is_session_token(identity):
+            return identity
+
+        user = self.session_manager.resolve(identity)
+
+        # Unknown or expired session: refuse
+        if user is None:
+            raise PermissionError('Invalid or expired session')
+
+        return user.username
+
+
+    @instrumented
+    def send_message(self,
+                     sender: Union[User, str],
+                     recipient: str,
+                     content: str,
+                     encryption_key: str) -> bool:
         """
         Sends an encrypted message
 
-        :param sender: Sender's username
+        :param sender: Sender's username, User or session token
         :param recipient: Recipient's username
         :param content: Message content
         :param encryption_key: Key to encrypt the message
@@ -46,15 +372,15 @@ class MessagingManager:
         """
         try:
 
-            # Get users collection
-            users_collection = self.db_manager.get_users_collection()
+            # Resolve the sending user
+            sender = self.resolve_username(sender)
 
             # Verify recipient exists
-            if not users_collection.find_one({'username': recipient}):
+            if not self.recipient_exists(recipient):
                 return False
 
-            # Encrypt content
-            encrypted_content = self.encryption_manager.encrypt(content, encryption_key)
+            # Compress (when enabled and worthwhile) and encrypt content
+            encrypted_content, compression = self.encryption_manager.encrypt_compressed(content, encryption_key)
 
             # Create message object
             message = Message(
@@ -62,52 +388,427 @@ class MessagingManager:
                 recipient=recipient,
                 encrypted_content=encrypted_content,
                 timestamp=datetime.now(),
-                read=False
+                read=False,
+                compression=compression
             )
             
             # Store message in database
-            self.messages_collection.insert_one(message.to_dict())
+            message_data = message.to_dict()
+            self.messages.insert(message_data)
+
+            # Count it in the recipient's inbox summary and announce it to in-process subscribers
+            self.update_summaries([SummaryChange(recipient, sender, 1, message.timestamp)])
+            self.feed.publish([message_data])
 
             # Return success
             return True
         
         # Errors during encryption or database operations: print and return False
         except Exception as e:
-            print(f'Error sending message: {e}')
+            print(f'Error sending message: {e}', file=sys.stderr)
+            record_error('MessagingManager.send_message')
+            return False
+
+
+    @instrumented
+    def send_stream(self,
+                    sender: Union[User, str],
+                    recipient: str,
+                    body: BinaryIO,
+                    encryption_key: str,
+                    chunk_size: int = STREAM_CHUNK_SIZE) -> bool:
+        """
+        Sends a large body without holding it in memory
+        Reads and encrypts it in fixed-size authenticated chunks stored next to the message,
+        so its size is not limited by the 16 MB document limit
+
+        :param sender: Sender's username, User or session token
+        :param recipient: Recipient's username
+        :param body: Binary file-like object holding the message body
+        :param encryption_key: Key to encrypt the message
+        :param chunk_size: Plain text bytes per chunk
+
+        :return: True if sent successfully, False otherwise
+        """
+        try:
+
+            # Resolve the sending user
+            sender = self.resolve_username(sender)
+
+            # Verify recipient exists
+            if not self.recipient_exists(recipient):
+                return False
+
+            # Chunks are stored first, under the ID the message will have
+            message_id = ObjectId()
+            nonce_prefix, chunks = self.encryption_manager.encrypt_stream(body, encryption_key, chunk_size)
+
+            try:
+                chunk_count = self.messages.insert_chunks(message_id, chunks)
+
+                # Message stored last, so the inbox never lists a body that is not fully written
+                message = Message(
+                    sender=sender,
+                    recipient=recipient,
+                    encrypted_content=None,
+                    timestamp=datetime.now(),
+                    read=False,
+                    _id=message_id,
+                    stream={'nonce': nonce_prefix, 'chunk_size': chunk_size, 'chunks': chunk_count}
+                )
+                message_data = message.to_dict()
+                self.messages.insert(message_data)
+
+            # Failure midway: drop the chunks already written
+            except Exception:
+                self.messages.delete_chunks(message_id)
+                raise
+
+            # Count it in the recipient's inbox summary and announce it to in-process subscribers
+            self.update_summaries([SummaryChange(recipient, sender, 1, message.timestamp)])
+            self.feed.publish([message_data])
+
+            # Return success
+            return True
+
+        # Errors reading the body, encrypting or storing: print and return False
+        except Exception as e:
+            print(f'Error sending message: {e}', file=sys.stderr)
+            record_error('MessagingManager.send_stream')
             return False
 
 
-    def get_unread_messages(self, username: str) -> List[Message]:
+    @instrumented
+    def recipient_exists(self, recipient: str) -> bool:
+        """
+        Checks whether a recipient exists, using the known-recipient cache first
+
+        :param recipient: Recipient's username
+
+        :return: True if the user exists, False otherwise
+        """
+        exists = cached_recipient(recipient)
+
+        # Cache hit (positive or negative): no round trip
+        if exists is not None:
+            return exists
+
+        # Cache miss: only the _id is needed to prove existence
+        exists = self.users.exists(recipient)
+
+        # Remember the answer for later sends
+        cache_recipient(recipient, exists)
+        return exists
+
+
+    @staticmethod
+    def invalidate_recipient(username: str) -> None:
+        """
+        Drops a username from the known-recipient cache (e.g. after registration)
+
+        :param username: Username to invalidate
+
+        :return: None
+        """
+        _recipient_cache.evict(username)
+
+
+    @instrumented
+    def send_bulk(self,
+                  sender: Union[User, str],
+                  recipients: Union[Iterable[str], Mapping[str, str]],
+                  content: str,
+                  encryption_key: Optional[str] = None) -> BulkSendResult:
+        """
+        Sends the same message to many recipients
+        Checks all uncached recipients with one lookup, encrypts once per distinct key
+        and writes the messages with one bulk insert
+
+        :param sender: Sender's username, User or session token
+        :param recipients: Recipients' usernames, or a mapping of recipient username to encryption key
+        :param content: Message content
+        :param encryption_key: Key shared by all recipients (when recipients is not a mapping)
+
+        :return: BulkSendResult with delivered, unknown and failed recipients
+
+        :raises PermissionError: If a session token is unknown or expired
+        :raises ValueError: If recipients is not a mapping and no encryption_key is given
+        """
+
+        # Recipients without keys and no shared key: nothing to encrypt with
+        if not isinstance(recipients, Mapping) and encryption_key is None:
+            raise ValueError('encryption_key is required unless recipients maps each recipient to a key')
+
+        sender = self.resolve_username(sender)
+
+        # Resolve the key of each recipient, dropping duplicates but keeping order
+        if isinstance(recipients, Mapping):
+            recipient_keys = dict(recipients)
+        else:
+            recipient_keys = dict.fromkeys(recipients, encryption_key)
+
+        # Nothing to send: empty result
+        if not recipient_keys:
+            return BulkSendResult([], [], [])
+
+        # Split recipients into cached answers and ones still to look up
+        existing = set()
+        missing = []
+        for recipient in recipient_keys:
+            exists = cached_recipient(recipient)
+            if exists is None:
+                missing.append(recipient)
+            elif exists:
+                existing.add(recipient)
+
+        # Verify every uncached recipient with a single lookup
+        if missing:
+            found = self.users.existing_usernames(missing)
+            existing.update(found)
+
+            # Remember the answers for later sends
+            for recipient in missing:
+                cache_recipient(recipient, recipient in found)
+
+        unknown = [recipient for recipient in recipient_keys if recipient not in existing]
+
+        # Encrypt the payload once per distinct key (with the compression applied to it)
+        ciphertexts: Dict[str, Tuple[str, Optional[str]]] = {}
+        for recipient, key in recipient_keys.items():
+            if recipient in existing and key not in ciphertexts:
+                ciphertexts[key] = self.encryption_manager.encrypt_compressed(content, key)
+
+        # Build one message document per known recipient
+        timestamp = datetime.now()
+        targets = [recipient for recipient in recipient_keys if recipient in existing]
+        documents = [
+            Message(
+                sender=sender,
+                recipient=recipient,
+                encrypted_content=ciphertexts[recipient_keys[recipient]][0],
+                timestamp=timestamp,
+                read=False,
+                compression=ciphertexts[recipient_keys[recipient]][1]
+            ).to_dict()
+            for recipient in targets
+        ]
+
+        # Write them all, so one failure does not stop the rest
+        failed_indexes = self.messages.insert_many(documents)
+
+        # Split known recipients into delivered and failed
+        delivered = [recipient for i, recipient in enumerate(targets) if i not in failed_indexes]
+        failed = [recipient for i, recipient in enumerate(targets) if i in failed_indexes]
+
+        # Count the delivered messages in their recipients' inbox summaries (one round trip)
+        self.update_summaries([SummaryChange(recipient, sender, 1, timestamp) for recipient in delivered])
+
+        # Announce them to in-process subscribers
+        self.feed.publish([document for i, document in enumerate(documents) if i not in failed_indexes])
+
+        # Return the outcome per recipient
+        return BulkSendResult(delivered, unknown, failed)
+
+
+    @instrumented
+    def get_unread_messages(self, username: Union[User, str]) -> List[Message]:
         """
         Gets all unread messages for a user
 
-        :param username: Recipient's username
+        :param username: Recipient's username, User or session token
 
         :return: List of unread Message objects
+
+        :raises PermissionError: If a session token is unknown or expired
         """
+        username = self.resolve_username(username)
 
         # Query unread messages
-        messages_data = self.messages_collection.find({
-            'recipient': username,
-            'read': False
-        }).sort('timestamp', -1)
+        messages_data = self.messages.find_unread(username)
 
         # Return list of Message objects
         return [Message.from_dict(msg) for msg in messages_data]
 
 
-    def read_message(self, message_id, encryption_key: str) -> Optional[str]:
+    @instrumented
+    def get_unread_page(self,
+                        username: Union[User, str],
+                        page_size: int = 20,
+                        continuation_token: Optional[str] = None) -> Tuple[List[Message], Optional[str]]:
+        """
+        Gets one page of unread message headers for a user, newest first
+        Pages on (timestamp, _id), so each page costs the same whatever its depth
+        With an inbox cache, the first page syncs the cache and every page is read from it
+
+        :param username: Recipient's username, User or session token
+        :param page_size: Maximum number of messages in the page
+        :param continuation_token: Token returned with the previous page (None for the first page)
+
+        :return: Tuple of (Message objects loading encrypted content on access, token for the next page or None)
+
+        :raises PermissionError: If a session token is unknown or expired
+        :raises ValueError: If page_size is below 1 or the continuation token is malformed
+        """
+        check_page_size(page_size)
+        username = self.resolve_username(username)
+        after = decode_continuation_token(continuation_token) if continuation_token is not None else None
+        messages_data = None
+
+        # Local cache: sync it when the inbox is opened, then page locally
+        if self.inbox_cache is not None:
+            try:
+                if continuation_token is None:
+                    self.sync_inbox_cache(username)
+                messages_data = self.inbox_cache.find_unread_page(username, after, page_size + 1)
+
+            # Unusable cache: page from the server this time
+            except sqlite3.Error as e:
+                print(f'Error reading the inbox cache: {e}', file=sys.stderr)
+
+        # Fetch one extra header to know whether another page exists
+        if messages_data is None:
+            messages_data = self.messages.find_unread_page(username, after, page_size + 1)
+        messages = [Message.from_dict(msg, self.load_encrypted_content) for msg in messages_data]
+
+        # Return the page and its continuation token
+        return split_page(messages, page_size)
+
+
+    def sync_inbox_cache(self, username: Union[User, str]) -> int:
+        """
+        Brings the local inbox cache of a user up to date with what changed since the last sync, in two queries:
+        the IDs of the messages read since (they drop out), then the full documents of the unread messages sent
+        or marked unread again since (they come in). Both go through indexes on the change times (timestamp,
+        read_changed_at), so a sync costs O(changes), whatever the number of unread messages
+        The look back starts INBOX_CACHE_SYNC_OVERLAP seconds before the last sync, for writes still in flight
+
+        :param username: Recipient's username, User or session token
+
+        :return: Number of messages fetched
+
+        :raises PermissionError: If a session token is unknown or expired
+        :raises sqlite3.Error: If the cache cannot be read or written
+        """
+        username = self.resolve_username(username)
+        synced_at = self.inbox_cache.synced_at(username)
+
+        # Start time at the millisecond precision BSON keeps, so changes stamped in the same millisecond are included
+        now = datetime.now()
+        started = now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+        # Synced before: only the changes since (overlapping a little; applying a change twice is harmless)
+        if synced_at is not None:
+            since = synced_at - timedelta(seconds=INBOX_CACHE_SYNC_OVERLAP)
+            removed = self.messages.find_read_since(username, since)
+
+        # Never synced: take the whole unread inbox (cached leftovers are replaced)
+        else:
+            since = None
+            removed = self.inbox_cache.message_ids(username)
+
+        added = self.messages.find_unread_since(username, since)
+        self.inbox_cache.apply(username, added, removed, started)
+        return len(added)
+
+
+    def discard_cached(self, message_ids: List[ObjectId]) -> None:
+        """
+        Drops messages just read from the local inbox cache (the next sync would too, one query later)
+
+        :param message_ids: IDs of the messages
+
+        :return: None
+        """
+
+        # No cache or nothing read: nothing to do
+        if self.inbox_cache is None or not message_ids:
+            return
+
+        try:
+            self.inbox_cache.discard(message_ids)
+
+        # Cache write failed: the next sync removes them
+        except sqlite3.Error as e:
+            print(f'Error updating the inbox cache: {e}', file=sys.stderr)
+
+
+    def iter_unread_messages(self, username: Union[User, str], page_size: int = 100) -> Iterator[Message]:
+        """
+        Streams unread message headers for a user, newest first, one page at a time
+
+        :param username: Recipient's username, User or session token
+        :param page_size: Number of messages fetched per round trip
+
+        :return: Iterator of Message objects loading encrypted content on access
+
+        :raises PermissionError: If a session token is unknown or expired
+        :raises ValueError: If page_size is below 1 (when iteration starts)
+        """
+        check_page_size(page_size)
+        username = self.resolve_username(username)
+        continuation_token = None
+
+        while True:
+            messages, continuation_token = self.get_unread_page(username, page_size, continuation_token)
+            yield from messages
+
+            # Last page reached: stop
+            if continuation_token is None:
+                return
+
+
+    def subscribe(self, username: Union[User, str], name: Optional[str] = None) -> InboxSubscription:
+        """
+        Subscribes to a user's new messages, pushed as they are stored instead of re-querying the inbox
+        With a name, resumes after the last message handled by the previous subscription under that name
+
+        :param username: Recipient's username, User or session token
+        :param name: Subscriber name the position is saved under (None: start from now, save nothing)
+
+        :return: InboxSubscription (check resumed: when False, list the inbox once for what came before)
+
+        :raises PermissionError: If a session token is unknown or expired
+        """
+        username = self.resolve_username(username)
+        position_key = f'{username}:{name}' if name is not None else None
+        resume_token = self.feed.load_position(position_key) if position_key is not None else None
+
+        return InboxSubscription(self, self.feed.subscribe(username, resume_token), position_key)
+
+
+    @instrumented
+    def load_encrypted_content(self, message_id: ObjectId) -> Optional[str]:
+        """
+        Fetches only the encrypted content of a message
+
+        :param message_id: ID of the message
+
+        :return: Encrypted content (as a Fernet token, whatever its storage format), or None if not found
+        """
+        return decode_content(self.messages.get_encrypted_content(message_id))
+
+
+    @instrumented
+    def read_message(self,
+                     message_id,
+                     encryption_key: str,
+                     reader: Optional[Union[User, str]] = None) -> Optional[str]:
         """
         Reads and decrypts a message, marks it as read
+        Fetches and acknowledges in a single round trip
 
         :param message_id: ID of the message to read
         :param encryption_key: Key to decrypt the message
+        :param reader: Optional username, User or session token; the message must then be addressed to them
 
         :return: Decrypted message content, or None if not found/decryption fails
+
+        :raises PermissionError: If a session token is unknown or expired
         """
+        recipient = self.resolve_username(reader) if reader is not None else None
 
-        # Fetch message from database
-        message_data = self.messages_collection.find_one({'_id': message_id})
+        # Fetch and acknowledge in one round trip (document as it was before the update)
+        message_data = self.messages.acknowledge(message_id, recipient)
 
         # If message not found, return None
         if not message_data:
@@ -116,20 +817,215 @@ class MessagingManager:
         # Convert to Message object
         message = Message.from_dict(message_data)
 
+        # Streamed body: decrypt through a buffer (read_stream keeps memory flat instead)
+        if message.stream is not None:
+            buffer = io.BytesIO()
+            written = self.encryption_manager.decrypt_stream(message.stream['nonce'],
+                                                             self.messages.iter_chunks(message_id),
+                                                             encryption_key,
+                                                             buffer)
+            decrypted_content = buffer.getvalue().decode(errors='replace') if written is not None else None
+
         # Decrypt content
-        decrypted_content = self.encryption_manager.decrypt(
-            message.encrypted_content,
-            encryption_key
-        )
+        else:
+            decrypted_content = self.encryption_manager.decrypt(
+                message.encrypted_content,
+                encryption_key,
+                message.compression
+            )
 
-        # If decryption successful: mark message as read
-        if decrypted_content:
+        # Decryption failed on an unread message: undo the acknowledgement (rare, wrong-key path)
+        if decrypted_content is None and not message.read:
+            self.messages.mark_unread(message_id)
 
-            # Mark as read
-            self.messages_collection.update_one(
-                {'_id': message_id},
-                {'$set': {'read': True}}
-            )
+        # Unread message read: one less in the summary (acknowledge is atomic, so only one reader counts it)
+        elif not message.read:
+            self.update_summaries([SummaryChange(message.recipient, message.sender, -1)])
+            self.discard_cached([message_id])
 
         # Return decrypted content
         return decrypted_content
+
+
+    @instrumented
+    def read_stream(self,
+                    message_id: ObjectId,
+                    encryption_key: str,
+                    writer: BinaryIO,
+                    reader: Optional[Union[User, str]] = None) -> bool:
+        """
+        Reads a message into a writer and marks it as read
+        Streamed bodies are fetched and decrypted a few chunks at a time, so memory stays flat
+
+        :param message_id: ID of the message to read
+        :param encryption_key: Key to decrypt the message
+        :param writer: Binary file-like object receiving the plain text (UTF-8 for inline messages)
+        :param reader: Optional username, User or session token; the message must then be addressed to them
+
+        :return: True if the whole body was written, False if not found/decryption fails
+
+        :raises PermissionError: If a session token is unknown or expired
+        """
+        recipient = self.resolve_username(reader) if reader is not None else None
+
+        # Fetch and acknowledge in one round trip (document as it was before the update)
+        message_data = self.messages.acknowledge(message_id, recipient)
+
+        # If message not found, return False
+        if not message_data:
+            return False
+
+        message = Message.from_dict(message_data)
+
+        # Streamed body: verify and write chunk by chunk
+        if message.stream is not None:
+            written = self.encryption_manager.decrypt_stream(message.stream['nonce'],
+                                                             self.messages.iter_chunks(message_id),
+                                                             encryption_key,
+                                                             writer)
+
+        # Inline body: decrypt it whole
+        else:
+            decrypted_content = self.encryption_manager.decrypt(message.encrypted_content, encryption_key,
+                                                                message.compression)
+            written = writer.write(decrypted_content.encode()) if decrypted_content is not None else None
+
+        # Decryption failed on an unread message: undo the acknowledgement
+        if written is None and not message.read:
+            self.messages.mark_unread(message_id)
+
+        # Unread message read: one less in the summary
+        elif not message.read:
+            self.update_summaries([SummaryChange(message.recipient, message.sender, -1)])
+            self.discard_cached([message_id])
+
+        return written is not None
+
+
+    @instrumented
+    def read_messages_bulk(self,
+                           message_ids: Iterable[ObjectId],
+                           encryption_key: str,
+                           reader: Optional[Union[User, str]] = None) -> Dict[ObjectId, Optional[str]]:
+        """
+        Reads and decrypts a set of messages, marking every successful one as read
+        Uses one fetch, one batch decryption and one update whatever the number of messages
+        (streamed bodies are read one by one through read_message)
+
+        :param message_ids: IDs of the messages to read
+        :param encryption_key: Key to decrypt the messages
+        :param reader: Optional username, User or session token; only messages addressed to them are read
+
+        :return: Dictionary of message ID to decrypted content (None if not found/decryption fails)
+
+        :raises PermissionError: If a session token is unknown or expired
+        """
+        recipient = self.resolve_username(reader) if reader is not None else None
+        message_ids = list(dict.fromkeys(message_ids))
+        results: Dict[ObjectId, Optional[str]] = dict.fromkeys(message_ids)
+
+        # Nothing to read: empty result
+        if not message_ids:
+            return results
+
+        # Fetch only what decryption needs, keeping the reader's own messages (others read as not found)
+        messages_data = [message_data for message_data in self.messages.get_encrypted_contents(message_ids)
+                         if recipient is None or message_data['recipient'] == recipient]
+
+        # Streamed bodies: no inline ciphertext to batch, read each from its chunks
+        for message_data in messages_data:
+            if message_data.get('stream') is not None:
+                results[message_data['_id']] = self.read_message(message_data['_id'], encryption_key, recipient)
+        messages_data = [message_data for message_data in messages_data if message_data.get('stream') is None]
+
+        # Decrypt the whole set at once
+        decrypted = self.encryption_manager.decrypt_many(
+            [decode_content(message_data['encrypted_content']) for message_data in messages_data],
+            encryption_key,
+            [message_data.get('compression') for message_data in messages_data]
+        )
+
+        # Collect successful decryptions, counting the unread ones per recipient and sender
+        read_ids = []
+        unread_counts: Dict[Tuple[str, str], int] = {}
+        for message_data, result in zip(messages_data, decrypted):
+            if result.ok:
+                results[message_data['_id']] = result.value
+                read_ids.append(message_data['_id'])
+                if not message_data['read']:
+                    key = (message_data['recipient'], message_data['sender'])
+                    unread_counts[key] = unread_counts.get(key, 0) + 1
+
+        # Mark every successfully decrypted message as read in one round trip
+        if read_ids:
+            marked = self.messages.mark_read(read_ids)
+            self.discard_cached(read_ids)
+
+            # Exactly the unread ones seen were marked: decrement the summaries by them
+            if marked == sum(unread_counts.values()):
+                self.update_summaries([SummaryChange(recipient, sender, -count)
+                                       for (recipient, sender), count in unread_counts.items()])
+
+            # A concurrent reader marked some first: recount the recipients involved instead of guessing
+            else:
+                for recipient in {recipient for recipient, _ in unread_counts}:
+                    self.repair_inbox_summaries(recipient)
+
+        # Return content per requested ID
+        return results
+
+
+    def update_summaries(self, changes: List[SummaryChange]) -> None:
+        """
+        Applies inbox summary changes after a message write
+        The message write already succeeded, so a failure here is reported but not raised
+        (the summary drifts until the next repair)
+
+        :param changes: Changes to apply
+
+        :return: None
+        """
+        try:
+            self.summaries.apply(changes)
+
+        # Errors updating summaries: print and carry on
+        except Exception as e:
+            print(f'Error updating inbox summary: {e}', file=sys.stderr)
+            record_error('MessagingManager.update_summaries')
+
+
+    @instrumented
+    def get_inbox_summary(self, username: Union[User, str]) -> InboxSummary:
+        """
+        Returns a user's unread count, last message time and unread count per sender
+        Reads one summary document by key, whatever the size of the inbox
+
+        :param username: Recipient's username, User or session token
+
+        :return: InboxSummary (zero unread if the user never received a message)
+
+        :raises PermissionError: If a session token is unknown or expired
+        """
+        summary = self.summaries.get(self.resolve_username(username))
+
+        # No summary yet: empty inbox
+        if summary is None:
+            return InboxSummary(0, None, {})
+
+        return InboxSummary(summary['unread'], summary.get('last_message_at'), summary['senders'])
+
+
+    @instrumented
+    def repair_inbox_summaries(self, recipient: Optional[str] = None) -> int:
+        """
+        Recomputes inbox summaries from the messages (one aggregation) and replaces the stored ones
+        Sends and reads landing while it runs may be missed; run it per recipient or at a quiet time
+
+        :param recipient: Only repair this recipient's summary (every summary if None)
+
+        :return: Number of summaries written
+        """
+        started = datetime.now()
+        summaries = fold_unread_counts(self.messages.unread_counts(recipient))
+        self.summaries.replace(summaries, started, recipient)
+        return len(summaries)
@@ -0,0 +1,476 @@
+"""
+Operation and MongoDB command metrics (latency histograms, counters, error counts)
+Disabled by default; enable with CIPHERMAIL_METRICS=true before the services are imported
+"""
+
+# --- IMPORTS ---
+from pymongo import monitoring
+
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+
+# --- TYPES ---
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+from typing import TypeVar
+
+
+# --- GLOBALS ---
+# Whether operations and commands are measured (checked once, when methods are decorated)
+METRICS_ENABLED = os.getenv('CIPHERMAIL_METRICS', 'false').lower() in ('1', 'true', 'yes')
+
+# Optional periodic snapshot file (.json for JSON, anything else for Prometheus text) and its interval
+METRICS_FILE = os.getenv('CIPHERMAIL_METRICS_FILE')
+METRICS_INTERVAL = float(os.getenv('CIPHERMAIL_METRICS_INTERVAL', '15'))
+
+# Latency histogram bucket upper bounds, in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+F = TypeVar('F', bound=Callable[..., Any])
+
+
+# --- CODE ---
+class Histogram:
+    """
+    Cumulative latency histogram with fixed buckets (Prometheus semantics)
+    """
+
+    __slots__ = ('buckets', 'counts', 'total', 'count')
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        """
+        Initializes an empty histogram
+
+        :param buckets: Bucket upper bounds, ascending (+Inf is implicit)
+
+        :return: None
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+
+    def observe(self, value: float) -> None:
+        """
+        Records one value (caller holds the registry lock)
+
+        :param value: Observed value, in seconds
+
+        :return: None
+        """
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+
+        self.total += value
+        self.count += 1
+
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        """
+        Returns cumulative counts per bucket, +Inf last
+
+        :return: List of (upper bound label, count) tuples
+        """
+        cumulative = []
+        running = 0
+
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            running += count
+            cumulative.append(('+Inf' if bound == float('inf') else repr(bound), running))
+
+        return cumulative
+
+
+class MetricsRegistry:
+    """
+    Process-wide store of operation and command metrics
+    """
+
+    def __init__(self) -> None:
+        """
+        Initializes an empty registry
+
+        :return: None
+        """
+        self.lock = threading.Lock()
+        self.operations: Dict[str, Histogram] = {}
+        self.operation_errors: Dict[str, int] = {}
+        self.commands: Dict[str, Histogram] = {}
+        self.command_documents: Dict[str, int] = {}
+        self.command_failures: Dict[str, int] = {}
+
+
+    def observe_operation(self, operation: str, seconds: float) -> None:
+        """
+        Records the duration of one service operation
+
+        :param operation: Operation name (e.g. 'MessagingManager.send_message')
+        :param seconds: Duration
+
+        :return: None
+        """
+        with self.lock:
+            histogram = self.operations.get(operation)
+            if histogram is None:
+                histogram = self.operations[operation] = Histogram()
+            histogram.observe(seconds)
+
+
+    def record_error(self, operation: str) -> None:
+        """
+        Counts a failed service operation
+
+        :param operation: Operation name
+
+        :return: None
+        """
+        with self.lock:
+            self.operation_errors[operation] = self.operation_errors.get(operation, 0) + 1
+
+
+    def observe_command(self, command: str, seconds: float, documents: int, failed: bool) -> None:
+        """
+        Records one MongoDB command
+
+        :param command: Command name (e.g. 'find')
+        :param seconds: Duration reported by the driver
+        :param documents: Documents returned or affected
+        :param failed: Whether the command failed
+
+        :return: None
+        """
+        with self.lock:
+            histogram = self.commands.get(command)
+            if histogram is None:
+                histogram = self.commands[command] = Histogram()
+            histogram.observe(seconds)
+            self.command_documents[command] = self.command_documents.get(command, 0) + documents
+            if failed:
+                self.command_failures[command] = self.command_failures.get(command, 0) + 1
+
+
+    def reset(self) -> None:
+        """
+        Drops every recorded value
+
+        :return: None
+        """
+        with self.lock:
+            self.operations.clear()
+            self.operation_errors.clear()
+            self.commands.clear()
+            self.command_documents.clear()
+            self.command_failures.clear()
+
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        Returns the recorded values as plain data
+
+        :return: Dictionary with 'operations' and 'commands' entries
+        """
+        with self.lock:
+            return {
+                'operations': {
+                    name: {'count': histogram.count, 'sum': histogram.total,
+                           'errors': self.operation_errors.get(name, 0),
+                           'buckets': dict(histogram.cumulative())}
+                    for name, histogram in self.operations.items()
+                },
+                'commands': {
+                    name: {'count': histogram.count, 'sum': histogram.total,
+                           'documents': self.command_documents.get(name, 0),
+                           'failures': self.command_failures.get(name, 0),
+                           'buckets': dict(histogram.cumulative())}
+                    for name, histogram in self.commands.items()
+                },
+            }
+
+
+    def to_prometheus(self) -> str:
+        """
+        Renders the recorded values in the Prometheus text exposition format
+
+        :return: Prometheus text snapshot
+        """
+        snapshot = self.snapshot()
+        lines = []
+
+        def histogram_lines(metric: str, label: str, entries: Dict[str, Dict[str, Any]]) -> None:
+            lines.append(f'# TYPE {metric} histogram')
+            for name, entry in entries.items():
+                for bound, count in entry['buckets'].items():
+                    lines.append(f'{metric}_bucket{{{label}="{name}",le="{bound}"}} {count}')
+                lines.append(f'{metric}_sum{{{label}="{name}"}} {entry["sum"]}')
+                lines.append(f'{metric}_count{{{label}="{name}"}} {entry["count"]}')
+
+        def counter_lines(metric: str, label: str, entries: Dict[str, Dict[str, Any]], field: str) -> None:
+            lines.append(f'# TYPE {metric} counter')
+            for name, entry in entries.items():
+                lines.append(f'{metric}{{{label}="{name}"}} {entry[field]}')
+
+        histogram_lines('ciphermail_operation_duration_seconds', 'operation', snapshot['operations'])
+        counter_lines('ciphermail_operation_errors_total', 'operation', snapshot['operations'], 'errors')
+        histogram_lines('ciphermail_mongodb_command_duration_seconds', 'command', snapshot['commands'])
+        counter_lines('ciphermail_mongodb_command_documents_total', 'command', snapshot['commands'], 'documents')
+        counter_lines('ciphermail_mongodb_command_failures_total', 'command', snapshot['commands'], 'failures')
+
+        return '\n'.join(lines) + '\n'
+
+
+# Process-wide registry
+_registry = MetricsRegistry()
+
+
+def get_metrics_registry() -> MetricsRegistry:
+    """
+    Returns the process-wide metrics registry
+
+    :return: MetricsRegistry instance
+    """
+    return _registry
+
+
+def instrumented(function: F) -> F:
+    """
+    Decorator measuring a service method: latency histogram, call count and raised errors
+    When metrics are disabled the method is returned untouched, so it costs nothing
+
+    :param function: Method to measure (named after its qualified name, e.g. 'AuthManager.login')
+
+    :return: Measured method, or the method itself when metrics are disabled
+    """
+
+    # Disabled: no wrapper at all
+    if not METRICS_ENABLED:
+        return function
+
+    operation = function.__qualname__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+
+        # Raised error: count it and let it propagate
+        except Exception:
+            _registry.record_error(operation)
+            raise
+
+        finally:
+            _registry.observe_operation(operation, time.perf_counter() - start)
+
+    return wrapper
+
+
+def record_error(operation: str) -> None:
+    """
+    Counts an error a service method handled itself (e.g. returned False instead of raising)
+
+    :param operation: Operation name, as used by instrumented()
+
+    :return: None
+    """
+
+    # Disabled: nothing to count
+    if not METRICS_ENABLED:
+        return
+
+    _registry.record_error(operation)
+
+
+def reply_documents(reply: Dict[str, Any]) -> int:
+    """
+    Counts the documents a command reply returned or affected
+
+    :param reply: Command reply document
+
+    :return: Number of documents
+    """
+    cursor = reply.get('cursor')
+
+    # find / aggregate / getMore: documents in this batch
+    if isinstance(cursor, dict):
+        return len(cursor.get('firstBatch', cursor.get('nextBatch', [])))
+
+    # findAndModify: one document if it matched
+    if 'value' in reply:
+        return 1 if reply['value'] is not None else 0
+
+    # insert / update / delete / count: affected documents
+    return int(reply.get('n', 0))
+
+
+class CommandMetricsListener(monitoring.CommandListener):
+    """
+    Records duration and document counts of every command a MongoDB client sends
+    """
+
+    def __init__(self, registry: Optional[MetricsRegistry] = None) -> None:
+        """
+        Initializes the listener
+
+        :param registry: MetricsRegistry to record into (process-wide registry by default)
+
+        :return: None
+        """
+        self.registry = registry or _registry
+
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        """
+        Ignores command starts (durations come with the outcome)
+
+        :param event: Command started event
+
+        :return: None
+        """
+        return None
+
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        """
+        Records a successful command
+
+        :param event: Command succeeded event
+
+        :return: None
+        """
+        self.registry.observe_command(event.command_name, event.duration_micros / 1e6,
+                                      reply_documents(event.reply), False)
+
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        """
+        Records a failed command
+
+        :param event: Command failed event
+
+        :return: None
+        """
+        self.registry.observe_command(event.command_name, event.duration_micros / 1e6, 0, True)
+
+
+def client_event_listeners() -> Dict[str, Any]:
+    """
+    Builds the MongoClient keyword arguments registering the command listener
+
+    :return: {'event_listeners': [...]} when metrics are enabled, {} otherwise (no listener overhead)
+    """
+
+    # Disabled: the driver publishes no command events at all
+    if not METRICS_ENABLED:
+        return {}
+
+    return {'event_listeners': [CommandMetricsListener()]}
+
+
+def write_metrics_file(path: str) -> None:
+    """
+    Writes a snapshot atomically (readers never see a partial file)
+
+    :param path: Output path (.json for JSON, anything else for Prometheus text)
+
+    :return: None
+    """
+    if path.endswith('.json'):
+        content = json.dumps(_registry.snapshot(), indent=2)
+    else:
+        content = _registry.to_prometheus()
+
+    temporary_path = f'{path}.tmp'
+    with open(temporary_path, 'w') as output:
+        output.write(content)
+    os.replace(temporary_path, path)
+
+
+class MetricsFileWriter:
+    """
+    Writes a metrics snapshot to a file periodically from a daemon thread
+    """
+
+    def __init__(self, path: str, interval: float = METRICS_INTERVAL) -> None:
+        """
+        Initializes the writer
+
+        :param path: Output path (.json for JSON, anything else for Prometheus text)
+        :param interval: Seconds between snapshots
+
+        :return: None
+        """
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='metrics-writer', daemon=True)
+
+
+    def run(self) -> None:
+        """
+        Writes a snapshot every interval until stopped
+
+        :return: None
+        """
+        while not self.stopped.wait(self.interval):
+            try:
+                write_metrics_file(self.path)
+
+            # Unwritable file: report and keep the application running
+            except OSError as e:
+                print(f'Error writing metrics: {e}', file=sys.stderr)
+
+
+    def start(self) -> 'MetricsFileWriter':
+        """
+        Starts the background thread
+
+        :return: The writer itself
+        """
+        self.thread.start()
+        return self
+
+
+    def stop(self) -> None:
+        """
+        Stops the background thread and writes a final snapshot
+
+        :return: None
+        """
+        self.stopped.set()
+        self.thread.join()
+
+        try:
+            write_metrics_file(self.path)
+
+        # Unwritable file: report it
+        except OSError as e:
+            print(f'Error writing metrics: {e}', file=sys.stderr)
+
+
+def start_metrics_file_writer() -> Optional[MetricsFileWriter]:
+    """
+    Starts periodic snapshots when metrics are enabled and CIPHERMAIL_METRICS_FILE is set
+
+    :return: Running MetricsFileWriter, or None
+    """
+
+    # Disabled or no file configured: nothing to write
+    if not METRICS_ENABLED or not METRICS_FILE:
+        return None
+
+    return MetricsFileWriter(METRICS_FILE).start()
@@ -0,0 +1,610 @@
+"""
+Password hashing service (pluggable KDFs and a bounded hashing worker pool)
+"""
+
+# --- IMPORTS ---
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+
+import asyncio
+import base64
+import collections
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+
+
+# --- TYPES ---
+from typing import Any
+from typing import Callable
+from typing import Deque
+from typing import Dict
+from typing import Optional
+from typing import Tuple
+
+
+# --- GLOBALS ---
+# Default KDF and scrypt cost parameters for new hashes
+PASSWORD_KDF = os.getenv('PASSWORD_KDF', 'scrypt')
+SCRYPT_LOG_N = int(os.getenv('SCRYPT_LOG_N', '14'))
+SCRYPT_R = int(os.getenv('SCRYPT_R', '8'))
+SCRYPT_P = int(os.getenv('SCRYPT_P', '1'))
+
+# Hashing workers and the maximum number of hashes queued or running at once
+PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', '0')) or os.cpu_count() or 1
+PASSWORD_HASH_QUEUE = int(os.getenv('PASSWORD_HASH_QUEUE', '0')) or PASSWORD_HASH_WORKERS * 4
+
+
+# --- CODE ---
+def _b64encode(data: bytes) -> str:
+    """
+    Encodes bytes as unpadded URL-safe base64
+
+    :param data: Bytes to encode
+
+    :return: Encoded string
+    """
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def _b64decode(data: str) -> bytes:
+    """
+    Decodes unpadded URL-safe base64
+
+    :param data: Encoded string
+
+    :return: Decoded bytes
+    """
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+class PasswordKDF:
+    """
+    Base class for password key derivation functions
+    Encoded hashes carry the KDF name and its cost parameters, so they are stored per user
+    """
+
+    name = ''
+
+
+    def hash(self, password: str) -> str:
+        """
+        Hashes a password with a fresh salt
+
+        :param password: Plain text password
+
+        :return: Encoded hash
+        """
+        raise NotImplementedError
+
+
+    def verify(self, password: str, encoded: str) -> bool:
+        """
+        Checks a password against an encoded hash produced by this KDF
+
+        :param password: Plain text password
+        :param encoded: Encoded hash
+
+        :return: True if the password matches, False otherwise
+        """
+        raise NotImplementedError
+
+
+    def needs_rehash(self, encoded: str) -> bool:
+        """
+        Tells whether an encoded hash should be replaced with one using this KDF's current settings
+
+        :param encoded: Encoded hash
+
+        :return: True if the hash is outdated, False otherwise
+        """
+        return True
+
+
+class LegacySha256KDF(PasswordKDF):
+    """
+    Unsalted SHA256 hex digest used before scrypt (upgraded on next login unless it is PASSWORD_KDF)
+    """
+
+    name = 'sha256'
+
+
+    def hash(self, password: str) -> str:
+        """
+        Hashes a password with unsalted SHA256
+
+        :param password: Plain text password
+
+        :return: Hex digest
+        """
+        return hashlib.sha256(password.encode()).hexdigest()
+
+
+    def verify(self, password: str, encoded: str) -> bool:
+        """
+        Checks a password against a SHA256 hex digest
+
+        :param password: Plain text password
+        :param encoded: Hex digest
+
+        :return: True if the password matches, False otherwise
+        """
+        return hmac.compare_digest(self.hash(password), encoded)
+
+
+    def needs_rehash(self, encoded: str) -> bool:
+        """
+        SHA256 has no cost parameters, so a SHA256 hash is never outdated relative to itself
+
+        :param encoded: Hex digest
+
+        :return: False
+        """
+        return False
+
+
+class ScryptKDF(PasswordKDF):
+    """
+    Salted, memory-hard scrypt KDF
+    Encoded as scrypt$ln=<log2 N>,r=<r>,p=<p>$<salt>$<hash>
+    """
+
+    name = 'scrypt'
+
+
+    def __init__(self,
+                 log_n: int = SCRYPT_LOG_N,
+                 r: int = SCRYPT_R,
+                 p: int = SCRYPT_P,
+                 salt_size: int = 16,
+                 key_length: int = 32) -> None:
+        """
+        Initializes the KDF with its cost parameters
+
+        :param log_n: log2 of the CPU/memory cost N
+        :param r: Block size
+        :param p: Parallelization factor
+        :param salt_size: Salt length in bytes
+        :param key_length: Derived key length in bytes
+
+        :return: None
+        """
+        self.log_n = log_n
+        self.r = r
+        self.p = p
+        self.salt_size = salt_size
+        self.key_length = key_length
+
+
+    @staticmethod
+    def _derive(password: str, salt: bytes, log_n: int, r: int, p: int, key_length: int) -> bytes:
+        """
+        Runs scrypt (OpenSSL releases the GIL while it works)
+
+        :param password: Plain text password
+        :param salt: Salt bytes
+        :param log_n: log2 of the CPU/memory cost N
+        :param r: Block size
+        :param p: Parallelization factor
+        :param key_length: Derived key length in bytes
+
+        :return: Derived key
+        """
+        n = 1 << log_n
+        return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p,
+                              maxmem=256 * n * r + (1 << 20), dklen=key_length)
+
+
+    @staticmethod
+    def parse(encoded: str) -> Optional[dict]:
+        """
+        Splits an encoded scrypt hash into its parts
+
+        :param encoded: Encoded hash
+
+        :return: Dictionary with log_n, r, p, salt and key, or None if malformed
+        """
+        try:
+            name, params, salt, key = encoded.split('$')
+            values = dict(item.split('=') for item in params.split(','))
+
+            # Not a scrypt hash: nothing to parse
+            if name != ScryptKDF.name:
+                return None
+
+            return {'log_n': int(values['ln']), 'r': int(values['r']), 'p': int(values['p']),
+                    'salt': _b64decode(salt), 'key': _b64decode(key)}
+
+        # Malformed hash
+        except (ValueError, KeyError):
+            return None
+
+
+    def hash(self, password: str) -> str:
+        """
+        Hashes a password with a fresh random salt
+
+        :param password: Plain text password
+
+        :return: Encoded hash
+        """
+        salt = secrets.token_bytes(self.salt_size)
+        key = self._derive(password, salt, self.log_n, self.r, self.p, self.key_length)
+        return f'{self.name}$ln={self.log_n},r={self.r},p={self.p}${_b64encode(salt)}${_b64encode(key)}'
+
+
+    def verify(self, password: str, encoded: str) -> bool:
+        """
+        Checks a password using the cost parameters stored in the hash
+
+        :param password: Plain text password
+        :param encoded: Encoded hash
+
+        :return: True if the password matches, False otherwise
+        """
+        parts = self.parse(encoded)
+
+        # Malformed hash: never matches
+        if parts is None:
+            return False
+
+        key = self._derive(password, parts['salt'], parts['log_n'], parts['r'], parts['p'], len(parts['key']))
+        return hmac.compare_digest(key, parts['key'])
+
+
+    def needs_rehash(self, encoded: str) -> bool:
+        """
+        Tells whether a hash uses other cost parameters than the current ones
+
+        :param encoded: Encoded hash
+
+        :return: True if the hash is outdated, False otherwise
+        """
+        parts = self.parse(encoded)
+        return parts is None or (parts['log_n'], parts['r'], parts['p']) != (self.log_n, self.r, self.p)
+
+
+# KDF name -> factory building it with the default cost parameters
+KDF_FACTORIES: Dict[str, Callable[[], PasswordKDF]] = {
+    ScryptKDF.name: ScryptKDF,
+    LegacySha256KDF.name: LegacySha256KDF,
+}
+
+
+def register_kdf(name: str, factory: Callable[[], PasswordKDF]) -> None:
+    """
+    Registers a KDF so hashes prefixed with its name can be verified and it can be selected by name
+
+    :param name: KDF name (prefix of its encoded hashes)
+    :param factory: Callable building the KDF with its default cost parameters
+
+    :return: None
+    """
+    KDF_FACTORIES[name] = factory
+
+
+class PendingSlots:
+    """
+    Counting semaphore shared by threads and asyncio tasks
+    Threads block in acquire(); tasks await acquire_async() without holding a thread, and a task cancelled
+    while waiting never keeps a slot
+    """
+
+    def __init__(self, size: int) -> None:
+        """
+        Initializes the slots
+
+        :param size: Number of slots
+
+        :return: None
+        """
+        self.free = size
+        self.condition = threading.Condition()
+        self.waiters: Deque[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = collections.deque()
+
+
+    def acquire(self, blocking: bool = True) -> bool:
+        """
+        Takes a slot, waiting for one if needed
+
+        :param blocking: Whether to wait while no slot is free
+
+        :return: True if a slot was taken, False otherwise (non-blocking only)
+        """
+        with self.condition:
+
+            # No free slot: give up, or wait for one
+            while self.free == 0:
+                if not blocking:
+                    return False
+                self.condition.wait()
+
+            self.free -= 1
+            return True
+
+
+    async def acquire_async(self) -> None:
+        """
+        Takes a slot from asyncio, waiting on the event loop while none is free
+
+        :return: None
+        """
+        loop = asyncio.get_running_loop()
+
+        with self.condition:
+
+            # Free slot and no task ahead in line: take it
+            if self.free > 0 and not self.waiters:
+                self.free -= 1
+                return
+
+            waiter = (loop, loop.create_future())
+            self.waiters.append(waiter)
+
+        try:
+            await waiter[1]
+
+        # Cancelled while waiting: leave the line, and give back a slot handed over in the meantime
+        except asyncio.CancelledError:
+            with self.condition:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+            if waiter[1].done() and not waiter[1].cancelled():
+                self.release()
+            raise
+
+
+    def release(self) -> None:
+        """
+        Gives a slot back, handing it to the oldest waiting task if any, or waking a waiting thread
+
+        :return: None
+        """
+        with self.condition:
+            while self.waiters:
+                loop, future = self.waiters.popleft()
+
+                # Hand the slot over on the task's loop (closed loop: that task is gone, try the next one)
+                try:
+                    loop.call_soon_threadsafe(self._grant, future)
+                    return
+                except RuntimeError:
+                    continue
+
+            self.free += 1
+            self.condition.notify()
+
+
+    def _grant(self, future: asyncio.Future) -> None:
+        """
+        Wakes a waiting task with the slot handed to it (on its loop)
+
+        :param future: Future the task awaits
+
+        :return: None
+        """
+
+        # Task cancelled before the slot reached it: pass the slot on
+        if future.cancelled():
+            self.release()
+            return
+
+        future.set_result(None)
+
+
+class PasswordHasher:
+    """
+    Hashes and verifies passwords on a bounded worker pool
+    """
+
+    def __init__(self,
+                 kdf: Optional[PasswordKDF] = None,
+                 workers: int = PASSWORD_HASH_WORKERS,
+                 max_pending: int = PASSWORD_HASH_QUEUE) -> None:
+        """
+        Initializes the hasher
+
+        :param kdf: KDF used for new hashes (PASSWORD_KDF with default costs if None)
+        :param workers: Number of hashing threads
+        :param max_pending: Maximum number of hashes queued or running; further submissions wait
+
+        :return: None
+        """
+        self.kdf = kdf or KDF_FACTORIES[PASSWORD_KDF]()
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ciphermail-kdf')
+        self._slots = PendingSlots(max_pending)
+        self._kdfs: Dict[str, PasswordKDF] = {self.kdf.name: self.kdf}
+
+
+    def kdf_for(self, encoded: str) -> Optional[PasswordKDF]:
+        """
+        Returns the KDF that produced an encoded hash
+
+        :param encoded: Encoded hash
+
+        :return: PasswordKDF instance, or None if unknown
+        """
+
+        # No prefix: legacy SHA256 hex digest
+        name = encoded.split('$', 1)[0] if '$' in encoded else LegacySha256KDF.name
+
+        # Unknown KDF: cannot verify
+        if name not in KDF_FACTORIES:
+            return None
+
+        # Build verifiers lazily and keep them
+        if name not in self._kdfs:
+            self._kdfs[name] = KDF_FACTORIES[name]()
+
+        return self._kdfs[name]
+
+
+    def _queue(self, function: Callable, *args) -> Future:
+        """
+        Queues work on the pool once a pending slot is held, releasing the slot when it finishes
+
+        :param function: Callable to run
+        :param args: Positional arguments for the callable
+
+        :return: Future with the result
+        """
+        try:
+            future = self.pool.submit(function, *args)
+
+        # Could not queue: give the slot back
+        except BaseException:
+            self._slots.release()
+            raise
+
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+
+    def _submit(self, function: Callable, *args) -> Future:
+        """
+        Queues work on the pool, waiting while max_pending hashes are in flight
+
+        :param function: Callable to run
+        :param args: Positional arguments for the callable
+
+        :return: Future with the result
+        """
+        self._slots.acquire()
+        return self._queue(function, *args)
+
+
+    async def _submit_async(self, function: Callable, *args) -> Any:
+        """
+        Runs work on the pool from asyncio, waiting for a pending slot without blocking the event loop
+
+        :param function: Callable to run
+        :param args: Positional arguments for the callable
+
+        :return: Result of the callable
+        """
+
+        await self._slots.acquire_async()
+        return await asyncio.wrap_future(self._queue(function, *args))
+
+
+    def submit_hash(self, password: str) -> Future:
+        """
+        Queues hashing of a password with the current KDF
+
+        :param password: Plain text password
+
+        :return: Future resolving to the encoded hash
+        """
+        return self._submit(self.kdf.hash, password)
+
+
+    def submit_verify(self, password: str, encoded: str) -> Future:
+        """
+        Queues verification of a password against an encoded hash
+
+        :param password: Plain text password
+        :param encoded: Encoded hash
+
+        :return: Future resolving to True if the password matches, False otherwise
+        """
+        kdf = self.kdf_for(encoded)
+
+        # Unknown KDF: resolved immediately as a mismatch
+        if kdf is None:
+            future = Future()
+            future.set_result(False)
+            return future
+
+        return self._submit(kdf.verify, password, encoded)
+
+
+    def hash(self, password: str) -> str:
+        """
+        Hashes a password on the worker pool and waits for the result
+
+        :param password: Plain text password
+
+        :return: Encoded hash
+        """
+        return self.submit_hash(password).result()
+
+
+    def verify(self, password: str, encoded: str) -> bool:
+        """
+        Verifies a password on the worker pool and waits for the result
+
+        :param password: Plain text password
+        :param encoded: Encoded hash
+
+        :return: True if the password matches, False otherwise
+        """
+        return self.submit_verify(password, encoded).result()
+
+
+    async def hash_async(self, password: str) -> str:
+        """
+        Hashes a password on the worker pool from asyncio
+
+        :param password: Plain text password
+
+        :return: Encoded hash
+        """
+        return await self._submit_async(self.kdf.hash, password)
+
+
+    async def verify_async(self, password: str, encoded: str) -> bool:
+        """
+        Verifies a password on the worker pool from asyncio
+
+        :param password: Plain text password
+        :param encoded: Encoded hash
+
+        :return: True if the password matches, False otherwise
+        """
+        kdf = self.kdf_for(encoded)
+
+        # Unknown KDF: never matches
+        if kdf is None:
+            return False
+
+        return await self._submit_async(kdf.verify, password, encoded)
+
+
+    def needs_rehash(self, encoded: str) -> bool:
+        """
+        Tells whether a stored hash should be upgraded to the current KDF and costs
+
+        :param encoded: Encoded hash
+
+        :return: True if the hash is outdated, False otherwise
+        """
+        kdf = self.kdf_for(encoded)
+        return kdf is not self.kdf or self.kdf.needs_rehash(encoded)
+
+
+# Process-wide hasher shared by the sync and async auth services
+_default_hasher: Optional[PasswordHasher] = None
+_default_hasher_lock = threading.Lock()
+
+
+def get_password_hasher() -> PasswordHasher:
+    """
+    Returns the process-wide password hasher, creating it on first use
+
+    :return: PasswordHasher instance
+    """
+    global _default_hasher
+
+    # Hasher already created: reuse it
+    if _default_hasher is not None:
+        return _default_hasher
+
+    with _default_hasher_lock:
+
+        # Create hasher if another thread did not beat us to it
+        if _default_hasher is None:
+            _default_hasher = PasswordHasher()
+
+    return _default_hasher
@@ -0,0 +1,184 @@
+"""
+Session service (opaque tokens with a bounded in-memory store and optional persistence in the storage backend)
+"""
+
+# --- IMPORTS ---
+from datetime import datetime
+from datetime import timedelta
+from ciphermail.models.user import User
+from ciphermail.services.cache import LRUCache
+from ciphermail.storage.base import StorageBackend
+
+import hashlib
+import os
+import secrets
+import sys
+
+
+# --- TYPES ---
+from typing import Optional
+from typing import Union
+
+
+# --- GLOBALS ---
+# Session lifetime (seconds), in-memory capacity and whether sessions are also stored in the backend
+SESSION_TTL = float(os.getenv('SESSION_TTL', '3600'))
+SESSION_STORE_SIZE = int(os.getenv('SESSION_STORE_SIZE', '10000'))
+SESSION_PERSIST = os.getenv('SESSION_PERSIST', 'false').lower() in ('1', 'true', 'yes')
+
+# Prefix telling session tokens apart from usernames
+TOKEN_PREFIX = 'cms_'
+
+
+# --- CODE ---
+def is_session_token(value: str) -> bool:
+    """
+    Tells whether a string is shaped like a session token
+
+    :param value: String to check
+
+    :return: True if it carries the session token prefix, False otherwise
+    """
+    return value.startswith(TOKEN_PREFIX)
+
+
+class SessionManager:
+    """
+    Issues, resolves and revokes session tokens
+    Tokens are only ever stored as SHA256 digests, in memory and in the storage backend
+    """
+
+    def __init__(self,
+                 db_manager: Optional[StorageBackend] = None,
+                 ttl: float = SESSION_TTL,
+                 max_sessions: int = SESSION_STORE_SIZE,
+                 persist: bool = SESSION_PERSIST) -> None:
+        """
+        Initializes the SessionManager
+
+        :param db_manager: Optional StorageBackend, required for persistence
+        :param ttl: Session lifetime in seconds
+        :param max_sessions: Maximum number of sessions kept in memory (least recently used evicted first)
+        :param persist: Whether sessions are also stored in the backend's session repository
+
+        :return: None
+        """
+        self.ttl = ttl
+        self.store = LRUCache(max_size=max_sessions, ttl=ttl)
+        self.sessions = db_manager.get_session_repository() if persist and db_manager else None
+
+
+    @staticmethod
+    def digest(token: str) -> str:
+        """
+        Returns the digest under which a token is stored
+
+        :param token: Session token
+
+        :return: SHA256 hex digest of the token
+        """
+        return hashlib.sha256(token.encode()).hexdigest()
+
+
+    def issue(self, user: User) -> str:
+        """
+        Issues a new session token for an authenticated user
+
+        :param user: Authenticated User object
+
+        :return: Opaque session token
+        """
+        token = TOKEN_PREFIX + secrets.token_urlsafe(32)
+        token_digest = self.digest(token)
+
+        # Sessions never carry the password hash
+        session_user = User(user.username, None, user._id)
+        self.store.set(token_digest, session_user)
+
+        # Persistence enabled: store it so other processes and restarts can resolve it
+        if self.sessions is not None:
+            try:
+                self.sessions.save(token_digest, user.username, user._id,
+                                   datetime.now() + timedelta(seconds=self.ttl))
+
+            # Persistence failure: the in-memory session still works
+            except Exception as e:
+                print(f'Error persisting session: {e}', file=sys.stderr)
+
+        return token
+
+
+    def resolve(self, token: str) -> Optional[User]:
+        """
+        Returns the user of a live session
+
+        :param token: Session token
+
+        :return: User object (without password), or None if unknown or expired
+        """
+        token_digest = self.digest(token)
+        user = self.store.get(token_digest)
+
+        # In-memory hit: no round trip
+        if user is not None:
+            return user
+
+        # Not persisted: unknown or expired
+        if self.sessions is None:
+            return None
+
+        # Persisted session (e.g. issued by another process)
+        now = datetime.now()
+        session_data = self.sessions.find_live(token_digest, now)
+
+        # Unknown or expired: return None
+        if session_data is None:
+            return None
+
+        # Keep it in memory for the rest of its lifetime
+        user = User(session_data['username'], None, session_data.get('user_id'))
+        self.store.set(token_digest, user, (session_data['expires_at'] - now).total_seconds())
+        return user
+
+
+    def authenticate(self, identity: Union[User, str]) -> Optional[User]:
+        """
+        Resolves an identity given either as a User or as a session token
+
+        :param identity: User object or session token
+
+        :return: User object, or None if the token is unknown or expired
+        """
+
+        # Already authenticated user: use as is
+        if isinstance(identity, User):
+            return identity
+
+        return self.resolve(identity)
+
+
+    def revoke(self, token: str) -> bool:
+        """
+        Ends a session
+
+        :param token: Session token
+
+        :return: True if a session was removed, False otherwise
+        """
+        token_digest = self.digest(token)
+        removed = self.store.evict(token_digest)
+
+        # Persisted: remove it there as well
+        if self.sessions is not None:
+            removed = self.sessions.delete(token_digest) or removed
+
+        return removed
+
+
+    def clear(self) -> None:
+        """
+        Drops every in-memory session (persisted sessions expire on their own)
+
+        :return: None
+        """
+        self.store.clear()
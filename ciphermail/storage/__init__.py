@@ -0,0 +1,3 @@
+##################
+# Storage module #
+##################
@@ -0,0 +1,503 @@
+"""
+Storage interfaces for the operations the services perform
+"""
+
+# --- TYPES ---
+from bson import ObjectId
+from datetime import datetime
+from typing import Any
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Set
+from typing import Tuple
+from typing import Union
+
+
+# --- CODE ---
+class SummaryChange(NamedTuple):
+    """
+    Change to a recipient's inbox summary: unread count delta from one sender, and the time of a new message
+    """
+    recipient: str
+    sender: str
+    delta: int
+    timestamp: Optional[datetime] = None
+
+
+class FeedEvent(NamedTuple):
+    """
+    New message delivered by a feed subscription: its header document and the position just after it
+    """
+    message: dict
+    token: Any
+
+
+class UserRepository:
+    """
+    User storage operations
+    Users are exchanged as documents shaped like User.to_dict()
+    """
+
+    def exists(self, username: str) -> bool:
+        """
+        Checks whether a username is registered
+
+        :param username: Username
+
+        :return: True if the user exists, False otherwise
+        """
+        raise NotImplementedError
+
+
+    def existing_usernames(self, usernames: Iterable[str]) -> Set[str]:
+        """
+        Returns which of the given usernames are registered
+
+        :param usernames: Usernames to check
+
+        :return: Set of registered usernames
+        """
+        raise NotImplementedError
+
+
+    def find_by_username(self, username: str) -> Optional[dict]:
+        """
+        Returns a user document
+
+        :param username: Username
+
+        :return: User document, or None if not found
+        """
+        raise NotImplementedError
+
+
+    def insert(self, user_data: dict) -> bool:
+        """
+        Stores a new user (sets its _id)
+
+        :param user_data: User document
+
+        :return: True if stored, False if the username is taken
+        """
+        raise NotImplementedError
+
+
+    def replace_password(self, user_id: Any, old_hash: str, new_hash: str) -> bool:
+        """
+        Replaces a password hash if it still has the expected value
+
+        :param user_id: User document ID
+        :param old_hash: Hash expected to be stored
+        :param new_hash: Hash to store
+
+        :return: True if replaced, False otherwise
+        """
+        raise NotImplementedError
+
+
+class MessageRepository:
+    """
+    Message storage operations
+    Messages are exchanged as documents shaped like Message.to_dict()
+    """
+
+    def insert(self, message_data: dict) -> ObjectId:
+        """
+        Stores a message (sets its _id)
+
+        :param message_data: Message document
+
+        :return: ID of the stored message
+        """
+        raise NotImplementedError
+
+
+    def insert_many(self, messages_data: List[dict]) -> Set[int]:
+        """
+        Stores many messages, continuing past individual failures
+
+        :param messages_data: Message documents
+
+        :return: Positions (in messages_data) of the messages that could not be stored
+        """
+        raise NotImplementedError
+
+
+    def find_unread(self, recipient: str) -> List[dict]:
+        """
+        Returns every unread message of a recipient, newest first
+
+        :param recipient: Recipient's username
+
+        :return: List of full message documents
+        """
+        raise NotImplementedError
+
+
+    def find_unread_page(self,
+                         recipient: str,
+                         after: Optional[Tuple[datetime, ObjectId]],
+                         limit: int) -> List[dict]:
+        """
+        Returns unread message headers of a recipient, newest first, after a keyset position
+
+        :param recipient: Recipient's username
+        :param after: (timestamp, _id) of the last message already returned, or None from the start
+        :param limit: Maximum number of headers
+
+        :return: List of message documents without encrypted_content
+        """
+        raise NotImplementedError
+
+
+    def find_read_since(self, recipient: str, since: datetime) -> List[ObjectId]:
+        """
+        Returns the IDs of a recipient's messages marked read since a given time (IDs only, for inbox cache syncs)
+        Every read state change stamps the message's read_changed_at
+
+        :param recipient: Recipient's username
+        :param since: Read state changes before this time are skipped
+
+        :return: List of message IDs, in no particular order
+        """
+        raise NotImplementedError
+
+
+    def find_unread_since(self, recipient: str, since: Optional[datetime]) -> List[dict]:
+        """
+        Returns a recipient's unread messages sent or marked unread again since a given time
+
+        :param recipient: Recipient's username
+        :param since: Return the unread messages sent or marked unread from then on (every one if None)
+
+        :return: List of full message documents, in no particular order
+        """
+        raise NotImplementedError
+
+
+    def get_encrypted_content(self, message_id: ObjectId) -> Optional[Union[str, bytes]]:
+        """
+        Returns only the encrypted content of a message
+
+        :param message_id: ID of the message
+
+        :return: Encrypted content as stored (Binary or base64 text), or None if the message does not exist
+        """
+        raise NotImplementedError
+
+
+    def get_encrypted_contents(self, message_ids: List[ObjectId]) -> List[dict]:
+        """
+        Returns the encrypted content of many messages
+
+        :param message_ids: IDs of the messages
+
+        :return: List of {'_id', 'sender', 'recipient', 'read', 'encrypted_content', 'compression' and 'stream'
+                 if any} documents for the messages that exist
+        """
+        raise NotImplementedError
+
+
+    def acknowledge(self, message_id: ObjectId, recipient: Optional[str] = None) -> Optional[dict]:
+        """
+        Atomically marks a message read and returns it as it was before
+        The time it was first read is kept as read_at (retention policies count from it), and stamped as
+        read_changed_at if it was unread
+
+        :param message_id: ID of the message
+        :param recipient: Only acknowledge the message if it was sent to this user (any recipient if None)
+
+        :return: Full message document before the update, or None if not found
+        """
+        raise NotImplementedError
+
+
+    def mark_unread(self, message_id: ObjectId) -> None:
+        """
+        Marks a message unread again (dropping its read_at, stamping read_changed_at)
+
+        :param message_id: ID of the message
+
+        :return: None
+        """
+        raise NotImplementedError
+
+
+    def mark_read(self, message_ids: List[ObjectId]) -> int:
+        """
+        Marks many messages read at once (setting read_at and read_changed_at on the ones that were unread)
+
+        :param message_ids: IDs of the messages
+
+        :return: Number of messages that were unread
+        """
+        raise NotImplementedError
+
+
+    def unread_counts(self, recipient: Optional[str] = None) -> List[dict]:
+        """
+        Recomputes unread counts from the messages themselves (for repairing inbox summaries)
+
+        :param recipient: Only this recipient's messages (every recipient if None)
+
+        :return: List of {'recipient', 'sender', 'unread', 'last_message_at'} documents, one per recipient and sender
+        """
+        raise NotImplementedError
+
+
+    def insert_chunks(self, message_id: ObjectId, chunks: Iterable[bytes]) -> int:
+        """
+        Stores the encrypted chunks of a streamed body, consuming them as they are produced
+
+        :param message_id: ID of the message the body belongs to
+        :param chunks: Encrypted chunks, in order
+
+        :return: Number of chunks stored
+        """
+        raise NotImplementedError
+
+
+    def iter_chunks(self, message_id: ObjectId) -> Iterator[bytes]:
+        """
+        Yields the encrypted chunks of a streamed body in order, without loading them all at once
+
+        :param message_id: ID of the message
+
+        :return: Iterator of encrypted chunks
+        """
+        raise NotImplementedError
+
+
+    def delete_chunks(self, message_id: ObjectId) -> None:
+        """
+        Removes the chunks of a streamed body
+
+        :param message_id: ID of the message
+
+        :return: None
+        """
+        raise NotImplementedError
+
+
+class SessionRepository:
+    """
+    Session storage operations
+    """
+
+    def save(self, token_digest: str, username: str, user_id: Any, expires_at: datetime) -> None:
+        """
+        Stores a session
+
+        :param token_digest: Digest of the session token
+        :param username: Session user's username
+        :param user_id: Session user's document ID
+        :param expires_at: Expiry time
+
+        :return: None
+        """
+        raise NotImplementedError
+
+
+    def find_live(self, token_digest: str, now: datetime) -> Optional[dict]:
+        """
+        Returns a session that has not expired
+
+        :param token_digest: Digest of the session token
+        :param now: Current time
+
+        :return: Session document (username, user_id, expires_at), or None
+        """
+        raise NotImplementedError
+
+
+    def delete(self, token_digest: str) -> bool:
+        """
+        Removes a session
+
+        :param token_digest: Digest of the session token
+
+        :return: True if removed, False otherwise
+        """
+        raise NotImplementedError
+
+
+class SummaryRepository:
+    """
+    Per-recipient inbox summaries: unread count, last message time and unread count per sender
+    Documents are {'_id': recipient, 'unread', 'last_message_at', 'senders': {sender: unread}, 'updated_at'}
+    """
+
+    def apply(self, changes: List[SummaryChange]) -> None:
+        """
+        Applies counter changes, each one atomically on its recipient's summary (created if missing)
+
+        :param changes: Changes to apply
+
+        :return: None
+        """
+        raise NotImplementedError
+
+
+    def get(self, recipient: str) -> Optional[dict]:
+        """
+        Returns a recipient's summary with a single key lookup
+
+        :param recipient: Recipient's username
+
+        :return: Summary document, or None if the recipient never received a message
+        """
+        raise NotImplementedError
+
+
+    def replace(self, summaries: List[dict], started: datetime, recipient: Optional[str] = None) -> None:
+        """
+        Replaces summaries with recomputed ones and drops the stale ones
+
+        :param summaries: Recomputed summary documents
+        :param started: When the recomputation started (summaries not updated since then are stale)
+        :param recipient: Only this recipient's summary was recomputed (every summary if None)
+
+        :return: None
+        """
+        raise NotImplementedError
+
+
+class FeedSubscription:
+    """
+    New messages of one recipient, in arrival order
+    resumed is True when the subscription picked up exactly after its resume token; otherwise messages
+    may have arrived unseen before it started, and the inbox should be listed once
+    """
+    resumed: bool = False
+
+    def next(self, timeout: float) -> Optional[FeedEvent]:
+        """
+        Waits for the next new message
+
+        :param timeout: Maximum time to wait, in seconds
+
+        :return: FeedEvent, or None if nothing arrived in time (or the subscription is closed)
+        """
+        raise NotImplementedError
+
+
+    def close(self) -> None:
+        """
+        Stops the subscription
+
+        :return: None
+        """
+        raise NotImplementedError
+
+
+class MessageFeed:
+    """
+    New-message notifications per recipient, and the saved positions of named subscribers
+    """
+
+    def publish(self, messages_data: List[dict]) -> None:
+        """
+        Announces stored messages to in-process subscribers (ignored where the server delivers them)
+
+        :param messages_data: Stored message documents (with their _id)
+
+        :return: None
+        """
+        raise NotImplementedError
+
+
+    def subscribe(self, recipient: str, resume_token: Any = None) -> FeedSubscription:
+        """
+        Starts delivering a recipient's new messages
+
+        :param recipient: Recipient's username
+        :param resume_token: Token of the last message already handled, to resume after it (None from now)
+
+        :return: FeedSubscription
+        """
+        raise NotImplementedError
+
+
+    def load_position(self, key: str) -> Any:
+        """
+        Returns a subscriber's saved resume token
+
+        :param key: Subscriber key
+
+        :return: Resume token, or None if nothing was saved
+        """
+        raise NotImplementedError
+
+
+    def save_position(self, key: str, token: Any) -> None:
+        """
+        Saves a subscriber's resume token
+
+        :param key: Subscriber key
+        :param token: Token of the last message handled
+
+        :return: None
+        """
+        raise NotImplementedError
+
+
+class StorageBackend:
+    """
+    Provides the repositories used by the services
+    """
+
+    def get_user_repository(self) -> UserRepository:
+        """
+        Returns the user repository
+
+        :return: UserRepository instance
+        """
+        raise NotImplementedError
+
+
+    def get_message_repository(self) -> MessageRepository:
+        """
+        Returns the message repository
+
+        :return: MessageRepository instance
+        """
+        raise NotImplementedError
+
+
+    def get_session_repository(self) -> SessionRepository:
+        """
+        Returns the session repository
+
+        :return: SessionRepository instance
+        """
+        raise NotImplementedError
+
+
+    def get_summary_repository(self) -> SummaryRepository:
+        """
+        Returns the inbox summary repository
+
+        :return: SummaryRepository instance
+        """
+        raise NotImplementedError
+
+
+    def get_message_feed(self) -> MessageFeed:
+        """
+        Returns the new-message feed
+
+        :return: MessageFeed instance
+        """
+        raise NotImplementedError
+
+
+    def close(self) -> None:
+        """
+        Releases the backend's resources
+
+        :return: None
+        """
+        raise NotImplementedError
@@ -0,0 +1,551 @@
+"""
+Bucketed MongoDB message storage: each recipient's messages grouped into fixed-capacity bucket documents
+
+A bucket holds up to BUCKET_CAPACITY messages (and about BUCKET_MAX_BYTES) of one recipient, in arrival order:
+{_id: {recipient, id}, recipient, start, end, count, size, unread, read_changed_at,
+ messages: [{_id, sender, timestamp, read, ...}]}
+An inbox page reads one or two buckets instead of one index entry and one document per message, and the
+listing index holds one entry per bucket with unread messages
+"""
+
+# --- IMPORTS ---
+from bson import ObjectId
+from datetime import datetime
+from ciphermail.storage.mongo import BULK_INSERT_CHUNK_SIZE
+from ciphermail.storage.mongo import MongoMessageRepository
+from pymongo import ReturnDocument
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from pymongo.errors import PyMongoError
+
+import bson
+import os
+import sys
+
+
+# --- TYPES ---
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+from typing import Union
+
+
+# --- GLOBALS ---
+# Messages per bucket, and bucket size in bytes past which a new bucket is started (well under the 16 MB limit)
+BUCKET_CAPACITY = int(os.getenv('BUCKET_CAPACITY', '100'))
+BUCKET_MAX_BYTES = int(os.getenv('BUCKET_MAX_BYTES', str(4 * 1024 * 1024)))
+
+# Buckets fetched per round trip when listing (a page usually needs one or two)
+BUCKET_FETCH_BATCH = 2
+
+
+# --- CODE ---
+def message_element(message_data: dict) -> dict:
+    """
+    Builds the bucket element of a message (the recipient is kept on the bucket)
+    Sets the message's _id if missing, like an insert does
+
+    :param message_data: Message document
+
+    :return: Bucket element
+    """
+    message_data.setdefault('_id', ObjectId())
+    return {field: value for field, value in message_data.items() if field != 'recipient'}
+
+
+def message_document(recipient: str, element: dict, headers: bool = False) -> dict:
+    """
+    Converts a bucket element back to a message document
+
+    :param recipient: Bucket's recipient
+    :param element: Bucket element
+    :param headers: Leave the encrypted content out
+
+    :return: Message document shaped like Message.to_dict()
+    """
+    document = {field: value for field, value in element.items() if not headers or field != 'encrypted_content'}
+    document['recipient'] = recipient
+    return document
+
+
+def bucket_append(message_data: dict) -> UpdateOne:
+    """
+    Builds the upsert appending a message to its recipient's open bucket (or starting a new one)
+
+    :param message_data: Message document (its _id is set if missing)
+
+    :return: UpdateOne operation
+    """
+    element = message_element(message_data)
+    size = len(bson.encode(element))
+    recipient = message_data['recipient']
+
+    return UpdateOne(
+        {'recipient': recipient, 'count': {'$lt': BUCKET_CAPACITY}, 'size': {'$lte': BUCKET_MAX_BYTES - size}},
+        {
+            '$push': {'messages': element},
+            '$inc': {'count': 1, 'size': size, 'unread': 0 if element['read'] else 1},
+            '$min': {'start': element['timestamp']},
+            '$max': {'end': element['timestamp']},
+            '$setOnInsert': {'_id': {'recipient': recipient, 'id': ObjectId()}},
+        },
+        upsert=True
+    )
+
+
+def before_position(after: Tuple[datetime, ObjectId]) -> dict:
+    """
+    Builds the expression matching bucket elements strictly after a keyset position (newest first)
+
+    :param after: (timestamp, _id) of the last message already returned
+
+    :return: Aggregation expression on $$this
+    """
+    timestamp, message_id = after
+    return {'$or': [
+        {'$lt': ['$$this.timestamp', timestamp]},
+        {'$and': [{'$eq': ['$$this.timestamp', timestamp]}, {'$lt': ['$$this._id', message_id]}]},
+    ]}
+
+
+def unread_buckets_pipeline(recipient: str,
+                            after: Optional[Tuple[datetime, ObjectId]] = None,
+                            headers: bool = True) -> List[dict]:
+    """
+    Builds the aggregation streaming a recipient's buckets with unread messages, latest ending first,
+    each trimmed to its unread messages after the keyset position
+
+    :param recipient: Recipient's username
+    :param after: (timestamp, _id) of the last message already returned, or None from the start
+    :param headers: Leave the encrypted content out
+
+    :return: Aggregation pipeline
+    """
+    match = {'recipient': recipient, 'unread': {'$gt': 0}}
+    condition = {'$eq': ['$$this.read', False]}
+
+    # Continuing: buckets starting after the position only hold newer messages
+    if after is not None:
+        match['start'] = {'$lte': after[0]}
+        condition = {'$and': [condition, before_position(after)]}
+
+    pipeline = [
+        {'$match': match},
+        {'$sort': {'end': -1}},
+        {'$project': {'recipient': 1, 'end': 1, 'messages': {'$filter': {'input': '$messages', 'cond': condition}}}},
+    ]
+
+    # Headers only: the ciphertext never leaves the server
+    if headers:
+        pipeline.append({'$project': {'messages.encrypted_content': 0}})
+
+    return pipeline
+
+
+def merge_buckets(buckets: Iterable[dict], limit: Optional[int] = None) -> List[dict]:
+    """
+    Merges the messages of buckets (latest ending first) into one newest-first list
+    Stops reading buckets once none of the remaining ones can hold a message newer than the limit-th kept
+
+    :param buckets: Buckets sorted by end, descending, holding only the wanted messages
+    :param limit: Maximum number of messages (None for all)
+
+    :return: List of message documents, newest first
+    """
+    messages: List[dict] = []
+
+    for bucket in buckets:
+
+        # Enough messages, all newer than anything this bucket (or a later one) holds: done
+        if limit is not None and len(messages) >= limit and bucket['end'] < messages[limit - 1]['timestamp']:
+            break
+
+        messages.extend(message_document(bucket['recipient'], element) for element in bucket['messages'])
+        messages.sort(key=lambda message_data: (message_data['timestamp'], message_data['_id']), reverse=True)
+
+        # Keep only what can still be returned
+        if limit is not None:
+            del messages[limit:]
+
+    return messages
+
+
+def mark_read_update(message_ids: List[ObjectId], now: datetime) -> List[dict]:
+    """
+    Builds the pipeline update marking some of a bucket's messages read and recounting its unread messages
+    (the bucket's read_changed_at is the latest of its messages', so inbox cache syncs can skip the others)
+
+    :param message_ids: IDs of the messages to mark
+    :param now: Read time of the messages that were unread
+
+    :return: Pipeline update
+    """
+    return [
+        {'$set': {'messages': {'$map': {'input': '$messages', 'in': {'$cond': [
+            {'$and': [{'$in': ['$$this._id', message_ids]}, {'$eq': ['$$this.read', False]}]},
+            {'$mergeObjects': ['$$this', {'read': True, 'read_at': now, 'read_changed_at': now}]},
+            '$$this'
+        ]}}}}},
+        {'$set': {'unread': {'$size': {'$filter': {'input': '$messages', 'cond': {'$eq': ['$$this.read', False]}}}},
+                  'read_changed_at': {'$max': ['$read_changed_at', now]}}},
+    ]
+
+
+def bucket_unread_counts_pipeline(recipient: Optional[str] = None) -> List[dict]:
+    """
+    Builds the aggregation recounting unread messages per recipient and sender from the buckets
+
+    :param recipient: Only this recipient's buckets (every recipient if None)
+
+    :return: Aggregation pipeline yielding {'recipient', 'sender', 'unread', 'last_message_at'} documents
+    """
+    pipeline = [{'$match': {'recipient': recipient}}] if recipient is not None else []
+    return pipeline + [
+        {'$project': {'recipient': 1, 'messages.sender': 1, 'messages.read': 1, 'messages.timestamp': 1}},
+        {'$unwind': '$messages'},
+        {'$group': {
+            '_id': {'recipient': '$recipient', 'sender': '$messages.sender'},
+            'unread': {'$sum': {'$cond': [{'$eq': ['$messages.read', False]}, 1, 0]}},
+            'last_message_at': {'$max': '$messages.timestamp'}
+        }},
+        {'$project': {'_id': 0, 'recipient': '$_id.recipient', 'sender': '$_id.sender',
+                      'unread': 1, 'last_message_at': 1}},
+    ]
+
+
+def bucket_feed_pipeline(recipient: str) -> List[dict]:
+    """
+    Builds the change stream pipeline delivering a recipient's new messages from the buckets
+    (a new bucket, or a bucket whose count changed; read flags and the like leave count alone)
+
+    :param recipient: Recipient's username
+
+    :return: Change stream pipeline
+    """
+    return [
+        {'$match': {'documentKey._id.recipient': recipient, '$or': [
+            {'operationType': 'insert'},
+            {'operationType': 'update', 'updateDescription.updatedFields.count': {'$exists': True}},
+        ]}},
+        {'$project': {'fullDocument.messages.encrypted_content': 0}},
+    ]
+
+
+class MongoBucketMessageRepository(MongoMessageRepository):
+    """
+    Message storage in per-recipient bucket documents on a MongoDB collection
+    Streamed body chunks are stored as in the one-document-per-message layout
+    """
+
+    def insert(self, message_data: dict) -> ObjectId:
+        """
+        Appends a message to its recipient's open bucket (sets its _id)
+
+        :param message_data: Message document
+
+        :return: ID of the stored message
+        """
+        operation = bucket_append(message_data)
+        self.collection.bulk_write([operation])
+        return message_data['_id']
+
+
+    def insert_many(self, messages_data: List[dict]) -> Set[int]:
+        """
+        Appends many messages with chunked, unordered bulk upserts
+
+        :param messages_data: Message documents
+
+        :return: Positions (in messages_data) of the messages that could not be stored
+        """
+        failed_indexes = set()
+
+        for start in range(0, len(messages_data), BULK_INSERT_CHUNK_SIZE):
+            chunk = messages_data[start:start + BULK_INSERT_CHUNK_SIZE]
+            try:
+                self.collection.bulk_write([bucket_append(message_data) for message_data in chunk], ordered=False)
+
+            # Partial failure: remember which messages were not written
+            except BulkWriteError as e:
+                failed_indexes.update(start + error['index'] for error in e.details.get('writeErrors', []))
+
+            # Chunk-level failure (e.g. network): count the whole chunk as failed
+            except PyMongoError as e:
+                print(f'Error storing messages: {e}', file=sys.stderr)
+                failed_indexes.update(range(start, start + len(chunk)))
+
+        return failed_indexes
+
+
+    def find_unread(self, recipient: str) -> List[dict]:
+        """
+        Returns every unread message of a recipient, newest first
+
+        :param recipient: Recipient's username
+
+        :return: List of full message documents
+        """
+        return merge_buckets(self.collection.aggregate(unread_buckets_pipeline(recipient, headers=False)))
+
+
+    def find_unread_page(self,
+                         recipient: str,
+                         after: Optional[Tuple[datetime, ObjectId]],
+                         limit: int) -> List[dict]:
+        """
+        Returns unread message headers of a recipient, newest first, after a keyset position
+        Reads buckets latest ending first and stops as soon as the page is settled
+
+        :param recipient: Recipient's username
+        :param after: (timestamp, _id) of the last message already returned, or None from the start
+        :param limit: Maximum number of headers
+
+        :return: List of message documents without encrypted_content
+        """
+        cursor = self.collection.aggregate(unread_buckets_pipeline(recipient, after),
+                                           batchSize=BUCKET_FETCH_BATCH)
+
+        # Close the cursor even if the page is settled before the last bucket
+        with cursor:
+            return merge_buckets(cursor, limit)
+
+
+    def find_elements(self, match: dict, condition: dict, projection: Optional[dict] = None) -> List[dict]:
+        """
+        Returns the messages of the buckets matching a query, keeping only the elements matching a condition
+
+        :param match: Query selecting the buckets
+        :param condition: Aggregation expression on $$this (the bucket element)
+        :param projection: Optional projection applied to the trimmed buckets
+
+        :return: List of message documents, in no particular order
+        """
+        pipeline = [
+            {'$match': match},
+            {'$project': {'recipient': 1, 'messages': {'$filter': {'input': '$messages', 'cond': condition}}}},
+        ]
+
+        # Only some fields wanted: trim server-side
+        if projection is not None:
+            pipeline.append({'$project': projection})
+
+        return [message_document(bucket['recipient'], element)
+                for bucket in self.collection.aggregate(pipeline) for element in bucket['messages']]
+
+
+    def find_read_since(self, recipient: str, since: datetime) -> List[ObjectId]:
+        """
+        Returns the IDs of a recipient's messages marked read since a given time
+        Only the buckets stamped with a later read state change are looked at
+
+        :param recipient: Recipient's username
+        :param since: Read state changes before this time are skipped
+
+        :return: List of message IDs, in no particular order
+        """
+        elements = self.find_elements(
+            {'recipient': recipient, 'read_changed_at': {'$gte': since}},
+            {'$and': [{'$eq': ['$$this.read', True]}, {'$gte': ['$$this.read_changed_at', since]}]},
+            {'recipient': 1, 'messages._id': 1}
+        )
+        return [message_data['_id'] for message_data in elements]
+
+
+    def find_unread_since(self, recipient: str, since: Optional[datetime]) -> List[dict]:
+        """
+        Returns a recipient's unread messages sent or marked unread again since a given time
+        Only the buckets ending or stamped with a read state change later are looked at
+
+        :param recipient: Recipient's username
+        :param since: Return the unread messages sent or marked unread from then on (every one if None)
+
+        :return: List of full message documents, in no particular order
+        """
+        match = {'recipient': recipient, 'unread': {'$gt': 0}}
+        condition = {'$eq': ['$$this.read', False]}
+
+        # Known sync time: only what changed since
+        if since is not None:
+            match['$or'] = [{'end': {'$gte': since}}, {'read_changed_at': {'$gte': since}}]
+            condition = {'$and': [condition, {'$or': [{'$gte': ['$$this.timestamp', since]},
+                                                      {'$gte': ['$$this.read_changed_at', since]}]}]}
+
+        return self.find_elements(match, condition)
+
+
+    def find_element(self, message_id: ObjectId, recipient: Optional[str] = None) -> Optional[dict]:
+        """
+        Returns a message from its bucket
+
+        :param message_id: ID of the message
+        :param recipient: Only if it was sent to this user (any recipient if None)
+
+        :return: Full message document, or None if not found
+        """
+        query = {'messages._id': message_id} if recipient is None else {'recipient': recipient,
+                                                                         'messages._id': message_id}
+        bucket = self.collection.find_one(query, {'recipient': 1, 'messages': {'$elemMatch': {'_id': message_id}}})
+        return message_document(bucket['recipient'], bucket['messages'][0]) if bucket is not None else None
+
+
+    def get_encrypted_content(self, message_id: ObjectId) -> Optional[Union[str, bytes]]:
+        """
+        Returns only the encrypted content of a message (its bucket element, by the message _id index)
+
+        :param message_id: ID of the message
+
+        :return: Encrypted content as stored, or None if the message does not exist
+        """
+        message_data = self.find_element(message_id)
+        return message_data.get('encrypted_content') if message_data is not None else None
+
+
+    def get_encrypted_contents(self, message_ids: List[ObjectId]) -> List[dict]:
+        """
+        Returns the encrypted content of many messages with one aggregation over their buckets
+
+        :param message_ids: IDs of the messages
+
+        :return: List of {'_id', 'sender', 'recipient', 'read', 'encrypted_content', 'compression' and 'stream'
+                 if any} documents for the messages that exist
+        """
+        buckets = self.collection.aggregate([
+            {'$match': {'messages._id': {'$in': message_ids}}},
+            {'$project': {'recipient': 1, 'messages': {'$filter': {'input': '$messages',
+                                                                   'cond': {'$in': ['$$this._id', message_ids]}}}}},
+        ])
+
+        return [
+            {field: value for field, value in message_document(bucket['recipient'], element).items()
+             if field in ('_id', 'sender', 'recipient', 'read', 'encrypted_content', 'compression', 'stream')}
+            for bucket in buckets for element in bucket['messages']
+        ]
+
+
+    def acknowledge(self, message_id: ObjectId, recipient: Optional[str] = None) -> Optional[dict]:
+        """
+        Marks a message read and returns it as it was before
+        Unread messages take one round trip (one atomic update of their bucket), already read ones two
+
+        :param message_id: ID of the message
+        :param recipient: Only acknowledge the message if it was sent to this user (any recipient if None)
+
+        :return: Full message document before the update, or None if not found
+        """
+        query = {'messages': {'$elemMatch': {'_id': message_id, 'read': False}}}
+        if recipient is not None:
+            query['recipient'] = recipient
+        now = datetime.now()
+
+        bucket = self.collection.find_one_and_update(
+            query,
+            {'$set': {'messages.$.read': True, 'messages.$.read_at': now, 'messages.$.read_changed_at': now},
+             '$max': {'read_changed_at': now}, '$inc': {'unread': -1}},
+            {'recipient': 1, 'messages': {'$elemMatch': {'_id': message_id}}},
+            return_document=ReturnDocument.BEFORE
+        )
+
+        # Not unread (already read, or not found): return it as it is
+        if bucket is None:
+            return self.find_element(message_id, recipient)
+
+        message_data = message_document(bucket['recipient'], bucket['messages'][0])
+
+        # Streamed body read for the first time: date its chunks too
+        if message_data.get('stream') is not None:
+            self.date_chunks(message_id, now)
+
+        return message_data
+
+
+    def mark_unread(self, message_id: ObjectId) -> None:
+        """
+        Marks a message unread again (dropping its read_at, stamping read_changed_at on it and its bucket)
+
+        :param message_id: ID of the message
+
+        :return: None
+        """
+        now = datetime.now()
+        bucket = self.collection.find_one_and_update(
+            {'messages': {'$elemMatch': {'_id': message_id, 'read': True}}},
+            {'$set': {'messages.$.read': False, 'messages.$.read_changed_at': now},
+             '$unset': {'messages.$.read_at': ''}, '$max': {'read_changed_at': now}, '$inc': {'unread': 1}},
+            {'messages': {'$elemMatch': {'_id': message_id}}}
+        )
+
+        # Streamed body: its chunks no longer count as read either
+        if bucket is not None and bucket['messages'][0].get('stream') is not None:
+            self.date_chunks(message_id, None)
+
+
+    def mark_read(self, message_ids: List[ObjectId]) -> int:
+        """
+        Marks many messages read, with one atomic update per bucket holding some of them unread
+
+        :param message_ids: IDs of the messages
+
+        :return: Number of messages that were unread
+        """
+        remaining = set(message_ids)
+        now = datetime.now()
+        marked = 0
+
+        while remaining:
+            pending = list(remaining)
+            bucket = self.collection.find_one_and_update(
+                {'messages': {'$elemMatch': {'_id': {'$in': pending}, 'read': False}}},
+                mark_read_update(pending, now),
+                {'messages._id': 1, 'messages.read': 1},
+                return_document=ReturnDocument.BEFORE
+            )
+
+            # No bucket left with any of them unread: done
+            if bucket is None:
+                break
+
+            # Count from the bucket as it was before, so concurrent readers never count a message twice
+            elements = [element for element in bucket['messages'] if element['_id'] in remaining]
+            marked += sum(1 for element in elements if not element['read'])
+            remaining.difference_update(element['_id'] for element in elements)
+
+        return marked
+
+
+    def unread_counts(self, recipient: Optional[str] = None) -> List[dict]:
+        """
+        Recomputes unread counts with one aggregation over the buckets, grouped by recipient and sender
+
+        :param recipient: Only this recipient's messages (every recipient if None)
+
+        :return: List of {'recipient', 'sender', 'unread', 'last_message_at'} documents, one per recipient and sender
+        """
+        return list(self.collection.aggregate(bucket_unread_counts_pipeline(recipient), allowDiskUse=True))
+
+
+    def change_message(self, change: dict) -> Optional[dict]:
+        """
+        Extracts the new message from a change on the buckets (pipeline from bucket_feed_pipeline)
+
+        :param change: Insert of a new bucket, or update of a bucket's count
+
+        :return: Message header document, or None if the bucket is gone
+        """
+
+        # New bucket: its first message
+        if change['operationType'] == 'insert':
+            bucket = change['fullDocument']
+            return message_document(bucket['recipient'], bucket['messages'][0], headers=True)
+
+        # Message appended: it sits at the new count's position
+        count = change['updateDescription']['updatedFields']['count']
+        bucket = self.collection.find_one({'_id': change['documentKey']['_id']},
+                                          {'recipient': 1, 'messages': {'$slice': [count - 1, 1]}})
+
+        # Bucket gone meanwhile: nothing to deliver
+        if bucket is None or not bucket['messages']:
+            return None
+
+        return message_document(bucket['recipient'], bucket['messages'][0], headers=True)
@@ -0,0 +1,43 @@
+"""
+Storage backend selection
+"""
+
+# --- IMPORTS ---
+from ciphermail.config.database import DatabaseManager
+from ciphermail.storage.base import StorageBackend
+from ciphermail.storage.memory import InMemoryBackend
+
+import os
+
+
+# --- TYPES ---
+from typing import Optional
+
+
+# --- GLOBALS ---
+# Backend used when none is given: 'mongo' (default) or 'memory'
+STORAGE_BACKEND = os.getenv('CIPHERMAIL_STORAGE', 'mongo').lower()
+
+
+# --- CODE ---
+def create_backend(name: Optional[str] = None) -> StorageBackend:
+    """
+    Creates a storage backend by name
+
+    :param name: 'mongo' or 'memory' (CIPHERMAIL_STORAGE, or 'mongo', by default)
+
+    :return: StorageBackend instance
+
+    :raises ValueError: If the backend name is unknown
+    """
+    name = (name or STORAGE_BACKEND).lower()
+
+    # In-memory backend: nothing to connect to
+    if name == 'memory':
+        return InMemoryBackend()
+
+    # MongoDB backend: connects with the configured settings
+    if name == 'mongo':
+        return DatabaseManager()
+
+    raise ValueError(f'Unknown storage backend: {name}')
@@ -0,0 +1,881 @@
+"""
+In-memory implementation of the storage interfaces (tests, benchmarks, single-process use)
+"""
+
+# --- IMPORTS ---
+from bson import ObjectId
+from datetime import datetime
+from collections import deque
+from ciphermail.storage.base import FeedEvent
+from ciphermail.storage.base import FeedSubscription
+from ciphermail.storage.base import MessageFeed
+from ciphermail.storage.base import MessageRepository
+from ciphermail.storage.base import SessionRepository
+from ciphermail.storage.base import StorageBackend
+from ciphermail.storage.base import SummaryChange
+from ciphermail.storage.base import SummaryRepository
+from ciphermail.storage.base import UserRepository
+
+import bisect
+import os
+import queue
+import threading
+import uuid
+
+
+# --- TYPES ---
+from typing import Any
+from typing import Deque
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+from typing import Union
+
+
+# --- GLOBALS ---
+# Messages the in-process feed remembers, so subscriptions can resume after a recent token
+FEED_HISTORY_SIZE = int(os.getenv('FEED_HISTORY_SIZE', '1000'))
+
+
+# --- CODE ---
+class InMemoryUserRepository(UserRepository):
+    """
+    User storage in a dictionary keyed by username
+    """
+
+    def __init__(self) -> None:
+        """
+        Initializes an empty repository
+
+        :return: None
+        """
+        self.users: Dict[str, dict] = {}
+        self.lock = threading.Lock()
+
+
+    def exists(self, username: str) -> bool:
+        """
+        Checks whether a username is registered
+
+        :param username: Username
+
+        :return: True if the user exists, False otherwise
+        """
+        return username in self.users
+
+
+    def existing_usernames(self, usernames: Iterable[str]) -> Set[str]:
+        """
+        Returns which of the given usernames are registered
+
+        :param usernames: Usernames to check
+
+        :return: Set of registered usernames
+        """
+        return {username for username in usernames if username in self.users}
+
+
+    def find_by_username(self, username: str) -> Optional[dict]:
+        """
+        Returns a copy of a user document
+
+        :param username: Username
+
+        :return: User document, or None if not found
+        """
+        user_data = self.users.get(username)
+        return dict(user_data) if user_data is not None else None
+
+
+    def insert(self, user_data: dict) -> bool:
+        """
+        Stores a new user (sets its _id)
+
+        :param user_data: User document
+
+        :return: True if stored, False if the username is taken
+        """
+        with self.lock:
+
+            # Username taken: refuse, like the unique index does
+            if user_data['username'] in self.users:
+                return False
+
+            user_data.setdefault('_id', ObjectId())
+            self.users[user_data['username']] = dict(user_data)
+            return True
+
+
+    def replace_password(self, user_id: Any, old_hash: str, new_hash: str) -> bool:
+        """
+        Replaces a password hash if it still has the expected value
+
+        :param user_id: User document ID
+        :param old_hash: Hash expected to be stored
+        :param new_hash: Hash to store
+
+        :return: True if replaced, False otherwise
+        """
+        with self.lock:
+            for user_data in self.users.values():
+                if user_data['_id'] == user_id:
+
+                    # Hash changed meanwhile: leave it alone
+                    if user_data['password'] != old_hash:
+                        return False
+
+                    user_data['password'] = new_hash
+                    return True
+
+        return False
+
+
+class InMemoryMessageRepository(MessageRepository):
+    """
+    Message storage in a dictionary keyed by _id
+    Each recipient's unread messages are also kept as a sorted list of (timestamp, _id) keys,
+    so inbox pages are found by bisection instead of scanning every message
+    """
+
+    def __init__(self) -> None:
+        """
+        Initializes an empty repository
+
+        :return: None
+        """
+        self.messages: Dict[ObjectId, dict] = {}
+        self.unread: Dict[str, List[Tuple[datetime, ObjectId]]] = {}
+        self.chunks: Dict[ObjectId, List[bytes]] = {}
+        self.lock = threading.RLock()
+
+
+    def _index(self, message_data: dict) -> None:
+        """
+        Adds an unread message to its recipient's sorted key list (lock held by the caller)
+
+        :param message_data: Stored message document
+
+        :return: None
+        """
+        keys = self.unread.setdefault(message_data['recipient'], [])
+        bisect.insort(keys, (message_data['timestamp'], message_data['_id']))
+
+
+    def _unindex(self, message_data: dict) -> None:
+        """
+        Removes a message from its recipient's sorted key list (lock held by the caller)
+
+        :param message_data: Stored message document
+
+        :return: None
+        """
+        keys = self.unread.get(message_data['recipient'], [])
+        key = (message_data['timestamp'], message_data['_id'])
+        position = bisect.bisect_left(keys, key)
+
+        # Present: drop it
+        if position < len(keys) and keys[position] == key:
+            del keys[position]
+
+
+    def _set_read(self, message_id: ObjectId, read: bool) -> None:
+        """
+        Updates the read flag (read time and change time) of a message and the unread index (lock held by the caller)
+
+        :param message_id: ID of the message
+        :param read: New read flag
+
+        :return: None
+        """
+        message_data = self.messages.get(message_id)
+
+        # Unknown message or flag unchanged: nothing to do
+        if message_data is None or message_data['read'] == read:
+            return
+
+        message_data['read'] = read
+        message_data['read_changed_at'] = datetime.now()
+        if read:
+            message_data['read_at'] = message_data['read_changed_at']
+            self._unindex(message_data)
+        else:
+            message_data.pop('read_at', None)
+            self._index(message_data)
+
+
+    def insert(self, message_data: dict) -> ObjectId:
+        """
+        Stores a message (sets its _id)
+
+        :param message_data: Message document
+
+        :return: ID of the stored message
+        """
+        message_data.setdefault('_id', ObjectId())
+        stored = dict(message_data)
+
+        with self.lock:
+            self.messages[stored['_id']] = stored
+            if not stored['read']:
+                self._index(stored)
+
+        return stored['_id']
+
+
+    def insert_many(self, messages_data: List[dict]) -> Set[int]:
+        """
+        Stores many messages
+
+        :param messages_data: Message documents
+
+        :return: Positions (in messages_data) of the messages that could not be stored (duplicate _id)
+        """
+        failed_indexes = set()
+
+        with self.lock:
+            for i, message_data in enumerate(messages_data):
+
+                # Duplicate _id: fail this one and carry on, like an unordered insert_many
+                if message_data.get('_id') in self.messages:
+                    failed_indexes.add(i)
+                    continue
+
+                self.insert(message_data)
+
+        return failed_indexes
+
+
+    def find_unread(self, recipient: str) -> List[dict]:
+        """
+        Returns every unread message of a recipient, newest first
+
+        :param recipient: Recipient's username
+
+        :return: List of full message documents
+        """
+        with self.lock:
+            keys = self.unread.get(recipient, [])
+            return [dict(self.messages[message_id]) for _, message_id in reversed(keys)]
+
+
+    def find_unread_page(self,
+                         recipient: str,
+                         after: Optional[Tuple[datetime, ObjectId]],
+                         limit: int) -> List[dict]:
+        """
+        Returns unread message headers of a recipient, newest first, after a keyset position
+
+        :param recipient: Recipient's username
+        :param after: (timestamp, _id) of the last message already returned, or None from the start
+        :param limit: Maximum number of headers
+
+        :return: List of message documents without encrypted_content
+        """
+        with self.lock:
+            keys = self.unread.get(recipient, [])
+
+            # Keys are ascending: the page is the run of keys just below the position, walked backwards
+            end = len(keys) if after is None else bisect.bisect_left(keys, tuple(after))
+            start = max(0, end - limit)
+
+            page = []
+            for _, message_id in reversed(keys[start:end]):
+                header = dict(self.messages[message_id])
+                del header['encrypted_content']
+                page.append(header)
+
+            return page
+
+
+    def find_read_since(self, recipient: str, since: datetime) -> List[ObjectId]:
+        """
+        Returns the IDs of a recipient's messages marked read since a given time
+
+        :param recipient: Recipient's username
+        :param since: Read state changes before this time are skipped
+
+        :return: List of message IDs, in no particular order
+        """
+        with self.lock:
+            return [message_id for message_id, message_data in self.messages.items()
+                    if message_data['recipient'] == recipient and message_data['read']
+                    and message_data.get('read_changed_at', datetime.min) >= since]
+
+
+    def find_unread_since(self, recipient: str, since: Optional[datetime]) -> List[dict]:
+        """
+        Returns a recipient's unread messages sent or marked unread again since a given time
+
+        :param recipient: Recipient's username
+        :param since: Return the unread messages sent or marked unread from then on (every one if None)
+
+        :return: List of full message documents, in no particular order
+        """
+        with self.lock:
+            return [dict(self.messages[message_id]) for timestamp, message_id in self.unread.get(recipient, [])
+                    if since is None or timestamp >= since
+                    or self.messages[message_id].get('read_changed_at', datetime.min) >= since]
+
+
+    def get_encrypted_content(self, message_id: ObjectId) -> Optional[Union[str, bytes]]:
+        """
+        Returns only the encrypted content of a message
+
+        :param message_id: ID of the message
+
+        :return: Encrypted content as stored (Binary or base64 text), or None if the message does not exist
+        """
+        message_data = self.messages.get(message_id)
+        return message_data['encrypted_content'] if message_data is not None else None
+
+
+    def get_encrypted_contents(self, message_ids: List[ObjectId]) -> List[dict]:
+        """
+        Returns the encrypted content of many messages
+
+        :param message_ids: IDs of the messages
+
+        :return: List of {'_id', 'sender', 'recipient', 'read', 'encrypted_content', 'compression' and 'stream'
+                 if any} documents for the messages that exist
+        """
+        fields = ('_id', 'sender', 'recipient', 'read', 'encrypted_content', 'compression', 'stream')
+
+        with self.lock:
+            return [
+                {field: self.messages[message_id][field] for field in fields if field in self.messages[message_id]}
+                for message_id in message_ids if message_id in self.messages
+            ]
+
+
+    def acknowledge(self, message_id: ObjectId, recipient: Optional[str] = None) -> Optional[dict]:
+        """
+        Atomically marks a message read and returns it as it was before
+
+        :param message_id: ID of the message
+        :param recipient: Only acknowledge the message if it was sent to this user (any recipient if None)
+
+        :return: Full message document before the update, or None if not found
+        """
+        with self.lock:
+            message_data = self.messages.get(message_id)
+
+            # Message not found (or not for this recipient): nothing to acknowledge
+            if message_data is None or recipient is not None and message_data['recipient'] != recipient:
+                return None
+
+            before = dict(message_data)
+            self._set_read(message_id, True)
+            return before
+
+
+    def mark_unread(self, message_id: ObjectId) -> None:
+        """
+        Marks a message unread again
+
+        :param message_id: ID of the message
+
+        :return: None
+        """
+        with self.lock:
+            self._set_read(message_id, False)
+
+
+    def mark_read(self, message_ids: List[ObjectId]) -> int:
+        """
+        Marks many messages read at once
+
+        :param message_ids: IDs of the messages
+
+        :return: Number of messages that were unread
+        """
+        count = 0
+
+        with self.lock:
+            for message_id in message_ids:
+                message_data = self.messages.get(message_id)
+                if message_data is not None and not message_data['read']:
+                    self._set_read(message_id, True)
+                    count += 1
+
+        return count
+
+
+    def unread_counts(self, recipient: Optional[str] = None) -> List[dict]:
+        """
+        Recomputes unread counts by scanning the messages
+
+        :param recipient: Only this recipient's messages (every recipient if None)
+
+        :return: List of {'recipient', 'sender', 'unread', 'last_message_at'} documents, one per recipient and sender
+        """
+        groups: Dict[Tuple[str, str], dict] = {}
+
+        with self.lock:
+            for message_data in self.messages.values():
+
+                # Other recipient: not part of this recount
+                if recipient is not None and message_data['recipient'] != recipient:
+                    continue
+
+                key = (message_data['recipient'], message_data['sender'])
+                group = groups.setdefault(key, {'recipient': key[0], 'sender': key[1], 'unread': 0,
+                                                'last_message_at': message_data['timestamp']})
+                group['unread'] += 0 if message_data['read'] else 1
+                group['last_message_at'] = max(group['last_message_at'], message_data['timestamp'])
+
+        return list(groups.values())
+
+
+    def insert_chunks(self, message_id: ObjectId, chunks: Iterable[bytes]) -> int:
+        """
+        Stores the encrypted chunks of a streamed body
+
+        :param message_id: ID of the message the body belongs to
+        :param chunks: Encrypted chunks, in order
+
+        :return: Number of chunks stored
+        """
+        stored = self.chunks.setdefault(message_id, [])
+        for chunk in chunks:
+            stored.append(chunk)
+
+        return len(stored)
+
+
+    def iter_chunks(self, message_id: ObjectId) -> Iterator[bytes]:
+        """
+        Yields the encrypted chunks of a streamed body in order
+
+        :param message_id: ID of the message
+
+        :return: Iterator of encrypted chunks
+        """
+        yield from list(self.chunks.get(message_id, []))
+
+
+    def delete_chunks(self, message_id: ObjectId) -> None:
+        """
+        Removes the chunks of a streamed body
+
+        :param message_id: ID of the message
+
+        :return: None
+        """
+        self.chunks.pop(message_id, None)
+
+
+class InMemorySessionRepository(SessionRepository):
+    """
+    Session storage in a dictionary keyed by token digest
+    """
+
+    def __init__(self) -> None:
+        """
+        Initializes an empty repository
+
+        :return: None
+        """
+        self.sessions: Dict[str, dict] = {}
+
+
+    def save(self, token_digest: str, username: str, user_id: Any, expires_at: datetime) -> None:
+        """
+        Stores a session
+
+        :param token_digest: Digest of the session token
+        :param username: Session user's username
+        :param user_id: Session user's document ID
+        :param expires_at: Expiry time
+
+        :return: None
+        """
+        self.sessions[token_digest] = {
+            '_id': token_digest,
+            'username': username,
+            'user_id': user_id,
+            'expires_at': expires_at
+        }
+
+
+    def find_live(self, token_digest: str, now: datetime) -> Optional[dict]:
+        """
+        Returns a session that has not expired, dropping it if it has
+
+        :param token_digest: Digest of the session token
+        :param now: Current time
+
+        :return: Session document (username, user_id, expires_at), or None
+        """
+        session_data = self.sessions.get(token_digest)
+
+        # Unknown: nothing to return
+        if session_data is None:
+            return None
+
+        # Expired: drop it (there is no TTL monitor here)
+        if session_data['expires_at'] <= now:
+            self.sessions.pop(token_digest, None)
+            return None
+
+        return dict(session_data)
+
+
+    def delete(self, token_digest: str) -> bool:
+        """
+        Removes a session
+
+        :param token_digest: Digest of the session token
+
+        :return: True if removed, False otherwise
+        """
+        return self.sessions.pop(token_digest, None) is not None
+
+
+class InMemorySummaryRepository(SummaryRepository):
+    """
+    Inbox summaries in a dictionary keyed by recipient
+    """
+
+    def __init__(self) -> None:
+        """
+        Initializes an empty repository
+
+        :return: None
+        """
+        self.summaries: Dict[str, dict] = {}
+        self.lock = threading.Lock()
+
+
+    def apply(self, changes: List[SummaryChange]) -> None:
+        """
+        Applies counter changes (only new messages create a summary, like the MongoDB upserts)
+
+        :param changes: Changes to apply
+
+        :return: None
+        """
+        now = datetime.now()
+
+        with self.lock:
+            for change in changes:
+                summary = self.summaries.get(change.recipient)
+
+                # No summary yet: only a new message creates one
+                if summary is None:
+                    if change.delta <= 0:
+                        continue
+                    summary = self.summaries[change.recipient] = {'_id': change.recipient, 'unread': 0,
+                                                                  'last_message_at': None, 'senders': {}}
+
+                summary['unread'] += change.delta
+                summary['senders'][change.sender] = summary['senders'].get(change.sender, 0) + change.delta
+                summary['updated_at'] = now
+
+                # New message: keep the latest message time
+                if change.timestamp is not None and (summary['last_message_at'] is None
+                                                     or change.timestamp > summary['last_message_at']):
+                    summary['last_message_at'] = change.timestamp
+
+
+    def get(self, recipient: str) -> Optional[dict]:
+        """
+        Returns a copy of a recipient's summary
+
+        :param recipient: Recipient's username
+
+        :return: Summary document (senders without unread messages left out), or None
+        """
+        with self.lock:
+            summary = self.summaries.get(recipient)
+
+            # Never received a message
+            if summary is None:
+                return None
+
+            return {**summary, 'unread': max(summary['unread'], 0),
+                    'senders': {sender: count for sender, count in summary['senders'].items() if count > 0}}
+
+
+    def replace(self, summaries: List[dict], started: datetime, recipient: Optional[str] = None) -> None:
+        """
+        Replaces summaries with recomputed ones, then drops the ones not updated since the recomputation started
+
+        :param summaries: Recomputed summary documents
+        :param started: When the recomputation started
+        :param recipient: Only this recipient's summary was recomputed (every summary if None)
+
+        :return: None
+        """
+        with self.lock:
+            for summary in summaries:
+                self.summaries[summary['_id']] = {**summary, 'senders': dict(summary['senders']),
+                                                  'updated_at': started}
+
+            # Leftovers (recipients without messages) that no send touched meanwhile
+            for name in [name for name, summary in self.summaries.items()
+                         if summary['updated_at'] < started and (recipient is None or name == recipient)]:
+                del self.summaries[name]
+
+
+class InProcessFeedSubscription(FeedSubscription):
+    """
+    Subscription to an InProcessMessageFeed, fed through a queue
+    """
+
+    def __init__(self, feed: 'InProcessMessageFeed', recipient: str) -> None:
+        """
+        Initializes the subscription (registered by the feed)
+
+        :param feed: Feed the subscription belongs to
+        :param recipient: Recipient's username
+
+        :return: None
+        """
+        self.feed = feed
+        self.recipient = recipient
+        self.events: 'queue.Queue[FeedEvent]' = queue.Queue()
+        self.closed = False
+
+
+    def next(self, timeout: float) -> Optional[FeedEvent]:
+        """
+        Waits for the next new message
+
+        :param timeout: Maximum time to wait, in seconds
+
+        :return: FeedEvent, or None if nothing arrived in time (or the subscription is closed)
+        """
+
+        # Closed: nothing more to deliver
+        if self.closed:
+            return None
+
+        try:
+            return self.events.get(timeout=timeout)
+
+        # Nothing in time
+        except queue.Empty:
+            return None
+
+
+    def close(self) -> None:
+        """
+        Stops the subscription
+
+        :return: None
+        """
+        self.closed = True
+        self.feed.unsubscribe(self)
+
+
+class InProcessMessageFeed(MessageFeed):
+    """
+    Publish/subscribe within the process: sends call publish() and subscribers get the messages from a queue
+    Used by the in-memory backend, and by the MongoDB backend where change streams are not available
+    (a standalone server), in which case only messages sent by this process are seen
+    Tokens are (feed, sequence) pairs; a subscription resumes after one while it is still in the history
+    """
+
+    def __init__(self, history_size: int = FEED_HISTORY_SIZE) -> None:
+        """
+        Initializes an empty feed
+
+        :param history_size: Messages remembered for resuming subscriptions
+
+        :return: None
+        """
+        # Tokens from another feed (another process) never match this one
+        self.feed_id = uuid.uuid4().hex
+        self.sequence = 0
+        self.history: Deque[Tuple[int, dict]] = deque(maxlen=history_size)
+        self.subscriptions: Dict[str, Set[InProcessFeedSubscription]] = {}
+        self.positions: Dict[str, Any] = {}
+        self.lock = threading.Lock()
+
+
+    def token(self, sequence: int) -> dict:
+        """
+        Builds the resume token of a published message
+
+        :param sequence: Message's sequence number in this feed
+
+        :return: Resume token
+        """
+        return {'feed': self.feed_id, 'sequence': sequence}
+
+
+    def covers(self, resume_token: Any) -> bool:
+        """
+        Checks whether everything published after a token is still in the history (lock held by the caller)
+
+        :param resume_token: Resume token
+
+        :return: True if a subscription can resume exactly after the token, False otherwise
+        """
+
+        # Token from another feed, or not a token of this kind: cannot resume
+        if not isinstance(resume_token, dict) or resume_token.get('feed') != self.feed_id:
+            return False
+
+        oldest = self.history[0][0] if self.history else self.sequence + 1
+        return oldest - 1 <= resume_token['sequence'] <= self.sequence
+
+
+    def publish(self, messages_data: List[dict]) -> None:
+        """
+        Delivers stored messages to their recipients' subscriptions and remembers them
+
+        :param messages_data: Stored message documents (with their _id)
+
+        :return: None
+        """
+        with self.lock:
+            for message_data in messages_data:
+                self.sequence += 1
+                header = {field: value for field, value in message_data.items() if field != 'encrypted_content'}
+                self.history.append((self.sequence, header))
+
+                for subscription in self.subscriptions.get(header['recipient'], ()):
+                    subscription.events.put(FeedEvent(header, self.token(self.sequence)))
+
+
+    def subscribe(self, recipient: str, resume_token: Any = None) -> InProcessFeedSubscription:
+        """
+        Starts delivering a recipient's new messages, first replaying those after the token if still remembered
+
+        :param recipient: Recipient's username
+        :param resume_token: Token of the last message already handled (None from now)
+
+        :return: InProcessFeedSubscription
+        """
+        subscription = InProcessFeedSubscription(self, recipient)
+
+        with self.lock:
+
+            # Token still covered: replay what the subscriber missed, in order
+            if self.covers(resume_token):
+                for sequence, header in self.history:
+                    if sequence > resume_token['sequence'] and header['recipient'] == recipient:
+                        subscription.events.put(FeedEvent(header, self.token(sequence)))
+                subscription.resumed = True
+
+            self.subscriptions.setdefault(recipient, set()).add(subscription)
+
+        return subscription
+
+
+    def unsubscribe(self, subscription: InProcessFeedSubscription) -> None:
+        """
+        Stops delivering to a subscription
+
+        :param subscription: Subscription to drop
+
+        :return: None
+        """
+        with self.lock:
+            subscriptions = self.subscriptions.get(subscription.recipient, set())
+            subscriptions.discard(subscription)
+
+            # Last subscriber of the recipient gone: drop the entry
+            if not subscriptions:
+                self.subscriptions.pop(subscription.recipient, None)
+
+
+    def load_position(self, key: str) -> Any:
+        """
+        Returns a subscriber's saved resume token
+
+        :param key: Subscriber key
+
+        :return: Resume token, or None if nothing was saved
+        """
+        return self.positions.get(key)
+
+
+    def save_position(self, key: str, token: Any) -> None:
+        """
+        Saves a subscriber's resume token
+
+        :param key: Subscriber key
+        :param token: Token of the last message handled
+
+        :return: None
+        """
+        self.positions[key] = token
+
+
+class InMemoryBackend(StorageBackend):
+    """
+    Keeps users, messages, sessions and inbox summaries in process memory (nothing survives the process)
+    New messages are announced through an in-process feed
+    """
+
+    def __init__(self) -> None:
+        """
+        Initializes empty repositories
+
+        :return: None
+        """
+        self.user_repository = InMemoryUserRepository()
+        self.message_repository = InMemoryMessageRepository()
+        self.session_repository = InMemorySessionRepository()
+        self.summary_repository = InMemorySummaryRepository()
+        self.message_feed = InProcessMessageFeed()
+
+
+    def get_user_repository(self) -> InMemoryUserRepository:
+        """
+        Returns the user repository
+
+        :return: InMemoryUserRepository instance
+        """
+        return self.user_repository
+
+
+    def get_message_repository(self) -> InMemoryMessageRepository:
+        """
+        Returns the message repository
+
+        :return: InMemoryMessageRepository instance
+        """
+        return self.message_repository
+
+
+    def get_session_repository(self) -> InMemorySessionRepository:
+        """
+        Returns the session repository
+
+        :return: InMemorySessionRepository instance
+        """
+        return self.session_repository
+
+
+    def get_summary_repository(self) -> InMemorySummaryRepository:
+        """
+        Returns the inbox summary repository
+
+        :return: InMemorySummaryRepository instance
+        """
+        return self.summary_repository
+
+
+    def get_message_feed(self) -> InProcessMessageFeed:
+        """
+        Returns the new-message feed
+
+        :return: InProcessMessageFeed instance
+        """
+        return self.message_feed
+
+
+    def close(self) -> None:
+        """
+        Nothing to release (data stays available until the backend is garbage collected)
+
+        :return: None
+        """
+        return None
@@ -0,0 +1,931 @@
+"""
+MongoDB implementation of the storage interfaces
+"""
+
+# --- IMPORTS ---
+from bson import Binary
+from bson import ObjectId
+from datetime import datetime
+from ciphermail.storage.base import FeedEvent
+from ciphermail.storage.base import FeedSubscription
+from ciphermail.storage.base import MessageFeed
+from ciphermail.storage.base import MessageRepository
+from ciphermail.storage.base import SessionRepository
+from ciphermail.storage.base import SummaryChange
+from ciphermail.storage.base import SummaryRepository
+from ciphermail.storage.base import UserRepository
+from ciphermail.storage.memory import InProcessMessageFeed
+from pymongo import ReplaceOne
+from pymongo import ReturnDocument
+from pymongo import UpdateOne
+from pymongo.change_stream import CollectionChangeStream
+from pymongo.collection import Collection
+from pymongo.errors import BulkWriteError
+from pymongo.errors import DuplicateKeyError
+from pymongo.errors import OperationFailure
+from pymongo.errors import PyMongoError
+
+import os
+import sys
+import time
+import urllib.parse
+
+
+# --- TYPES ---
+from typing import Any
+from typing import Callable
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+from typing import Union
+
+
+# --- GLOBALS ---
+# Bulk reads need the ciphertext plus what the inbox summary update needs
+CONTENT_PROJECTION = {'sender': 1, 'recipient': 1, 'read': 1, 'encrypted_content': 1, 'compression': 1, 'stream': 1}
+
+# Inbox listings only need headers, never the ciphertext
+HEADER_PROJECTION = {'encrypted_content': 0}
+
+# Newest first, _id breaks timestamp ties so pages never overlap
+INBOX_SORT = [('timestamp', -1), ('_id', -1)]
+
+# Message documents written per insert_many call
+BULK_INSERT_CHUNK_SIZE = 1000
+
+# Streamed body chunks written per insert_many call and fetched per round trip
+# (bounds the memory held at once to a few chunks, whatever the body size)
+CHUNK_WRITE_BATCH = 8
+CHUNK_READ_BATCH = 4
+
+# New-message feed: 'auto' (change streams, in-process where the server has none), 'changestream' or 'local'
+MESSAGE_FEED = os.getenv('MESSAGE_FEED', 'auto').lower()
+
+# Longest a change stream waits on the server per round trip (bounds how late a timeout is noticed)
+FEED_MAX_AWAIT_MS = 500
+
+# Server error codes: change streams need a replica set / resume point no longer in the oplog
+CHANGE_STREAMS_UNSUPPORTED = 40573
+CHANGE_STREAM_HISTORY_LOST = 286
+
+
+# --- CODE ---
+def sender_field(sender: str) -> str:
+    """
+    Escapes a username for use as a field name under 'senders' (field names cannot hold '.' or start with '$')
+
+    :param sender: Sender's username
+
+    :return: Field name ('%', '.' and '$' percent-encoded)
+    """
+    return sender.replace('%', '%25').replace('.', '%2E').replace('$', '%24')
+
+
+def acknowledge_update(now: datetime) -> List[dict]:
+    """
+    Builds the update marking a message read, keeping the time it was first read (retention counts from it)
+
+    :param now: Current time
+
+    :return: Pipeline update setting read, read_at if not set yet and, if it was unread, read_changed_at
+    """
+    return [{'$set': {'read': True,
+                      'read_at': {'$ifNull': ['$read_at', now]},
+                      'read_changed_at': {'$cond': ['$read', '$read_changed_at', now]}}}]
+
+
+def mark_unread_update(now: datetime) -> dict:
+    """
+    Builds the update marking a message unread again (its read time goes with it)
+
+    :param now: Current time (recorded as read_changed_at, for inbox cache syncs)
+
+    :return: Update document
+    """
+    return {'$set': {'read': False, 'read_changed_at': now}, '$unset': {'read_at': ''}}
+
+
+def summary_update(change: SummaryChange, now: datetime) -> dict:
+    """
+    Builds the update applying one change to an inbox summary
+
+    :param change: Change to apply
+    :param now: Current time (recorded as updated_at)
+
+    :return: Update document
+    """
+    update = {
+        '$inc': {'unread': change.delta, f'senders.{sender_field(change.sender)}': change.delta},
+        '$set': {'updated_at': now}
+    }
+
+    # New message: keep the latest message time
+    if change.timestamp is not None:
+        update['$max'] = {'last_message_at': change.timestamp}
+
+    return update
+
+
+def summary_from_document(summary: dict) -> dict:
+    """
+    Converts a stored inbox summary to its public form
+
+    :param summary: Stored summary document
+
+    :return: Summary document with plain sender names, senders without unread messages left out,
+             and an unread count never below zero
+    """
+    return {
+        **summary,
+        'unread': max(summary.get('unread', 0), 0),
+        'senders': {urllib.parse.unquote(field): count
+                    for field, count in summary.get('senders', {}).items() if count > 0}
+    }
+
+
+def unread_counts_pipeline(recipient: Optional[str] = None) -> List[dict]:
+    """
+    Builds the aggregation recounting unread messages per recipient and sender
+
+    :param recipient: Only this recipient's messages (every recipient if None)
+
+    :return: Aggregation pipeline yielding {'recipient', 'sender', 'unread', 'last_message_at'} documents
+    """
+    pipeline = [{'$match': {'recipient': recipient}}] if recipient is not None else []
+    return pipeline + [
+        {'$group': {
+            '_id': {'recipient': '$recipient', 'sender': '$sender'},
+            'unread': {'$sum': {'$cond': [{'$eq': ['$read', False]}, 1, 0]}},
+            'last_message_at': {'$max': '$timestamp'}
+        }},
+        {'$project': {'_id': 0, 'recipient': '$_id.recipient', 'sender': '$_id.sender',
+                      'unread': 1, 'last_message_at': 1}},
+    ]
+
+
+def summary_replacements(summaries: List[dict], started: datetime) -> List[ReplaceOne]:
+    """
+    Builds the writes storing recomputed summaries
+
+    :param summaries: Recomputed summary documents (plain sender names)
+    :param started: When the recomputation started (recorded as updated_at)
+
+    :return: List of upserting ReplaceOne operations
+    """
+    return [
+        ReplaceOne({'_id': summary['_id']},
+                   {**summary, 'senders': {sender_field(sender): count for sender, count in summary['senders'].items()},
+                    'updated_at': started},
+                   upsert=True)
+        for summary in summaries
+    ]
+
+
+def stale_summaries_query(started: datetime, recipient: Optional[str] = None) -> dict:
+    """
+    Builds the query matching summaries a recomputation left behind (recipients without messages)
+    that no send or read touched meanwhile
+
+    :param started: When the recomputation started
+    :param recipient: Only this recipient's summary was recomputed (every summary if None)
+
+    :return: Query document
+    """
+    query = {'updated_at': {'$lt': started}}
+    if recipient is not None:
+        query['_id'] = recipient
+    return query
+
+
+def inbox_feed_pipeline(recipient: str) -> List[dict]:
+    """
+    Builds the change stream pipeline delivering a recipient's new messages
+    Filtered on the server, and without the ciphertext (loaded on access like inbox pages)
+
+    :param recipient: Recipient's username
+
+    :return: Change stream pipeline
+    """
+    return [
+        {'$match': {'operationType': 'insert', 'fullDocument.recipient': recipient}},
+        {'$project': {'fullDocument.encrypted_content': 0}},
+    ]
+
+
+def inserted_message(change: dict) -> Optional[dict]:
+    """
+    Extracts the new message from a change on the messages collection
+
+    :param change: Insert change (pipeline from inbox_feed_pipeline)
+
+    :return: Message header document
+    """
+    return change['fullDocument']
+
+
+def change_stream_token(resume_token: Any) -> Optional[dict]:
+    """
+    Returns a resume token if it comes from a change stream
+
+    :param resume_token: Saved resume token (possibly from the in-process feed)
+
+    :return: Change stream resume token, or None
+    """
+    return resume_token if isinstance(resume_token, dict) and '_data' in resume_token else None
+
+
+def unread_page_query(recipient: str, after: Optional[Tuple[datetime, ObjectId]] = None) -> dict:
+    """
+    Builds the keyset query for a page of unread messages
+
+    :param recipient: Recipient's username
+    :param after: (timestamp, _id) of the last message already returned, or None from the start
+
+    :return: MongoDB filter document
+    """
+    query = {'recipient': recipient, 'read': False}
+
+    # Continuing: only messages strictly after the last one returned
+    if after is not None:
+        timestamp, message_id = after
+        query['$or'] = [
+            {'timestamp': {'$lt': timestamp}},
+            {'timestamp': timestamp, '_id': {'$lt': message_id}}
+        ]
+
+    return query
+
+
+class MongoUserRepository(UserRepository):
+    """
+    User storage on a MongoDB collection
+    """
+
+    def __init__(self, collection: Collection) -> None:
+        """
+        Initializes the repository
+
+        :param collection: Users collection
+
+        :return: None
+        """
+        self.collection = collection
+
+
+    def exists(self, username: str) -> bool:
+        """
+        Checks whether a username is registered (fetches only _id)
+
+        :param username: Username
+
+        :return: True if the user exists, False otherwise
+        """
+        return self.collection.find_one({'username': username}, {'_id': 1}) is not None
+
+
+    def existing_usernames(self, usernames: Iterable[str]) -> Set[str]:
+        """
+        Returns which of the given usernames are registered, with a single $in query
+
+        :param usernames: Usernames to check
+
+        :return: Set of registered usernames
+        """
+        return {
+            user['username'] for user in self.collection.find(
+                {'username': {'$in': list(usernames)}},
+                {'_id': 0, 'username': 1}
+            )
+        }
+
+
+    def find_by_username(self, username: str) -> Optional[dict]:
+        """
+        Returns a user document
+
+        :param username: Username
+
+        :return: User document, or None if not found
+        """
+        return self.collection.find_one({'username': username})
+
+
+    def insert(self, user_data: dict) -> bool:
+        """
+        Stores a new user (sets its _id)
+
+        :param user_data: User document
+
+        :return: True if stored, False if the username is taken
+        """
+        try:
+            self.collection.insert_one(user_data)
+            return True
+
+        # Unique index hit (concurrent registration): username taken
+        except DuplicateKeyError:
+            return False
+
+
+    def replace_password(self, user_id: Any, old_hash: str, new_hash: str) -> bool:
+        """
+        Replaces a password hash if it still has the expected value
+
+        :param user_id: User document ID
+        :param old_hash: Hash expected to be stored
+        :param new_hash: Hash to store
+
+        :return: True if replaced, False otherwise
+        """
+        result = self.collection.update_one(
+            {'_id': user_id, 'password': old_hash},
+            {'$set': {'password': new_hash}}
+        )
+        return result.modified_count > 0
+
+
+class MongoMessageRepository(MessageRepository):
+    """
+    Message storage on a MongoDB collection, with streamed bodies in a chunk collection
+    """
+
+    def __init__(self, collection: Collection, chunks_collection: Collection) -> None:
+        """
+        Initializes the repository
+
+        :param collection: Messages collection
+        :param chunks_collection: Collection of streamed body chunks ({message_id, n, data})
+
+        :return: None
+        """
+        self.collection = collection
+        self.chunks_collection = chunks_collection
+
+
+    def insert(self, message_data: dict) -> ObjectId:
+        """
+        Stores a message (sets its _id)
+
+        :param message_data: Message document
+
+        :return: ID of the stored message
+        """
+        return self.collection.insert_one(message_data).inserted_id
+
+
+    def insert_many(self, messages_data: List[dict]) -> Set[int]:
+        """
+        Stores many messages with chunked, unordered insert_many calls
+
+        :param messages_data: Message documents
+
+        :return: Positions (in messages_data) of the messages that could not be stored
+        """
+        failed_indexes = set()
+
+        for start in range(0, len(messages_data), BULK_INSERT_CHUNK_SIZE):
+            chunk = messages_data[start:start + BULK_INSERT_CHUNK_SIZE]
+            try:
+                self.collection.insert_many(chunk, ordered=False)
+
+            # Partial failure: remember which documents were not written
+            except BulkWriteError as e:
+                failed_indexes.update(start + error['index'] for error in e.details.get('writeErrors', []))
+
+            # Chunk-level failure (e.g. network): count the whole chunk as failed
+            except PyMongoError as e:
+                print(f'Error storing messages: {e}', file=sys.stderr)
+                failed_indexes.update(range(start, start + len(chunk)))
+
+        return failed_indexes
+
+
+    def find_unread(self, recipient: str) -> List[dict]:
+        """
+        Returns every unread message of a recipient, newest first
+
+        :param recipient: Recipient's username
+
+        :return: List of full message documents
+        """
+        return list(self.collection.find({'recipient': recipient, 'read': False}).sort('timestamp', -1))
+
+
+    def find_unread_page(self,
+                         recipient: str,
+                         after: Optional[Tuple[datetime, ObjectId]],
+                         limit: int) -> List[dict]:
+        """
+        Returns unread message headers of a recipient, newest first, after a keyset position
+
+        :param recipient: Recipient's username
+        :param after: (timestamp, _id) of the last message already returned, or None from the start
+        :param limit: Maximum number of headers
+
+        :return: List of message documents without encrypted_content
+        """
+        return list(self.collection.find(unread_page_query(recipient, after), HEADER_PROJECTION)
+                                   .sort(INBOX_SORT)
+                                   .limit(limit))
+
+
+    def find_read_since(self, recipient: str, since: datetime) -> List[ObjectId]:
+        """
+        Returns the IDs of a recipient's messages marked read since a given time (for inbox cache syncs)
+        Only the messages whose read state changed are looked at, through the read_changed_at index
+
+        :param recipient: Recipient's username
+        :param since: Read state changes before this time are skipped
+
+        :return: List of message IDs, in no particular order
+        """
+        return [message_data['_id'] for message_data in
+                self.collection.find({'recipient': recipient, 'read_changed_at': {'$gte': since}, 'read': True},
+                                     {'_id': 1})]
+
+
+    def find_unread_since(self, recipient: str, since: Optional[datetime]) -> List[dict]:
+        """
+        Returns a recipient's unread messages sent or marked unread again since a given time
+        Each branch of the $or has its own index (timestamp in the inbox index, read_changed_at)
+
+        :param recipient: Recipient's username
+        :param since: Return the unread messages sent or marked unread from then on (every one if None)
+
+        :return: List of full message documents, in no particular order
+        """
+        query = {'recipient': recipient, 'read': False}
+
+        # Known sync time: only what changed since
+        if since is not None:
+            query['$or'] = [{'timestamp': {'$gte': since}}, {'read_changed_at': {'$gte': since}}]
+
+        return list(self.collection.find(query))
+
+
+    def get_encrypted_content(self, message_id: ObjectId) -> Optional[Union[str, bytes]]:
+        """
+        Returns only the encrypted content of a message
+
+        :param message_id: ID of the message
+
+        :return: Encrypted content as stored (Binary or base64 text), or None if the message does not exist
+        """
+        message_data = self.collection.find_one({'_id': message_id}, {'_id': 0, 'encrypted_content': 1})
+
+        # Message not found: nothing to load
+        if message_data is None:
+            return None
+
+        return message_data.get('encrypted_content')
+
+
+    def get_encrypted_contents(self, message_ids: List[ObjectId]) -> List[dict]:
+        """
+        Returns the encrypted content of many messages with a single $in query
+
+        :param message_ids: IDs of the messages
+
+        :return: List of {'_id', 'sender', 'recipient', 'read', 'encrypted_content', 'compression' and 'stream'
+                 if any} documents for the messages that exist
+        """
+        return list(self.collection.find({'_id': {'$in': message_ids}}, CONTENT_PROJECTION))
+
+
+    def acknowledge(self, message_id: ObjectId, recipient: Optional[str] = None) -> Optional[dict]:
+        """
+        Marks a message read and returns it as it was before, in one round trip
+
+        :param message_id: ID of the message
+        :param recipient: Only acknowledge the message if it was sent to this user (any recipient if None)
+
+        :return: Full message document before the update, or None if not found
+        """
+        query = {'_id': message_id} if recipient is None else {'_id': message_id, 'recipient': recipient}
+        now = datetime.now()
+
+        message_data = self.collection.find_one_and_update(
+            query,
+            acknowledge_update(now),
+            return_document=ReturnDocument.BEFORE
+        )
+
+        # Streamed body read for the first time: date its chunks too, so a read TTL expires them with it
+        if message_data is not None and message_data.get('stream') is not None and not message_data['read']:
+            self.date_chunks(message_id, now)
+
+        return message_data
+
+
+    def date_chunks(self, message_id: ObjectId, read_at: Optional[datetime]) -> None:
+        """
+        Sets (or clears) the read time on the chunks of a streamed body
+
+        :param message_id: ID of the message
+        :param read_at: Time of the first read (None: unread again)
+
+        :return: None
+        """
+        update = {'$set': {'read_at': read_at}} if read_at is not None else {'$unset': {'read_at': ''}}
+        self.chunks_collection.update_many({'message_id': message_id}, update)
+
+
+    def mark_unread(self, message_id: ObjectId) -> None:
+        """
+        Marks a message unread again
+
+        :param message_id: ID of the message
+
+        :return: None
+        """
+        message_data = self.collection.find_one_and_update({'_id': message_id}, mark_unread_update(datetime.now()),
+                                                           {'_id': 0, 'stream': 1})
+
+        # Streamed body: its chunks no longer count as read either
+        if message_data is not None and message_data.get('stream') is not None:
+            self.date_chunks(message_id, None)
+
+
+    def mark_read(self, message_ids: List[ObjectId]) -> int:
+        """
+        Marks many messages read with a single update_many
+
+        :param message_ids: IDs of the messages
+
+        :return: Number of messages that were unread
+        """
+        now = datetime.now()
+        result = self.collection.update_many({'_id': {'$in': message_ids}, 'read': False},
+                                             {'$set': {'read': True, 'read_at': now, 'read_changed_at': now}})
+        return result.modified_count
+
+
+    def unread_counts(self, recipient: Optional[str] = None) -> List[dict]:
+        """
+        Recomputes unread counts with one aggregation, grouped by recipient and sender
+
+        :param recipient: Only this recipient's messages (every recipient if None)
+
+        :return: List of {'recipient', 'sender', 'unread', 'last_message_at'} documents, one per recipient and sender
+        """
+        return list(self.collection.aggregate(unread_counts_pipeline(recipient), allowDiskUse=True))
+
+
+    def insert_chunks(self, message_id: ObjectId, chunks: Iterable[bytes]) -> int:
+        """
+        Stores the encrypted chunks of a streamed body, a few chunks per insert_many call
+
+        :param message_id: ID of the message the body belongs to
+        :param chunks: Encrypted chunks, in order
+
+        :return: Number of chunks stored
+        """
+        batch = []
+        count = 0
+
+        for chunk in chunks:
+            batch.append({'message_id': message_id, 'n': count, 'data': Binary(chunk)})
+            count += 1
+
+            # Batch full: write it and drop it from memory
+            if len(batch) == CHUNK_WRITE_BATCH:
+                self.chunks_collection.insert_many(batch)
+                batch = []
+
+        # Remaining chunks
+        if batch:
+            self.chunks_collection.insert_many(batch)
+
+        return count
+
+
+    def iter_chunks(self, message_id: ObjectId) -> Iterator[bytes]:
+        """
+        Yields the encrypted chunks of a streamed body in order, a few per round trip
+
+        :param message_id: ID of the message
+
+        :return: Iterator of encrypted chunks
+        """
+        cursor = self.chunks_collection.find({'message_id': message_id}, {'_id': 0, 'data': 1}) \
+                                       .sort('n', 1) \
+                                       .batch_size(CHUNK_READ_BATCH)
+
+        for chunk in cursor:
+            yield bytes(chunk['data'])
+
+
+    def delete_chunks(self, message_id: ObjectId) -> None:
+        """
+        Removes the chunks of a streamed body
+
+        :param message_id: ID of the message
+
+        :return: None
+        """
+        self.chunks_collection.delete_many({'message_id': message_id})
+
+
+class MongoSessionRepository(SessionRepository):
+    """
+    Session storage on a TTL-indexed MongoDB collection
+    """
+
+    def __init__(self, collection: Collection) -> None:
+        """
+        Initializes the repository
+
+        :param collection: Sessions collection
+
+        :return: None
+        """
+        self.collection = collection
+
+
+    def save(self, token_digest: str, username: str, user_id: Any, expires_at: datetime) -> None:
+        """
+        Stores a session
+
+        :param token_digest: Digest of the session token
+        :param username: Session user's username
+        :param user_id: Session user's document ID
+        :param expires_at: Expiry time (the TTL index removes the document afterwards)
+
+        :return: None
+        """
+        self.collection.insert_one({
+            '_id': token_digest,
+            'username': username,
+            'user_id': user_id,
+            'expires_at': expires_at
+        })
+
+
+    def find_live(self, token_digest: str, now: datetime) -> Optional[dict]:
+        """
+        Returns a session that has not expired (the TTL monitor runs only once a minute)
+
+        :param token_digest: Digest of the session token
+        :param now: Current time
+
+        :return: Session document (username, user_id, expires_at), or None
+        """
+        return self.collection.find_one({'_id': token_digest, 'expires_at': {'$gt': now}})
+
+
+    def delete(self, token_digest: str) -> bool:
+        """
+        Removes a session
+
+        :param token_digest: Digest of the session token
+
+        :return: True if removed, False otherwise
+        """
+        return self.collection.delete_one({'_id': token_digest}).deleted_count > 0
+
+
+class MongoSummaryRepository(SummaryRepository):
+    """
+    Inbox summaries on a MongoDB collection keyed by recipient
+    Each change is a single-document $inc/$max, so concurrent senders and readers never lose updates
+    """
+
+    def __init__(self, collection: Collection) -> None:
+        """
+        Initializes the repository
+
+        :param collection: Inbox summaries collection
+
+        :return: None
+        """
+        self.collection = collection
+
+
+    def apply(self, changes: List[SummaryChange]) -> None:
+        """
+        Applies counter changes in one round trip
+        Only new messages create a summary; decrements on a missing one are dropped (the repair job rebuilds it)
+
+        :param changes: Changes to apply
+
+        :return: None
+        """
+        now = datetime.now()
+
+        # Single change: plain update
+        if len(changes) == 1:
+            change = changes[0]
+            self.collection.update_one({'_id': change.recipient}, summary_update(change, now),
+                                       upsert=change.delta > 0)
+
+        # Several changes: one unordered bulk write
+        elif changes:
+            self.collection.bulk_write([
+                UpdateOne({'_id': change.recipient}, summary_update(change, now), upsert=change.delta > 0)
+                for change in changes
+            ], ordered=False)
+
+
+    def get(self, recipient: str) -> Optional[dict]:
+        """
+        Returns a recipient's summary by _id
+
+        :param recipient: Recipient's username
+
+        :return: Summary document (sender names unescaped, senders without unread messages left out), or None
+        """
+        summary = self.collection.find_one({'_id': recipient})
+        return summary_from_document(summary) if summary is not None else None
+
+
+    def replace(self, summaries: List[dict], started: datetime, recipient: Optional[str] = None) -> None:
+        """
+        Replaces summaries with recomputed ones, then drops the ones not updated since the recomputation started
+
+        :param summaries: Recomputed summary documents
+        :param started: When the recomputation started
+        :param recipient: Only this recipient's summary was recomputed (every summary if None)
+
+        :return: None
+        """
+        # Recomputed summaries: write them in one round trip
+        if summaries:
+            self.collection.bulk_write(summary_replacements(summaries, started), ordered=False)
+
+        self.collection.delete_many(stale_summaries_query(started, recipient))
+
+
+class MongoFeedSubscription(FeedSubscription):
+    """
+    Subscription backed by a change stream on the message storage collection
+    """
+
+    def __init__(self,
+                 stream: CollectionChangeStream,
+                 resumed: bool,
+                 to_message: Callable[[dict], Optional[dict]] = inserted_message) -> None:
+        """
+        Initializes the subscription
+
+        :param stream: Open change stream (pipeline from the feed)
+        :param resumed: Whether the stream resumed after a token
+        :param to_message: Extracts the new message header from a change (None to skip the change)
+
+        :return: None
+        """
+        self.stream = stream
+        self.resumed = resumed
+        self.to_message = to_message
+
+
+    def next(self, timeout: float) -> Optional[FeedEvent]:
+        """
+        Waits for the next new message, a server round trip of at most FEED_MAX_AWAIT_MS at a time
+
+        :param timeout: Maximum time to wait, in seconds
+
+        :return: FeedEvent, or None if nothing arrived in time (or the subscription is closed)
+        """
+        deadline = time.monotonic() + timeout
+
+        while self.stream.alive:
+            change = self.stream.try_next()
+            message_data = self.to_message(change) if change is not None else None
+
+            # New message: its change _id is the resume token
+            if message_data is not None:
+                return FeedEvent(message_data, change['_id'])
+
+            # Nothing in time
+            if time.monotonic() >= deadline:
+                return None
+
+        return None
+
+
+    def close(self) -> None:
+        """
+        Closes the change stream
+
+        :return: None
+        """
+        self.stream.close()
+
+
+class MongoMessageFeed(MessageFeed):
+    """
+    New messages from change streams filtered by recipient, resumable from the last change handled
+    Change streams need a replica set (or sharded cluster); on a standalone server ('auto' mode) subscriptions
+    fall back to an in-process feed, which only sees messages sent by this process
+    Subscriber positions are kept in a collection keyed by subscriber
+    """
+
+    def __init__(self,
+                 collection: Collection,
+                 positions_collection: Collection,
+                 mode: str = MESSAGE_FEED,
+                 pipeline: Callable[[str], List[dict]] = inbox_feed_pipeline,
+                 to_message: Callable[[dict], Optional[dict]] = inserted_message) -> None:
+        """
+        Initializes the feed
+
+        :param collection: Collection the messages are stored in
+        :param positions_collection: Collection of saved resume tokens ({_id: subscriber key, token, updated_at})
+        :param mode: 'auto', 'changestream' or 'local'
+        :param pipeline: Builds the change stream pipeline of a recipient's new messages
+        :param to_message: Extracts the new message header from a change (None to skip the change)
+
+        :return: None
+        """
+        self.collection = collection
+        self.positions_collection = positions_collection
+        self.pipeline = pipeline
+        self.to_message = to_message
+        self.fallback = InProcessMessageFeed()
+
+        # Whether change streams are used (None until the first subscription finds out, in 'auto' mode)
+        self.change_streams: Optional[bool] = {'changestream': True, 'local': False}.get(mode)
+
+
+    def publish(self, messages_data: List[dict]) -> None:
+        """
+        Announces stored messages to in-process subscribers (unneeded once change streams are known to work)
+
+        :param messages_data: Stored message documents (with their _id)
+
+        :return: None
+        """
+
+        # Change streams in use: the server delivers every message
+        if self.change_streams:
+            return
+
+        self.fallback.publish(messages_data)
+
+
+    def subscribe(self, recipient: str, resume_token: Any = None) -> FeedSubscription:
+        """
+        Opens a change stream on the recipient's new messages, resuming after the token if the oplog still has it
+
+        :param recipient: Recipient's username
+        :param resume_token: Token of the last message already handled (None from now)
+
+        :return: MongoFeedSubscription, or an in-process subscription where change streams are not available
+
+        :raises OperationFailure: If the change stream cannot be opened for another reason
+        """
+
+        # In-process feed chosen or detected: no change stream
+        if self.change_streams is False:
+            return self.fallback.subscribe(recipient, resume_token)
+
+        token = change_stream_token(resume_token)
+
+        try:
+            stream = self.collection.watch(self.pipeline(recipient), resume_after=token,
+                                           max_await_time_ms=FEED_MAX_AWAIT_MS)
+            self.change_streams = True
+            return MongoFeedSubscription(stream, token is not None, self.to_message)
+
+        except OperationFailure as e:
+
+            # Resume point no longer in the oplog: start from now (the subscriber lists its inbox once)
+            if token is not None and e.code == CHANGE_STREAM_HISTORY_LOST:
+                stream = self.collection.watch(self.pipeline(recipient), max_await_time_ms=FEED_MAX_AWAIT_MS)
+                return MongoFeedSubscription(stream, False, self.to_message)
+
+            # Standalone server in 'auto' mode: use the in-process feed from now on
+            if e.code == CHANGE_STREAMS_UNSUPPORTED and self.change_streams is None:
+                self.change_streams = False
+                return self.fallback.subscribe(recipient, resume_token)
+
+            raise
+
+
+    def load_position(self, key: str) -> Any:
+        """
+        Returns a subscriber's saved resume token
+
+        :param key: Subscriber key
+
+        :return: Resume token, or None if nothing was saved
+        """
+        position = self.positions_collection.find_one({'_id': key})
+        return position['token'] if position is not None else None
+
+
+    def save_position(self, key: str, token: Any) -> None:
+        """
+        Saves a subscriber's resume token
+
+        :param key: Subscriber key
+        :param token: Token of the last message handled
+
+        :return: None
+        """
+        self.positions_collection.update_one({'_id': key},
+                                             {'$set': {'token': token, 'updated_at': datetime.now()}},
+                                             upsert=True)
@@ -0,0 +1,42 @@
+"""
+Shared test setup: cheap password hashing and the in-memory backend, before any service module is imported
+Tests needing MongoDB run against CIPHERMAIL_TEST_MONGODB_URI (a throwaway database on it), and are skipped without it
+"""
+
+# --- IMPORTS ---
+import os
+import pytest
+
+
+# --- GLOBALS ---
+# Module globals read these at import time
+os.environ.setdefault('SCRYPT_LOG_N', '10')
+os.environ.setdefault('CIPHERMAIL_STORAGE', 'memory')
+os.environ.setdefault('INBOX_CACHE_PATH', '')
+
+# MongoDB server for the tests that need one (dropped database: ciphermail_test)
+TEST_MONGODB_URI = os.getenv('CIPHERMAIL_TEST_MONGODB_URI', '')
+TEST_DATABASE = 'ciphermail_test'
+
+
+# --- CODE ---
+@pytest.fixture
+def mongo_settings():
+    """
+    Settings of an empty test database, dropped again afterwards
+    """
+    from ciphermail.config.settings import DatabaseSettings
+    from pymongo import MongoClient
+
+    # No server configured: these tests cannot run here
+    if not TEST_MONGODB_URI:
+        pytest.skip('CIPHERMAIL_TEST_MONGODB_URI is not set')
+
+    settings = DatabaseSettings(uri=TEST_MONGODB_URI, database_name=TEST_DATABASE, server_selection_timeout_ms=2000)
+    client = MongoClient(TEST_MONGODB_URI, serverSelectionTimeoutMS=2000)
+    client.drop_database(TEST_DATABASE)
+
+    yield settings
+
+    client.drop_database(TEST_DATABASE)
+    client.close()
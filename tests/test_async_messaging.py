@@ -0,0 +1,116 @@
+"""
+Tests for the asyncio services (the MongoDB ones need CIPHERMAIL_TEST_MONGODB_URI)
+"""
+
+# --- IMPORTS ---
+from ciphermail.config.async_database import AsyncDatabaseManager
+from ciphermail.config.database import DatabaseManager
+from ciphermail.config.settings import DatabaseSettings
+from ciphermail.services.async_auth import AsyncAuthManager
+from ciphermail.services.async_messaging import AsyncMessagingManager
+from ciphermail.services.auth import AuthManager
+from ciphermail.services.messaging import MessagingManager
+
+import asyncio
+import io
+import pytest
+
+
+# --- GLOBALS ---
+PASSWORD = 'correct horse battery staple'
+KEY = 'test-key'
+
+
+# --- CODE ---
+@pytest.fixture
+def sync_backend(mongo_settings):
+    backend = DatabaseManager(mongo_settings, shared=False)
+    auth_manager = AuthManager(backend)
+    for username in ('alice', 'bob'):
+        assert auth_manager.register(username, PASSWORD)
+    yield backend
+    backend.close()
+
+
+def run_async(settings: DatabaseSettings, work):
+    """
+    Runs work(AsyncMessagingManager) on a fresh event loop and client
+    """
+    async def main():
+        db_manager = AsyncDatabaseManager(settings)
+        try:
+            assert await db_manager.ensure_indexes()
+            return await work(AsyncMessagingManager(db_manager))
+        finally:
+            await db_manager.close()
+
+    return asyncio.run(main())
+
+
+def test_bucket_layout_is_refused():
+    with pytest.raises(ValueError):
+        AsyncDatabaseManager(DatabaseSettings(), layout='bucket')
+    with pytest.raises(ValueError):
+        AsyncDatabaseManager(DatabaseSettings(), layout='nonsense')
+
+
+def test_streamed_message_is_read_from_its_chunks(mongo_settings, sync_backend):
+    body = b'streamed body ' * 1000
+    messaging = MessagingManager(sync_backend)
+    assert messaging.send_stream('alice', 'bob', io.BytesIO(body), KEY, chunk_size=1024)
+    message_id = messaging.get_unread_messages('bob')[0]._id
+
+    # Wrong key: nothing returned, message still unread
+    assert run_async(mongo_settings, lambda manager: manager.read_message(message_id, 'wrong-key')) is None
+    assert [message._id for message in messaging.get_unread_messages('bob')] == [message_id]
+
+    assert run_async(mongo_settings, lambda manager: manager.read_message(message_id, KEY)) == body.decode()
+    assert messaging.get_unread_messages('bob') == []
+
+
+def test_register_matches_the_sync_checks(mongo_settings):
+    async def main():
+        db_manager = AsyncDatabaseManager(mongo_settings)
+        try:
+            assert await db_manager.ensure_indexes()
+            auth_manager = AsyncAuthManager(db_manager)
+            first, second = await asyncio.gather(auth_manager.register('dave', PASSWORD),
+                                                 auth_manager.register('dave', PASSWORD))
+            return (first, second,
+                    await auth_manager.register('dave', PASSWORD),
+                    await auth_manager.login('dave', PASSWORD) is not None)
+        finally:
+            await db_manager.close()
+
+    first, second, again, logged_in = asyncio.run(main())
+    assert sorted([first, second]) == [False, True]
+    assert again is False and logged_in
+
+
+def test_token_shaped_username_is_reserved():
+    async def main():
+        db_manager = AsyncDatabaseManager(DatabaseSettings())
+        try:
+            return await AsyncAuthManager(db_manager).register('cms_abc', PASSWORD)
+        finally:
+            await db_manager.close()
+
+    # Refused before any round trip, so no server is needed
+    assert asyncio.run(main()) is False
+
+
+def test_reads_are_restricted_to_the_reader(mongo_settings, sync_backend):
+    messaging = MessagingManager(sync_backend)
+    assert messaging.send_message('alice', 'bob', 'inline', KEY)
+    assert messaging.send_stream('alice', 'bob', io.BytesIO(b'streamed'), KEY, chunk_size=4)
+    ids = [message._id for message in messaging.get_unread_messages('bob')]
+
+    # Someone else's messages: not found, left unread
+    assert run_async(mongo_settings, lambda manager: manager.read_message(ids[0], KEY, 'alice')) is None
+    results = run_async(mongo_settings, lambda manager: manager.read_messages_bulk(ids, KEY, 'alice'))
+    assert results == dict.fromkeys(ids)
+    assert len(messaging.get_unread_messages('bob')) == 2
+
+    results = run_async(mongo_settings, lambda manager: manager.read_messages_bulk(ids, KEY, 'bob'))
+    assert sorted(results.values()) == ['inline', 'streamed']
+    assert messaging.get_unread_messages('bob') == []
@@ -0,0 +1,113 @@
+"""
+Tests for the bucket message layout (the MongoDB ones need CIPHERMAIL_TEST_MONGODB_URI)
+"""
+
+# --- IMPORTS ---
+from bson import ObjectId
+from datetime import datetime
+from datetime import timedelta
+from ciphermail.services.auth import AuthManager
+from ciphermail.services.inbox_cache import InboxCache
+from ciphermail.services.messaging import MessagingManager
+from ciphermail.storage import buckets
+from ciphermail.storage.buckets import merge_buckets
+
+import pytest
+import time
+
+
+# --- GLOBALS ---
+PASSWORD = 'correct horse battery staple'
+KEY = 'test-key'
+NOON = datetime(2024, 1, 1, 12)
+
+
+# --- CODE ---
+def bucket(end_offset: int, *offsets: int) -> dict:
+    """
+    Bucket of unread messages at NOON + offsets (minutes), ending at NOON + end_offset
+    """
+    return {'recipient': 'bob', 'end': NOON + timedelta(minutes=end_offset),
+            'messages': [{'_id': ObjectId(), 'timestamp': NOON + timedelta(minutes=offset)} for offset in offsets]}
+
+
+def test_merge_stops_once_older_buckets_cannot_matter():
+    consumed = []
+
+    def stream():
+        for item in (bucket(10, 10, 2), bucket(8, 8, 7), bucket(5, 5), bucket(1, 1)):
+            consumed.append(item)
+            yield item
+
+    messages = merge_buckets(stream(), 3)
+
+    assert [message['timestamp'].minute for message in messages] == [10, 8, 7]
+    assert all(message['recipient'] == 'bob' for message in messages)
+    assert len(consumed) == 3
+
+
+@pytest.fixture
+def bucket_messaging(mongo_settings, monkeypatch):
+    from ciphermail.config.database import DatabaseManager
+    monkeypatch.setattr(buckets, 'BUCKET_CAPACITY', 3)
+    backend = DatabaseManager(mongo_settings, shared=False, layout='bucket')
+    auth_manager = AuthManager(backend)
+    for username in ('alice', 'bob'):
+        assert auth_manager.register(username, PASSWORD)
+    yield backend, MessagingManager(backend)
+    backend.close()
+
+
+def test_bucket_layout_pages_and_marks_read(bucket_messaging):
+    backend, messaging = bucket_messaging
+    for n in range(7):
+        assert messaging.send_message('alice', 'bob', f'message {n}', KEY)
+    assert backend.message_buckets.count_documents({'recipient': 'bob'}) == 3
+
+    ids, token = [], None
+    while True:
+        page, token = messaging.get_unread_page('bob', 2, token)
+        ids.extend(message._id for message in page)
+        if token is None:
+            break
+    assert len(set(ids)) == 7 and ids == sorted(ids, reverse=True)
+
+    # One read, then a bulk read spanning buckets: per-bucket unread counts follow
+    assert messaging.read_message(ids[0], KEY, 'bob') == 'message 6'
+    results = messaging.read_messages_bulk(ids[1:5], KEY, 'bob')
+    assert sorted(results.values()) == [f'message {n}' for n in range(2, 6)]
+    assert sum(item['unread'] for item in backend.message_buckets.find({'recipient': 'bob'})) == 2
+    assert messaging.get_inbox_summary('bob').unread == 2
+
+    # Unread again: counted back in its bucket
+    backend.get_message_repository().mark_unread(ids[0])
+    assert [message._id for message in messaging.get_unread_messages('bob')][0] == ids[0]
+
+
+def test_bucket_layout_syncs_the_inbox_cache(bucket_messaging, tmp_path, monkeypatch):
+    monkeypatch.setattr('ciphermail.services.messaging.INBOX_CACHE_SYNC_OVERLAP', 0)
+    backend, messaging = bucket_messaging
+    cache = InboxCache(str(tmp_path / 'inbox.sqlite'))
+    cached = MessagingManager(backend, inbox_cache=cache)
+
+    def sync() -> int:
+        # Past the millisecond of the last change first (a sync also takes what changed in its first millisecond)
+        time.sleep(0.002)
+        return cached.sync_inbox_cache('bob')
+
+    for n in range(5):
+        assert messaging.send_message('alice', 'bob', f'message {n}', KEY)
+
+    assert sync() == 5
+    assert sync() == 0
+
+    # Read elsewhere, one then in bulk: dropped without a fetch; marked unread again: fetched back
+    ids = sorted(cache.message_ids('bob'))
+    assert messaging.read_message(ids[0], KEY, 'bob') == 'message 0'
+    assert backend.get_message_repository().mark_read(ids[1:3]) == 2
+    assert sync() == 0
+    assert cache.message_ids('bob') == set(ids[3:])
+    backend.get_message_repository().mark_unread(ids[0])
+    assert sync() == 1
+    assert cache.message_ids('bob') == {ids[0], *ids[3:]}
+    cache.close()
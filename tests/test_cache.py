@@ -0,0 +1,73 @@
+"""
+Tests for the bounded LRU/TTL cache
+"""
+
+# --- IMPORTS ---
+from ciphermail.services import cache as cache_module
+from ciphermail.services.cache import LRUCache
+
+import pytest
+
+
+# --- CODE ---
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    Controllable monotonic clock: call clock.advance(seconds)
+    """
+    class Clock:
+        now = 1000.0
+
+        def advance(self, seconds: float) -> None:
+            self.now += seconds
+
+    clock = Clock()
+    monkeypatch.setattr(cache_module.time, 'monotonic', lambda: clock.now)
+    return clock
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = LRUCache(max_size=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+
+    assert cache.get('b') is None and cache.get('a') == 1 and cache.get('c') == 3
+    assert len(cache) == 2
+
+
+def test_cached_none_is_not_a_miss():
+    cache = LRUCache()
+    cache.set('a', None)
+    calls = []
+    assert cache.get_or_create('a', lambda: calls.append(1)) is None and calls == []
+    assert cache.get('missing', 'default') == 'default'
+
+
+def test_entries_expire_after_their_ttl(clock):
+    cache = LRUCache(ttl=10)
+    cache.set('default', 1)
+    cache.set('short', 2, ttl=1)
+
+    clock.advance(5)
+    assert cache.get('short') is None and cache.get('default') == 1
+
+    clock.advance(5)
+    assert cache.get('default') is None and len(cache) == 0
+
+
+def test_zero_size_disables_the_cache():
+    cache = LRUCache(max_size=0)
+    cache.set('a', 1)
+    assert cache.get('a') is None and len(cache) == 0
+
+
+def test_resize_evicts_the_oldest_and_evict_removes_one():
+    cache = LRUCache(max_size=3)
+    for key in 'abc':
+        cache.set(key, key)
+    cache.resize(1)
+    assert cache.get('c') == 'c' and len(cache) == 1
+
+    assert cache.evict('c') and not cache.evict('c')
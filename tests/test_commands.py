@@ -0,0 +1,104 @@
+"""
+Tests for the non-interactive commands and the JSONL batch mode
+"""
+
+# --- IMPORTS ---
+from ciphermail.interface.arguments import build_parser
+from ciphermail.interface.commands import CommandRunner
+from ciphermail.interface.commands import run_batch
+from ciphermail.storage.memory import InMemoryBackend
+
+import io
+import json
+import sys
+
+import pytest
+
+
+# --- GLOBALS ---
+PASSWORD = 'correct horse battery staple'
+KEY = 'test-key'
+
+
+# --- CODE ---
+@pytest.fixture
+def runner() -> CommandRunner:
+    backend = InMemoryBackend()
+    runner = CommandRunner(backend, 'alice', PASSWORD, KEY)
+    assert runner.run({'op': 'register'})['ok']
+    return runner
+
+
+def batch(runner: CommandRunner, *operations) -> list:
+    output = io.StringIO()
+    run_batch(runner, io.StringIO(''.join(json.dumps(operation) + '\n' for operation in operations)), output)
+    return [json.loads(line) for line in output.getvalue().splitlines()]
+
+
+def test_send_and_read_round_trip(runner):
+    results = batch(runner,
+                    {'op': 'send', 'to': '@alice', 'message': 'hello'},
+                    {'op': 'inbox'})
+    assert results[0] == {'ok': True, 'to': 'alice'}
+    message_id = results[1]['messages'][0]['id']
+    assert batch(runner, {'op': 'read', 'id': message_id})[0]['message'] == 'hello'
+
+
+@pytest.mark.parametrize('operation, field', [
+    ({'op': 'send', 'to': 5, 'message': 'hello'}, 'to'),
+    ({'op': 'send', 'to': 'alice', 'message': 5}, 'message'),
+    ({'op': 'send', 'to': 'alice', 'message': 'hello', 'key': ['k']}, 'key'),
+    ({'op': 'register', 'username': 7, 'password': PASSWORD}, 'username'),
+    ({'op': 'read', 'id': 12}, 'id'),
+    ({'op': 'inbox', 'limit': '5'}, 'limit'),
+    ({'op': 'inbox', 'limit': True}, 'limit'),
+    ({'op': 'inbox', 'page_token': 3}, 'page_token'),
+])
+def test_mistyped_operands_are_reported_per_line(runner, operation, field):
+    results = batch(runner, operation, {'op': 'send', 'to': 'alice', 'message': 'still running'})
+    assert results[0]['ok'] is False and field in results[0]['error']
+    assert results[1] == {'ok': True, 'to': 'alice'}
+
+
+def test_unexpected_errors_do_not_stop_the_batch(runner, monkeypatch):
+    def broken(*args, **kwargs):
+        raise RuntimeError('storage down')
+
+    monkeypatch.setattr(runner.messaging_manager, 'get_unread_page', broken)
+    results = batch(runner, {'op': 'inbox'}, {'op': 'send', 'to': 'alice', 'message': 'hello'})
+    assert results[0] == {'ok': False, 'error': 'RuntimeError: storage down'}
+    assert results[1]['ok']
+
+
+def test_bad_lines_are_reported(runner):
+    output = io.StringIO()
+    assert not run_batch(runner, io.StringIO('not json\n[1]\n{"op": "nope", "ref": 4}\n'), output)
+    results = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert [result['ok'] for result in results] == [False, False, False]
+    assert results[2]['ref'] == 4
+
+
+def test_service_errors_stay_off_the_batch_output(runner, monkeypatch, capsys):
+    def broken(*args, **kwargs):
+        raise RuntimeError('storage down')
+
+    monkeypatch.setattr(runner.messaging_manager.messages, 'insert', broken)
+    assert not run_batch(runner, io.StringIO('{"op": "send", "to": "alice", "message": "hello"}\n'), sys.stdout)
+    captured = capsys.readouterr()
+    assert [json.loads(line) for line in captured.out.splitlines()] == [{'ok': False,
+                                                                           'error': 'Failed to send message'}]
+    assert 'storage down' in captured.err
+
+
+@pytest.mark.parametrize('limit', [0, -1])
+def test_inbox_limit_below_one_is_reported(runner, limit):
+    results = batch(runner, {'op': 'inbox', 'limit': limit}, {'op': 'inbox', 'limit': 1})
+    assert results[0]['ok'] is False and 'limit' in results[0]['error']
+    assert results[1]['ok']
+
+
+@pytest.mark.parametrize('limit', ['0', '-1', 'ten'])
+def test_inbox_limit_argument_must_be_positive(limit, capsys):
+    with pytest.raises(SystemExit):
+        build_parser().parse_args(['inbox', '--limit', limit])
+    assert '--limit' in capsys.readouterr().err
@@ -0,0 +1,59 @@
+"""
+Tests for compression before encryption and its decompression caps
+"""
+
+# --- IMPORTS ---
+from ciphermail.services import compression
+from ciphermail.services.compression import COMPRESSORS
+from ciphermail.services.encryption import EncryptionManager
+
+import os
+import pytest
+
+
+# --- GLOBALS ---
+KEY = 'test-key'
+TEXT = b'all work and no play makes jack a dull boy ' * 100
+
+
+# --- CODE ---
+@pytest.mark.parametrize('algorithm', sorted(COMPRESSORS))
+def test_round_trip(algorithm):
+    data, used = compression.compress(TEXT, algorithm)
+    assert used == algorithm and len(data) < len(TEXT)
+    assert compression.decompress(data, used) == TEXT
+
+
+@pytest.mark.parametrize('algorithm', sorted(COMPRESSORS))
+def test_small_or_incompressible_text_is_stored_as_is(algorithm):
+    small = b'x' * (compression.COMPRESSION_THRESHOLD - 1)
+    noise = os.urandom(4096)
+    assert compression.compress(small, algorithm) == (small, None)
+    assert compression.compress(noise, algorithm) == (noise, None)
+
+
+@pytest.mark.parametrize('algorithm', sorted(COMPRESSORS))
+def test_output_above_the_cap_is_refused(algorithm, monkeypatch):
+    bomb, used = compression.compress(b'\0' * 100000, algorithm)
+    monkeypatch.setattr(compression, 'MAX_DECOMPRESSED_SIZE', 1000)
+
+    with pytest.raises(ValueError):
+        compression.decompress(bomb, used)
+
+    # Exactly at the cap: still fine
+    data, used = compression.compress(b'\0' * 1000, algorithm)
+    assert compression.decompress(data, used) == b'\0' * 1000
+
+
+def test_unknown_algorithm_is_refused():
+    with pytest.raises(ValueError):
+        compression.decompress(b'data', 'lzma')
+
+
+def test_oversized_message_decrypts_to_none(monkeypatch):
+    monkeypatch.setattr(compression, 'MESSAGE_COMPRESSION', 'zlib')
+    token, used = EncryptionManager.encrypt_compressed(TEXT.decode(), KEY)
+    assert used == 'zlib' and EncryptionManager.decrypt(token, KEY, used) == TEXT.decode()
+
+    monkeypatch.setattr(compression, 'MAX_DECOMPRESSED_SIZE', 100)
+    assert EncryptionManager.decrypt(token, KEY, used) is None
@@ -0,0 +1,81 @@
+"""
+Tests for the encryption service
+"""
+
+# --- IMPORTS ---
+from ciphermail.services.encryption import EncryptionManager
+
+import io
+import pytest
+
+
+# --- GLOBALS ---
+KEY = 'test-key'
+CHUNK_SIZE = 16
+
+
+# --- CODE ---
+class TrickleReader(io.RawIOBase):
+    """
+    Returns at most 5 bytes per read, like a pipe or a socket
+    """
+
+    def __init__(self, data: bytes) -> None:
+        self.data = io.BytesIO(data)
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        return self.data.read(min(size, 5) if size >= 0 else 5)
+
+
+def encrypt(body: bytes, reader_class=io.BytesIO) -> tuple:
+    nonce_prefix, chunks = EncryptionManager.encrypt_stream(reader_class(body), KEY, CHUNK_SIZE)
+    return nonce_prefix, list(chunks)
+
+
+def decrypt(nonce_prefix: bytes, chunks: list, key: str = KEY) -> bytes:
+    writer = io.BytesIO()
+    written = EncryptionManager.decrypt_stream(nonce_prefix, chunks, key, writer)
+    return writer.getvalue() if written is not None else None
+
+
+@pytest.mark.parametrize('size', [0, 1, CHUNK_SIZE - 1, CHUNK_SIZE, CHUNK_SIZE + 1, 5 * CHUNK_SIZE, 1000])
+def test_stream_round_trip(size):
+    body = (bytes(range(256)) * 4)[:size]
+    nonce_prefix, chunks = encrypt(body)
+
+    assert len(chunks) == max(1, -(-size // CHUNK_SIZE))
+    assert decrypt(nonce_prefix, chunks) == body
+
+
+def test_short_reads_still_fill_every_chunk():
+    body = b'z' * 100
+    nonce_prefix, chunks = encrypt(body, TrickleReader)
+    assert len(chunks) == 7 and decrypt(nonce_prefix, chunks) == body
+
+
+def test_each_body_gets_its_own_nonce_prefix():
+    first, _ = encrypt(b'same body')
+    second, _ = encrypt(b'same body')
+    assert first != second and len(first) == 8
+
+
+@pytest.mark.parametrize('tamper', [
+    pytest.param(lambda chunks: [chunks[0][:-1] + bytes([chunks[0][-1] ^ 1])] + chunks[1:], id='flipped-bit'),
+    pytest.param(lambda chunks: [chunks[1], chunks[0]] + chunks[2:], id='reordered'),
+    pytest.param(lambda chunks: chunks[:1] + chunks[2:], id='dropped-middle'),
+    pytest.param(lambda chunks: chunks[:-1], id='truncated'),
+    pytest.param(lambda chunks: chunks + chunks[-1:], id='final-repeated'),
+    pytest.param(lambda chunks: [], id='empty'),
+])
+def test_tampered_stream_is_rejected(tamper):
+    nonce_prefix, chunks = encrypt(b'0123456789abcdef' * 4 + b'tail')
+    assert decrypt(nonce_prefix, tamper(chunks)) is None
+
+
+def test_wrong_key_or_nonce_prefix_is_rejected():
+    nonce_prefix, chunks = encrypt(b'secret body')
+    assert decrypt(nonce_prefix, chunks, 'other-key') is None
+    assert decrypt(bytes(8), chunks) is None
@@ -0,0 +1,111 @@
+"""
+Tests for the local inbox cache and its sync against the in-memory backend
+"""
+
+# --- IMPORTS ---
+from ciphermail.services.auth import AuthManager
+from ciphermail.services.inbox_cache import InboxCache
+from ciphermail.services.messaging import MessagingManager
+from ciphermail.storage.memory import InMemoryBackend
+
+import os
+import pytest
+import time
+
+
+# --- GLOBALS ---
+PASSWORD = 'correct horse battery staple'
+KEY = 'test-key'
+
+
+# --- CODE ---
+@pytest.fixture
+def backend() -> InMemoryBackend:
+    backend = InMemoryBackend()
+    auth_manager = AuthManager(backend)
+    for username in ('alice', 'bob'):
+        assert auth_manager.register(username, PASSWORD)
+    return backend
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = InboxCache(str(tmp_path / 'cache' / 'inbox.sqlite'))
+    yield cache
+    cache.close()
+
+
+def send(messaging: MessagingManager, count: int) -> None:
+    for n in range(count):
+        assert messaging.send_message('alice', 'bob', f'message {n}', KEY)
+
+
+def sync(cached: MessagingManager) -> int:
+    # Past the millisecond of the last change first (a sync also takes what changed in its first millisecond)
+    time.sleep(0.002)
+    return cached.sync_inbox_cache('bob')
+
+
+def test_cache_file_is_private(tmp_path, cache):
+    assert os.stat(tmp_path / 'cache' / 'inbox.sqlite').st_mode & 0o777 == 0o600
+    assert os.stat(tmp_path / 'cache').st_mode & 0o777 == 0o700
+
+
+def test_sync_fetches_only_new_and_returning_documents(backend, cache, monkeypatch):
+    monkeypatch.setattr('ciphermail.services.messaging.INBOX_CACHE_SYNC_OVERLAP', 0)
+    server = MessagingManager(backend)
+    cached = MessagingManager(backend, inbox_cache=cache)
+    send(server, 5)
+
+    assert sync(cached) == 5
+    assert sync(cached) == 0
+
+    # New messages: only they are fetched
+    send(server, 2)
+    assert sync(cached) == 2
+
+    # Read elsewhere: dropped without a fetch; marked unread again: fetched back
+    message_id = server.get_unread_messages('bob')[0]._id
+    assert server.read_message(message_id, KEY) is not None
+    assert sync(cached) == 0
+    assert message_id not in cache.message_ids('bob')
+    backend.get_message_repository().mark_unread(message_id)
+    assert sync(cached) == 1
+    assert len(cache.message_ids('bob')) == 7
+
+    # Read in bulk elsewhere: dropped too
+    assert backend.get_message_repository().mark_read(list(cache.message_ids('bob'))[:3]) == 3
+    assert sync(cached) == 0
+    assert len(cache.message_ids('bob')) == 4
+
+
+def test_sync_overlap_refetches_recent_changes_harmlessly(backend, cache):
+    server = MessagingManager(backend)
+    cached = MessagingManager(backend, inbox_cache=cache)
+    send(server, 3)
+
+    # Everything is within the overlap: fetched again, cached once
+    assert sync(cached) == 3
+    assert sync(cached) == 3
+    assert len(cache.message_ids('bob')) == 3
+
+
+def test_cached_pages_match_the_server(backend, cache):
+    server = MessagingManager(backend)
+    cached = MessagingManager(backend, inbox_cache=cache)
+    send(server, 12)
+
+    def all_pages(messaging: MessagingManager) -> list:
+        ids, token = [], None
+        while True:
+            page, token = messaging.get_unread_page('bob', 5, token)
+            ids.extend(message._id for message in page)
+            if token is None:
+                return ids
+
+    assert all_pages(cached) == all_pages(server)
+
+    # Read through the cached manager: leaves the cache at once
+    message_id = all_pages(cached)[0]
+    assert cached.read_message(message_id, KEY, 'bob') is not None
+    assert message_id not in cache.message_ids('bob')
@@ -0,0 +1,135 @@
+"""
+Tests for the messaging service on the in-memory backend
+"""
+
+# --- IMPORTS ---
+from datetime import datetime
+from datetime import timedelta
+from ciphermail.models.message import Message
+from ciphermail.services.auth import AuthManager
+from ciphermail.services.encryption import EncryptionManager
+from ciphermail.services.messaging import MessagingManager
+from ciphermail.storage.memory import InMemoryBackend
+
+import io
+import pytest
+
+
+# --- GLOBALS ---
+PASSWORD = 'correct horse battery staple'
+KEY = 'test-key'
+
+
+# --- CODE ---
+@pytest.fixture
+def backend() -> InMemoryBackend:
+    backend = InMemoryBackend()
+    auth_manager = AuthManager(backend)
+    for username in ('alice', 'bob', 'carol'):
+        assert auth_manager.register(username, PASSWORD)
+    return backend
+
+
+@pytest.fixture
+def messaging(backend) -> MessagingManager:
+    return MessagingManager(backend)
+
+
+def seed(backend: InMemoryBackend, recipient: str, count: int, same_time: bool = False) -> list:
+    """
+    Stores unread messages directly, oldest first (all at one timestamp if same_time)
+    """
+    token = EncryptionManager.encrypt('body', KEY)
+    start = datetime(2024, 1, 1)
+    messages = [Message('alice', recipient, token, start if same_time else start + timedelta(seconds=n), False)
+                .to_dict() for n in range(count)]
+    backend.get_message_repository().insert_many(messages)
+    return [message['_id'] for message in messages]
+
+
+@pytest.mark.parametrize('same_time', [False, True])
+def test_pages_cover_the_inbox_once_newest_first(backend, messaging, same_time):
+    seed(backend, 'bob', 23, same_time)
+    seen, token = [], None
+
+    while True:
+        page, token = messaging.get_unread_page('bob', 5, token)
+        seen.extend(page)
+        if token is None:
+            break
+
+    assert len(seen) == 23 and len({message._id for message in seen}) == 23
+    keys = [(message.timestamp, message._id) for message in seen]
+    assert keys == sorted(keys, reverse=True)
+    assert [message._id for message in messaging.iter_unread_messages('bob', 4)] == [message._id for message in seen]
+
+
+def test_last_page_has_no_token(backend, messaging):
+    seed(backend, 'bob', 5)
+    page, token = messaging.get_unread_page('bob', 5)
+    assert len(page) == 5 and token is None
+
+
+@pytest.mark.parametrize('page_size', [0, -1])
+def test_page_size_below_one_is_rejected(backend, messaging, page_size):
+    seed(backend, 'bob', 3)
+    with pytest.raises(ValueError):
+        messaging.get_unread_page('bob', page_size)
+    with pytest.raises(ValueError):
+        next(messaging.iter_unread_messages('bob', page_size))
+
+
+def test_malformed_continuation_token_is_rejected(messaging):
+    with pytest.raises(ValueError):
+        messaging.get_unread_page('bob', 5, 'not-a-token')
+
+
+def test_read_stream_only_reads_the_readers_messages(messaging):
+    assert messaging.send_stream('alice', 'bob', io.BytesIO(b'streamed'), KEY, chunk_size=4)
+    message_id = messaging.get_unread_messages('bob')[0]._id
+
+    # Someone else's message: reported as not found, left unread
+    assert messaging.read_stream(message_id, KEY, io.BytesIO(), reader='carol') is False
+    assert len(messaging.get_unread_messages('bob')) == 1
+
+    writer = io.BytesIO()
+    assert messaging.read_stream(message_id, KEY, writer, reader='bob') and writer.getvalue() == b'streamed'
+    assert messaging.get_unread_messages('bob') == []
+
+
+def test_bulk_read_only_reads_the_readers_messages(backend, messaging):
+    ids = seed(backend, 'bob', 2)
+
+    # Someone else's messages: reported as not found, left unread
+    assert messaging.read_messages_bulk(ids, KEY, reader='carol') == dict.fromkeys(ids)
+    assert len(messaging.get_unread_messages('bob')) == 2
+
+    assert messaging.read_messages_bulk(ids, KEY, reader='bob') == dict.fromkeys(ids, 'body')
+    assert messaging.get_unread_messages('bob') == []
+
+
+def test_bulk_read_routes_streamed_bodies_through_their_chunks(backend, messaging):
+    seed(backend, 'bob', 2)
+    messaging.repair_inbox_summaries('bob')
+    assert messaging.send_stream('alice', 'bob', io.BytesIO(b'x' * 10), KEY, chunk_size=3)
+    ids = [message._id for message in messaging.get_unread_messages('bob')]
+
+    results = messaging.read_messages_bulk(ids, KEY)
+
+    assert sorted(results.values()) == ['body', 'body', 'x' * 10]
+    assert messaging.get_unread_messages('bob') == []
+    assert messaging.get_inbox_summary('bob').unread == 0
+
+
+def test_bulk_send_encrypts_per_key_and_reports_unknown_recipients(messaging):
+    result = messaging.send_bulk('alice', {'bob': KEY, 'carol': 'other-key', 'nobody': KEY}, 'hi')
+
+    assert result.delivered == ['bob', 'carol'] and result.unknown == ['nobody'] and result.failed == []
+    carol_message = messaging.get_unread_messages('carol')[0]
+    assert messaging.read_message(carol_message._id, 'other-key', 'carol') == 'hi'
+
+
+def test_bulk_send_without_any_key_is_rejected(messaging):
+    with pytest.raises(ValueError):
+        messaging.send_bulk('alice', ['bob'], 'hi')
+    assert messaging.get_unread_messages('bob') == []
@@ -0,0 +1,73 @@
+"""
+Tests for the password hasher's bounded worker pool
+"""
+
+# --- IMPORTS ---
+from ciphermail.services.passwords import PasswordHasher
+from ciphermail.services.passwords import ScryptKDF
+
+import asyncio
+import threading
+
+import pytest
+
+
+# --- CODE ---
+class BlockingKDF(ScryptKDF):
+    """
+    Scrypt KDF whose hash waits for an event, to keep the only worker busy
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+
+    def hash(self, password: str) -> str:
+        self.started.set()
+        self.release.wait(5)
+        return super().hash(password)
+
+
+def test_hash_and_verify_round_trip():
+    hasher = PasswordHasher(workers=1, max_pending=1)
+    encoded = hasher.hash('secret')
+    assert hasher.verify('secret', encoded)
+    assert not hasher.verify('wrong', encoded)
+
+
+def test_cancelled_async_hash_does_not_leak_its_slot():
+    kdf = BlockingKDF()
+    hasher = PasswordHasher(kdf, workers=1, max_pending=1)
+
+    async def scenario() -> str:
+
+        # Hold the only slot, then give up waiting for it twice
+        busy = asyncio.ensure_future(hasher.hash_async('first'))
+        await asyncio.get_running_loop().run_in_executor(None, kdf.started.wait, 5)
+        for _ in range(2):
+            with pytest.raises(asyncio.TimeoutError):
+                await asyncio.wait_for(hasher.hash_async('second'), 0.05)
+
+        # Busy hash done: its slot, and only it, is free again
+        kdf.release.set()
+        await busy
+        return await asyncio.wait_for(hasher.hash_async('third'), 5)
+
+    assert asyncio.run(scenario()).startswith('scrypt$')
+    assert hasher._slots.acquire(blocking=False)
+    assert not hasher._slots.acquire(blocking=False)
+
+
+def test_sync_submissions_wait_for_a_slot():
+    kdf = BlockingKDF()
+    hasher = PasswordHasher(kdf, workers=1, max_pending=1)
+    first = hasher.submit_hash('first')
+    kdf.started.wait(5)
+
+    # Slot taken: a non-blocking acquire fails until the hash finishes
+    assert not hasher._slots.acquire(blocking=False)
+    kdf.release.set()
+    first.result(5)
+    assert hasher.submit_hash('second').result(5).startswith('scrypt$')
@@ -0,0 +1,109 @@
+"""
+Tests for the read message archiver (need CIPHERMAIL_TEST_MONGODB_URI)
+"""
+
+# --- IMPORTS ---
+from bson import json_util
+from datetime import datetime
+from datetime import timedelta
+from ciphermail.config import migrations
+from ciphermail.config import retention
+from ciphermail.config.database import DatabaseManager
+from ciphermail.config.migrations import MIGRATIONS_COLLECTION
+from ciphermail.config.settings import DatabaseSettings
+from pymongo.errors import PyMongoError
+
+import gzip
+import pytest
+
+
+# --- CODE ---
+@pytest.fixture
+def db_manager(mongo_settings):
+    db_manager = DatabaseManager(mongo_settings, shared=False)
+    yield db_manager
+    db_manager.close()
+
+
+def seed(db_manager: DatabaseManager, read_days_ago: list) -> list:
+    """
+    Stores one message per entry, first read that many days ago (None: unread); the first one is streamed
+    """
+    now = datetime.now()
+    documents = []
+
+    for n, days in enumerate(read_days_ago):
+        document = {'sender': 'alice', 'recipient': 'bob', 'encrypted_content': None if n == 0 else f'token {n}',
+                    'timestamp': now - timedelta(days=400 - n), 'read': days is not None}
+        if days is not None:
+            document['read_at'] = now - timedelta(days=days)
+        if n == 0:
+            document['stream'] = {'nonce': b'\0' * 8, 'chunk_size': 4, 'chunks': 2}
+        documents.append(document)
+
+    db_manager.messages.insert_many(documents)
+    db_manager.message_chunks.insert_many([{'message_id': documents[0]['_id'], 'n': n, 'data': b'chunk'}
+                                           for n in range(2)])
+    return [document['_id'] for document in documents]
+
+
+def test_interrupted_run_resumes_with_its_cutoff(db_manager, monkeypatch, tmp_path):
+    ids = seed(db_manager, [300, 250, 200, 150, 120, 10, None])
+    archive = db_manager.db[retention.ARCHIVE_COLLECTION]
+    archive_batch = retention.archive_batch
+    calls = []
+
+    # Second batch fails: the first one is saved as progress
+    def failing_batch(*args):
+        calls.append(1)
+        if len(calls) == 2:
+            raise PyMongoError('connection lost')
+        return archive_batch(*args)
+
+    monkeypatch.setattr(retention, 'archive_batch', failing_batch)
+    assert retention.archive_read_messages(db_manager, older_than_days=90, batch_size=2) is False
+    progress = db_manager.db[MIGRATIONS_COLLECTION].find_one({'_id': retention.RETENTION_ID})
+    assert progress['archived'] == 2 and archive.count_documents({}) == 2
+
+    # A batch copied but not deleted before the interruption: its copy is skipped when redone
+    archive.insert_one(db_manager.messages.find_one({'_id': ids[2]}))
+
+    # Resume with a shorter age: the saved cutoff still applies, so the message read 10 days ago stays
+    monkeypatch.setattr(retention, 'archive_batch', archive_batch)
+    export_path = tmp_path / 'archive.jsonl.gz'
+    assert retention.archive_read_messages(db_manager, older_than_days=5, batch_size=2, export_path=str(export_path))
+
+    assert sorted(archive.distinct('_id')) == sorted(ids[:5])
+    assert sorted(db_manager.messages.distinct('_id')) == sorted(ids[5:])
+    assert db_manager.message_chunks.count_documents({}) == 0
+    assert db_manager.db[retention.CHUNKS_ARCHIVE_COLLECTION].count_documents({'message_id': ids[0]}) == 2
+    assert db_manager.db[MIGRATIONS_COLLECTION].find_one({'_id': retention.RETENTION_ID}) is None
+
+    with gzip.open(export_path, 'rt', encoding='utf-8') as export:
+        kinds = [next(iter(json_util.loads(line))) for line in export]
+    assert kinds == ['message'] * 3
+
+    # Next run: fresh cutoff
+    assert retention.archive_read_messages(db_manager, older_than_days=5, batch_size=2)
+    assert sorted(db_manager.messages.distinct('_id')) == [ids[6]]
+
+
+def test_streamed_chunks_move_with_their_message(db_manager):
+    ids = seed(db_manager, [300])
+
+    assert retention.archive_read_messages(db_manager, older_than_days=90)
+
+    chunks_archive = db_manager.db[retention.CHUNKS_ARCHIVE_COLLECTION]
+    assert [chunk['n'] for chunk in chunks_archive.find({'message_id': ids[0]}).sort('n', 1)] == [0, 1]
+    assert db_manager.message_chunks.count_documents({}) == 0
+
+
+@pytest.mark.parametrize('script', [retention, migrations])
+def test_scripts_refuse_the_bucket_layout(script, monkeypatch):
+    monkeypatch.setattr(script, 'DatabaseManager',
+                        lambda: DatabaseManager(DatabaseSettings(), shared=False, layout='bucket'))
+    monkeypatch.setattr('sys.argv', [script.__name__])
+
+    with pytest.raises(SystemExit) as exit_info:
+        script.main()
+    assert exit_info.value.code == 1
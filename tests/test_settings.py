@@ -0,0 +1,44 @@
+"""
+Tests for database settings loading
+"""
+
+# --- IMPORTS ---
+from ciphermail.config.settings import load_database_settings
+
+import pytest
+
+
+# --- CODE ---
+@pytest.fixture(autouse=True)
+def clean_environment(monkeypatch):
+    for variable in ('CIPHERMAIL_CONFIG', 'MONGODB_COMPRESSORS', 'MONGODB_ZLIB_LEVEL', 'MONGODB_MAX_POOL_SIZE'):
+        monkeypatch.delenv(variable, raising=False)
+
+
+def test_wire_compression_is_off_by_default():
+    options = load_database_settings().client_options()
+    assert 'compressors' not in options and 'zlibCompressionLevel' not in options
+
+
+def test_wire_compression_is_opt_in_from_the_environment(monkeypatch):
+    monkeypatch.setenv('MONGODB_COMPRESSORS', 'bogus, zlib')
+    monkeypatch.setenv('MONGODB_ZLIB_LEVEL', '6')
+    options = load_database_settings().client_options()
+    assert options['compressors'] == 'zlib' and options['zlibCompressionLevel'] == 6
+
+
+def test_file_values_are_overridden_by_the_environment(tmp_path, monkeypatch):
+    config = tmp_path / 'ciphermail.toml'
+    config.write_text('[database]\ncompressors = ["zlib"]\nmax_pool_size = 5\n')
+    monkeypatch.setenv('MONGODB_MAX_POOL_SIZE', '7')
+
+    settings = load_database_settings(str(config))
+
+    assert settings.compressors == ('zlib',) and settings.max_pool_size == 7
+
+
+def test_unknown_file_setting_is_rejected(tmp_path):
+    config = tmp_path / 'ciphermail.toml'
+    config.write_text('[database]\nmax_pool_sise = 5\n')
+    with pytest.raises(ValueError):
+        load_database_settings(str(config))
@@ -0,0 +1,97 @@
+"""
+Tests for inbox summaries: counter updates on both summary repositories, and their upkeep by the services
+"""
+
+# --- IMPORTS ---
+from datetime import datetime
+from datetime import timedelta
+from ciphermail.services.auth import AuthManager
+from ciphermail.services.messaging import InboxSummary
+from ciphermail.services.messaging import MessagingManager
+from ciphermail.storage.base import SummaryChange
+from ciphermail.storage.memory import InMemoryBackend
+from ciphermail.storage.memory import InMemorySummaryRepository
+from ciphermail.storage.mongo import sender_field
+from ciphermail.storage.mongo import summary_update
+
+import pytest
+
+
+# --- GLOBALS ---
+PASSWORD = 'correct horse battery staple'
+KEY = 'test-key'
+NOON = datetime(2024, 1, 1, 12)
+
+
+# --- CODE ---
+@pytest.fixture(params=['memory', 'mongo'])
+def summaries(request):
+    """
+    Summary repository of each backend (the MongoDB one needs CIPHERMAIL_TEST_MONGODB_URI)
+    """
+
+    # In-memory repository: always available
+    if request.param == 'memory':
+        yield InMemorySummaryRepository()
+        return
+
+    from ciphermail.config.database import DatabaseManager
+    backend = DatabaseManager(request.getfixturevalue('mongo_settings'), shared=False)
+    yield backend.get_summary_repository()
+    backend.close()
+
+
+def test_update_increments_counters_and_keeps_the_latest_time():
+    update = summary_update(SummaryChange('bob', 'a.b', 1, NOON), NOON)
+    assert update['$inc'] == {'unread': 1, 'senders.a%2Eb': 1}
+    assert update['$max'] == {'last_message_at': NOON}
+    assert '$max' not in summary_update(SummaryChange('bob', 'alice', -1), NOON)
+
+
+def test_sender_names_are_escaped_reversibly():
+    assert sender_field('$a.b%c') == '%24a%2Eb%25c'
+
+
+def test_changes_add_up_per_recipient_and_sender(summaries):
+    summaries.apply([SummaryChange('bob', 'alice', 1, NOON),
+                     SummaryChange('bob', 'd.$ave', 1, NOON - timedelta(hours=1)),
+                     SummaryChange('bob', 'alice', 1, NOON + timedelta(hours=1))])
+
+    # An older message arriving late does not move last_message_at back
+    summaries.apply([SummaryChange('bob', 'd.$ave', 1, NOON - timedelta(hours=2))])
+
+    summary = summaries.get('bob')
+    assert summary['unread'] == 4 and summary['last_message_at'] == NOON + timedelta(hours=1)
+    assert summary['senders'] == {'alice': 2, 'd.$ave': 2}
+
+    # Read messages: counted down, senders with nothing unread left out
+    summaries.apply([SummaryChange('bob', 'd.$ave', -2)])
+    assert summaries.get('bob')['senders'] == {'alice': 2}
+
+
+def test_only_new_messages_create_a_summary(summaries):
+    summaries.apply([SummaryChange('carol', 'alice', -1)])
+    assert summaries.get('carol') is None
+
+
+def test_services_keep_summaries_in_step_and_repair_them():
+    backend = InMemoryBackend()
+    auth_manager = AuthManager(backend)
+    for username in ('alice', 'bob'):
+        assert auth_manager.register(username, PASSWORD)
+    messaging = MessagingManager(backend)
+
+    assert messaging.get_inbox_summary('bob') == InboxSummary(0, None, {})
+    for n in range(3):
+        assert messaging.send_message('alice', 'bob', f'message {n}', KEY)
+    message = messaging.get_unread_messages('bob')[0]
+    assert messaging.read_message(message._id, KEY) is not None
+    assert messaging.read_message(message._id, KEY) is not None
+
+    summary = messaging.get_inbox_summary('bob')
+    assert summary.unread == 2 and summary.senders == {'alice': 2}
+
+    # Drifted counters: the repair recounts them from the messages
+    backend.get_summary_repository().apply([SummaryChange('bob', 'alice', 5)])
+    assert messaging.repair_inbox_summaries('bob') == 1
+    assert messaging.get_inbox_summary('bob').unread == 2